@@ -1,6 +1,6 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
-from .models import CustomUser, Book, Transaction, Review, BookRequest, Notification
+from .models import CustomUser, Book, Transaction, Review, BookRequest, Notification, BroadcastNotification
 
 @admin.register(CustomUser)
 class CustomUserAdmin(UserAdmin):
@@ -39,4 +39,8 @@ class BookRequestAdmin(admin.ModelAdmin):
     
 @admin.register(Notification)
 class NotificationAdmin(admin.ModelAdmin):
-    list_display = ['id', 'recipient', 'message']
\ No newline at end of file
+    list_display = ['id', 'recipient', 'message']
+    
+@admin.register(BroadcastNotification)
+class BroadcastNotificationAdmin(admin.ModelAdmin):
+    list_display = ['id', 'message', 'created_at']
@@ -0,0 +1,76 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import RefreshToken
+
+
+# JWT authentication without a users query on every request. The user a token resolves to is kept in a small
+# per-process LRU for AUTH_USER_CACHE_SECONDS, keyed by user id and the token_version claim. Saving a user drops
+# their entries in the process that saved it, the other workers notice within the TTL. Changing the password
+# bumps CustomUser.token_version, which also revokes every token issued before it.
+
+TOKEN_VERSION_CLAIM = 'token_version'
+
+_lock = threading.Lock()
+_users = OrderedDict() # (user_id, token_version) -> (expires_at, user)
+_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+
+class LibraryRefreshToken(RefreshToken):
+    # Access tokens copy their refresh token's claims, so both carry the version
+    @classmethod
+    def for_user(cls, user):
+        token = super().for_user(user)
+        token[TOKEN_VERSION_CLAIM] = user.token_version
+        return token
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken(_("Token contained no recognizable user identification"))
+        key = (user_id, validated_token.get(TOKEN_VERSION_CLAIM, 0)) # Tokens from before the claim count as version 0
+        now = time.monotonic()
+        with _lock:
+            entry = _users.get(key)
+            if entry and entry[0] > now:
+                _users.move_to_end(key)
+                _stats['hits'] += 1
+                return copy.copy(entry[1]) # Views may set attributes on request.user, the cached one stays clean
+            _stats['misses'] += 1
+
+        user = super().get_user(validated_token) # Raises for missing and inactive users, which are never cached
+        if user.token_version != key[1]:
+            raise AuthenticationFailed(_("The token has been revoked, log in again."), code='token_revoked')
+        with _lock:
+            _users[key] = (now + settings.AUTH_USER_CACHE_SECONDS, copy.copy(user))
+            _users.move_to_end(key)
+            while len(_users) > settings.AUTH_USER_CACHE_SIZE:
+                _users.popitem(last=False)
+                _stats['evictions'] += 1
+        return user
+
+
+def evict(user_id):
+    with _lock:
+        for key in [key for key in _users if key[0] == user_id]:
+            del _users[key]
+
+
+def clear():
+    with _lock:
+        _users.clear()
+        _stats.update(hits=0, misses=0, evictions=0)
+
+
+def stats():
+    with _lock:
+        return {**_stats, 'size': len(_users)}
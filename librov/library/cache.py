@@ -0,0 +1,62 @@
+import hashlib
+import time
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+
+# Response cache for catalog reads. Cache keys carry a generation number: 'books' for every listing and
+# 'book:<id>' for one book's detail. A change bumps the generations it affects, so the stale entries are never
+# read again and simply age out. Generations are nanosecond stamps rather than counters, so a generation that
+# was evicted and comes back can't line up with entries written under an older one.
+
+HITS_KEY = 'catalog:stats:hits'
+MISSES_KEY = 'catalog:stats:misses'
+
+
+def catalog_cache():
+    return caches[getattr(settings, 'CATALOG_CACHE_ALIAS', 'default')]
+
+
+def get_generation(name):
+    cache = catalog_cache()
+    key = f'catalog:gen:{name}'
+    generation = cache.get(key)
+    if generation is None:
+        cache.add(key, time.time_ns(), None)
+        generation = cache.get(key)
+    return generation
+
+
+def bump_generations(*names):
+    catalog_cache().set_many({f'catalog:gen:{name}': time.time_ns() for name in names}, None)
+
+
+def invalidate_books(book_ids):
+    # Runs once the write is committed, otherwise a reader could cache the old rows under the new generation
+    names = ['books', *(f'book:{book_id}' for book_id in book_ids)]
+    transaction.on_commit(lambda: bump_generations(*names))
+
+
+def response_cache_key(request, generation_name):
+    # The same filters, search, ordering and page in any order map to the same entry
+    params = sorted((name, sorted(request.query_params.getlist(name))) for name in request.query_params)
+    # Paginated bodies hold absolute next/previous links, so the scheme and host are part of the key too
+    digest = hashlib.md5(repr((request.build_absolute_uri(request.path), params)).encode()).hexdigest()
+    return f'catalog:response:{generation_name}:{get_generation(generation_name)}:{digest}'
+
+
+def record(hit):
+    cache = catalog_cache()
+    key = HITS_KEY if hit else MISSES_KEY
+    try:
+        cache.incr(key)
+    except ValueError:
+        if not cache.add(key, 1, None):
+            cache.incr(key)
+
+
+def stats():
+    values = catalog_cache().get_many([HITS_KEY, MISSES_KEY])
+    hits, misses = values.get(HITS_KEY, 0), values.get(MISSES_KEY, 0)
+    return {'hits': hits, 'misses': misses, 'hit_rate': round(hits / (hits + misses), 4) if hits + misses else None}
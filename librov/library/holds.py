@@ -0,0 +1,28 @@
+from django.db.models import F
+from .models import Book, Hold
+from .signals import book_copies_changed
+
+
+# Where freed copies go, shared by the views and the expire_holds command. Both run inside the caller's transaction.
+
+def release_copies(book_ids):
+    # One copy of each book came free (a return, a cancelled or expired hold): it goes to the head of the book's
+    # hold queue, or back into available_copies when nobody is waiting
+    held = Hold.hand_off(book_ids)
+    shelved = [book_id for book_id in book_ids if book_id not in held]
+    if shelved:
+        Book.objects.filter(id__in=shelved).update(available_copies=F('available_copies') + 1)
+        book_copies_changed.send(sender=Book, book_ids=shelved)
+    return shelved
+
+
+def hand_off_shelved_copy(book_id):
+    # A copy on the shelf while members wait for the book, e.g. one staff added or one returned just before a hold
+    # went in, goes to the head of the queue. Returns whether one did
+    if not Book.objects.filter(id=book_id, available_copies__gt=0).update(available_copies=F('available_copies') - 1):
+        return False
+    if not Hold.hand_off([book_id]):
+        Book.objects.filter(id=book_id).update(available_copies=F('available_copies') + 1) # Nobody left waiting
+        return False
+    book_copies_changed.send(sender=Book, book_ids=[book_id])
+    return True
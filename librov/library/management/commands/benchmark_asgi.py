@@ -0,0 +1,120 @@
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone as dt_timezone
+from pathlib import Path
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test import AsyncClient, Client
+from rest_framework_simplejwt.tokens import RefreshToken
+from library.models import Book, CustomUser
+from library.management.commands.run_benchmark import percentile
+
+
+# Each mode runs in its own process, because which views are routed is settled when the URLconf is loaded
+MODES = {'wsgi': '0', 'asgi': '1'}
+
+
+class Command(BaseCommand):
+    help = ("Compares the read endpoints served the WSGI way (sync views on a fixed pool of worker threads, like a "
+            "gthread worker) with the ASGI way (the async views on one event loop) at several concurrency levels. "
+            "Requests are handled in-process, meant for a database filled by generate_dataset.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, nargs='+', default=[10, 50, 200], help="Requests in flight at once")
+        parser.add_argument('--requests', type=int, default=400, help="Requests per mode and concurrency level")
+        parser.add_argument('--threads', type=int, default=8, help="Worker threads of the WSGI mode")
+        parser.add_argument('--modes', nargs='+', choices=sorted(MODES), default=sorted(MODES, reverse=True))
+        parser.add_argument('--output', help="JSON file for the results, defaults to benchmarks/asgi-<timestamp>.json")
+        parser.add_argument('--child', choices=sorted(MODES), help="Internal, runs one mode and prints its results as JSON")
+
+    def handle(self, *args, **options):
+        if options['child']:
+            results = asyncio.run(self.run_mode(options['child'], options))
+            self.stdout.write(json.dumps(results))
+            return
+
+        report = {
+            'started_at': datetime.now(dt_timezone.utc).isoformat(),
+            'settings': {key: options[key] for key in ('concurrency', 'requests', 'threads')},
+            'modes': {},
+        }
+        for mode in options['modes']:
+            report['modes'][mode] = self.spawn(mode, options)
+            for level, result in report['modes'][mode].items():
+                self.stdout.write(f"{mode:<5} concurrency {level:>4}  {result['throughput_rps']:>8} req/s  p50 {result['p50_ms']:>8}ms  "
+                                  f"p95 {result['p95_ms']:>8}ms  p99 {result['p99_ms']:>8}ms  errors {result['errors']}")
+        output = Path(options['output'] or f"benchmarks/asgi-{datetime.now():%Y%m%d-%H%M%S}.json")
+        output.parent.mkdir(parents=True, exist_ok=True)
+        output.write_text(json.dumps(report, indent=2))
+        self.stdout.write(self.style.SUCCESS(f"Results written to {output}"))
+
+    def spawn(self, mode, options):
+        command = [sys.executable, str(settings.BASE_DIR / 'manage.py'), 'benchmark_asgi', '--child', mode,
+                   '--requests', str(options['requests']), '--threads', str(options['threads']),
+                   '--concurrency', *map(str, options['concurrency'])]
+        finished = subprocess.run(command, env={**os.environ, 'LIBROV_ASYNC_VIEWS': MODES[mode]}, capture_output=True, text=True)
+        if finished.returncode:
+            raise CommandError(f"The {mode} run failed:\n{finished.stderr}")
+        return json.loads(finished.stdout.strip().splitlines()[-1])
+
+    async def run_mode(self, mode, options):
+        members, book_ids = await self.fixtures()
+        tokens = [str(RefreshToken.for_user(member).access_token) for member in members]
+        paths = [
+            lambda n: f'/library/books/?page={n % 50 + 1}',
+            lambda n: f'/library/books/{book_ids[n * 7919 % len(book_ids)]}/',
+            lambda n: f'/library/reviews/?book={book_ids[n * 104729 % len(book_ids)]}',
+            lambda n: '/library/notifications/',
+        ]
+        settings.ALLOWED_HOSTS = [*settings.ALLOWED_HOSTS, 'testserver'] # The test clients' host
+        if mode == 'asgi':
+            client = AsyncClient(raise_request_exception=False)
+            async def send(path, token):
+                response = await client.get(path, headers={'authorization': f'Bearer {token}'})
+                return response.status_code
+        else:
+            pool = ThreadPoolExecutor(options['threads'], thread_name_prefix='wsgi')
+            local = threading.local()
+            def get(path, token):
+                if not hasattr(local, 'client'):
+                    local.client = Client(raise_request_exception=False)
+                return local.client.get(path, HTTP_AUTHORIZATION=f'Bearer {token}').status_code
+            async def send(path, token):
+                return await asyncio.get_running_loop().run_in_executor(pool, get, path, token)
+
+        async def level(concurrency):
+            gate = asyncio.Semaphore(concurrency)
+            timings, errors = [], 0
+            async def one(n):
+                nonlocal errors
+                async with gate:
+                    started = time.perf_counter()
+                    status = await send(paths[n % len(paths)](n), tokens[n % len(tokens)])
+                    timings.append(time.perf_counter() - started)
+                    errors += status >= 400
+            await asyncio.gather(*(one(n) for n in range(min(concurrency, 50)))) # Warm up connections and caches
+            timings, errors = [], 0
+            started = time.perf_counter()
+            await asyncio.gather(*(one(n) for n in range(options['requests'])))
+            wall = time.perf_counter() - started
+            timings.sort()
+            return {
+                'requests': len(timings), 'errors': errors, 'throughput_rps': round(len(timings) / wall, 1),
+                'p50_ms': round(percentile(timings, 50) * 1000, 2), 'p95_ms': round(percentile(timings, 95) * 1000, 2),
+                'p99_ms': round(percentile(timings, 99) * 1000, 2),
+            }
+        return {str(concurrency): await level(concurrency) for concurrency in options['concurrency']}
+
+    @staticmethod
+    async def fixtures():
+        members = [member async for member in CustomUser.objects.filter(is_staff=False, username__startswith='bench').order_by('id')[:32]]
+        book_ids = [pk async for pk in Book.objects.order_by('id').values_list('id', flat=True)[:50000]]
+        if not members or not book_ids:
+            raise CommandError("No generated members or books, run generate_dataset first")
+        return members, book_ids
@@ -0,0 +1,79 @@
+import random
+import statistics
+import time
+from datetime import date, timedelta
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from rest_framework.filters import SearchFilter
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+from library.management.wordlists import GENRES, NAMES, WORDS
+from library.models import Book
+from library.search import BookSearchFilter, search_index_available
+from library.views import BookViewSet
+
+
+class Command(BaseCommand):
+    help = ("Compares ?search= with and without search_mode=fts on a generated catalog. "
+            "The generated books are rolled back when the benchmark finishes.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--books', type=int, nargs='+', default=[100000, 1000000])
+        parser.add_argument('--queries', type=int, default=50, help="Searches to time per mode")
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        if not search_index_available(connection.alias):
+            raise CommandError("The full-text index is missing, run migrate or rebuild_search_index first")
+        for size in options['books']:
+            with transaction.atomic():
+                self.run_size(size, options['queries'], random.Random(options['seed']))
+                transaction.set_rollback(True)
+
+    def run_size(self, size, query_count, rng):
+        started = time.perf_counter()
+        existing = Book.objects.count()
+        batch = []
+        for number in range(existing, size):
+            batch.append(Book(
+                title=' '.join(rng.choice(WORDS).title() for _ in range(rng.randint(2, 5))),
+                author=f'{rng.choice(NAMES)} {rng.choice(NAMES)}',
+                isbn=f'{9780000000000 + number}',
+                genre=rng.choice(GENRES),
+                published_date=date(1950, 1, 1) + timedelta(days=rng.randint(0, 27000)),
+                available_copies=rng.randint(0, 5),
+            ))
+            if len(batch) == 5000:
+                Book.objects.bulk_create(batch)
+                batch = []
+        Book.objects.bulk_create(batch)
+        self.stdout.write(f"\n{size} books ready in {time.perf_counter() - started:.1f}s")
+
+        searches = []
+        for _ in range(query_count):
+            kind = rng.random()
+            if kind < 0.4:
+                searches.append(rng.choice(WORDS))
+            elif kind < 0.7:
+                searches.append(rng.choice(WORDS)[:rng.randint(3, 5)]) # What the catalog UI sends while typing
+            elif kind < 0.9:
+                searches.append(f'{rng.choice(WORDS)} {rng.choice(NAMES)}')
+            else:
+                searches.append(f'{9780000000000 + rng.randrange(size)}')
+
+        view = BookViewSet()
+        factory = APIRequestFactory()
+        for label, backend, extra in [('icontains (SearchFilter)', SearchFilter(), {}),
+                                      ('fts (search_mode=fts)', BookSearchFilter(), {'search_mode': 'fts'})]:
+            timings = []
+            for term in searches:
+                request = Request(factory.get('/library/books/', {'search': term, **extra}))
+                began = time.perf_counter()
+                queryset = backend.filter_queryset(request, Book.objects.all(), view)
+                queryset.count() # What the paginator runs first
+                list(queryset[:10])
+                timings.append((time.perf_counter() - began) * 1000)
+            timings.sort()
+            p95 = timings[int(len(timings) * 0.95) - 1]
+            self.stdout.write(f"  {label:<26} mean {statistics.mean(timings):8.2f}ms  "
+                              f"p50 {statistics.median(timings):8.2f}ms  p95 {p95:8.2f}ms")
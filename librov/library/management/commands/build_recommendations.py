@@ -0,0 +1,123 @@
+import heapq
+import math
+import time
+from collections import Counter, defaultdict
+from itertools import chain
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Exists, OuterRef, Q
+from django.utils import timezone
+from library.models import BookSimilarity, JobWatermark, Review, Transaction
+
+
+WATERMARK = 'build_recommendations'
+
+
+class Command(BaseCommand):
+    help = ("Precomputes the most similar books for every book from who borrowed and reviewed what: two books are "
+            "similar when the same members read both. Meant for cron. Runs after the first only recompute the books "
+            "of members who borrowed or reviewed something since the last run, --full recomputes everything.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--neighbours', type=int, default=20, help="How many similar books to keep per book")
+        parser.add_argument('--max-books-per-member', type=int, default=500,
+                            help="Members with more books than this are left out, a kiosk or staff account would link every book to every other")
+        parser.add_argument('--full', action='store_true', help="Recompute every book, e.g. weekly, which also drops deleted loans and reviews")
+        parser.add_argument('--batch-size', type=int, default=500, help="How many books to write per transaction")
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        now = timezone.now() # Taken before reading, so anything written during the run is picked up by the next one
+        since = None if options['full'] else JobWatermark.get(WATERMARK)
+
+        if since is None:
+            books_of = self.books_of(Q())
+        else:
+            # Not the whole history: the rows of every member who read a book of a member who borrowed or reviewed
+            # something since, which holds every member of those books and all their other books
+            recent = Q(user_id__in=Transaction.objects.filter(checkout_date__gt=since).values('user_id'))
+            recent |= Q(user_id__in=Review.objects.filter(updated_at__gt=since).values('user_id'))
+            books_of = self.books_of(self.either('user_id', self.either('book_id', recent)))
+
+        # The member x book matrix, kept sparse as a set of books per member and a set of members per book
+        members_of = defaultdict(set)
+        for user_id, book_ids in books_of.items():
+            if len(book_ids) <= options['max_books_per_member']:
+                for book_id in book_ids:
+                    members_of[book_id].add(user_id)
+
+        if since is None:
+            member_counts = {book_id: len(members) for book_id, members in members_of.items()}
+            book_ids = sorted(members_of)
+            # Books nobody has borrowed or reviewed any more keep no neighbours, the rest are replaced below
+            stored = set(BookSimilarity.objects.values_list('book_id', flat=True).distinct())
+            book_ids = sorted(stored - set(members_of)) + book_ids
+        else:
+            # A new loan or review changes the counts between the book and everything else its member has read. It also
+            # shifts the scores other books give the new book a little, those wait for the next --full run
+            changed = set(Transaction.objects.filter(checkout_date__gt=since).values_list('user_id', flat=True))
+            changed.update(Review.objects.filter(updated_at__gt=since).values_list('user_id', flat=True))
+            book_ids = sorted({book_id for user_id in changed for book_id in books_of.get(user_id, ())})
+            # The other books only have the members loaded above, their full counts come from the database
+            left_out = [user_id for user_id, their_books in books_of.items() if len(their_books) > options['max_books_per_member']]
+            member_counts = self.member_counts(sorted(members_of), left_out, options['batch_size'])
+
+        written = 0
+        for start in range(0, len(book_ids), options['batch_size']):
+            batch = book_ids[start:start + options['batch_size']]
+            rows = [row for book_id in batch for row in self.neighbours(book_id, books_of, members_of, member_counts, options)]
+            with transaction.atomic():
+                BookSimilarity.objects.filter(book_id__in=batch).delete()
+                BookSimilarity.objects.bulk_create(rows)
+            written += len(rows)
+
+        JobWatermark.set(WATERMARK, now)
+        mode = f'all {len(members_of)} borrowed or reviewed' if since is None else f'changed since {since:%Y-%m-%d %H:%M}, {len(members_of)} loaded'
+        self.stdout.write(self.style.SUCCESS(
+            f"Recomputed {len(book_ids)} books ({mode}), "
+            f"{written} neighbours stored in {time.perf_counter() - started:.1f}s"))
+
+    @staticmethod
+    def books_of(condition):
+        # Member -> the books they borrowed or reviewed, from the loans and reviews meeting the condition
+        books_of = defaultdict(set)
+        for user_id, book_id in Transaction.objects.filter(condition).values_list('user_id', 'book_id').distinct().iterator():
+            books_of[user_id].add(book_id)
+        for user_id, book_id in Review.objects.filter(condition).values_list('user_id', 'book_id').iterator():
+            books_of[user_id].add(book_id)
+        return books_of
+
+    @staticmethod
+    def either(field, condition):
+        # Loans and reviews with the same <field> as a loan or review meeting the condition, as a subquery on both tables
+        return (Q(**{f'{field}__in': Transaction.objects.filter(condition).values(field)})
+                | Q(**{f'{field}__in': Review.objects.filter(condition).values(field)}))
+
+    @staticmethod
+    def member_counts(book_ids, left_out, batch_size):
+        # Members per book counted by the database, the members who borrowed it plus those who only reviewed it.
+        # Only the left out members that were loaded are known, other heavy accounts count until the next --full run
+        counts = Counter()
+        for start in range(0, len(book_ids), batch_size):
+            batch = book_ids[start:start + batch_size]
+            borrowers = (Transaction.objects.filter(book_id__in=batch).exclude(user_id__in=left_out)
+                         .values_list('book_id').annotate(Count('user_id', distinct=True)).order_by())
+            reviewers = (Review.objects.filter(book_id__in=batch).exclude(user_id__in=left_out)
+                         .exclude(Exists(Transaction.objects.filter(user_id=OuterRef('user_id'), book_id=OuterRef('book_id'))))
+                         .values_list('book_id').annotate(Count('id')).order_by())
+            for book_id, count in chain(borrowers, reviewers):
+                counts[book_id] += count
+        return counts
+
+    @staticmethod
+    def neighbours(book_id, books_of, members_of, member_counts, options):
+        # One row of the co-occurrence matrix (members in common with every other book), scored by cosine similarity
+        members = members_of.get(book_id, ())
+        common = Counter()
+        for user_id in members:
+            common.update(books_of[user_id])
+        common.pop(book_id, None)
+        scored = ((count / math.sqrt(len(members) * member_counts[other]), -other) for other, count in common.items())
+        top = heapq.nlargest(options['neighbours'], scored) # Ties go to the older book, so reruns store the same ranking
+        return [BookSimilarity(book_id=book_id, similar_id=-negated_id, rank=rank, score=score)
+                for rank, (score, negated_id) in enumerate(top, 1)]
@@ -0,0 +1,50 @@
+import time
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+from library.holds import hand_off_shelved_copy, release_copies
+from library.models import Hold, Notification
+
+
+class Command(BaseCommand):
+    help = ("Expires ready holds that were not picked up in time and passes their copies on to the next member in "
+            "line. Also hands copies sitting on the shelf to members still waiting, e.g. copies added by staff. "
+            "Meant for cron, e.g. every hour.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        now = timezone.now()
+        expired = 0
+        while True:
+            # Along the (status, ready_until) index, the holds handled in the last chunk are no longer READY
+            chunk = list(Hold.objects.filter(status=Hold.READY, ready_until__lt=now).order_by('ready_until', 'id')
+                         .values_list('id', 'user_id', 'book_id', 'book__title')[:options['chunk_size']])
+            if not chunk:
+                break
+            with transaction.atomic():
+                ids = [hold_id for hold_id, *_ in chunk]
+                claimed = set(Hold.objects.filter(id__in=ids, status=Hold.READY).values_list('id', flat=True))
+                Hold.objects.filter(id__in=claimed).update(status=Hold.EXPIRED)
+                Notification.objects.bulk_create([
+                    Notification(recipient_id=user_id, message=f'Your hold on "{title}" expired and the copy went to the next member in line.')
+                    for hold_id, user_id, book_id, title in chunk if hold_id in claimed
+                ])
+                for hold_id, user_id, book_id, title in chunk:
+                    if hold_id in claimed:
+                        release_copies([book_id]) # One at a time, two expired holds on a book free two copies
+            expired += len(claimed)
+
+        handed = 0
+        waiting_for_shelved = Hold.objects.filter(status=Hold.WAITING, book__available_copies__gt=0).values_list('book_id', flat=True).distinct()
+        for book_id in list(waiting_for_shelved):
+            while True:
+                with transaction.atomic():
+                    if not hand_off_shelved_copy(book_id):
+                        break
+                handed += 1
+
+        self.stdout.write(self.style.SUCCESS(
+            f"{expired} holds expired, {handed} shelved copies handed to waiting members in {time.perf_counter() - started:.2f}s"))
@@ -0,0 +1,154 @@
+import random
+import time
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta, timezone as dt_timezone
+from django.contrib.auth.hashers import make_password
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from library.cache import bump_generations
+from library.management.wordlists import GENRES, NAMES, WORDS
+from library.models import Book, CustomUser, Notification, Review, ResourceVersion, Transaction
+
+
+PASSWORD = 'librov-bench' # Every generated member logs in with this
+REVIEW_TEXTS = ['Loved it.', 'Not for me.', 'A slow start but worth it.', 'Read it twice.', 'The ending let me down.',
+                'Would recommend to anyone who likes the genre.', 'Beautifully written.', 'Too long.']
+
+
+@contextmanager
+def historical_timestamps(*models):
+    # auto_now / auto_now_add would stamp every generated row with the time of the run, this lets the
+    # generated dates through for the duration of the bulk inserts
+    fields = [field for model in models for field in model._meta.concrete_fields
+              if getattr(field, 'auto_now', False) or getattr(field, 'auto_now_add', False)]
+    saved = [(field, field.auto_now, field.auto_now_add) for field in fields]
+    for field in fields:
+        field.auto_now = field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field, auto_now, auto_now_add in saved:
+            field.auto_now, field.auto_now_add = auto_now, auto_now_add
+
+
+class Command(BaseCommand):
+    help = ("Fills the database with a synthetic library for load tests: members, books, loans, reviews and "
+            "notifications, inserted in bulk. The same --seed on an empty database gives the same data every time.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--books', type=int, default=10000)
+        parser.add_argument('--transactions', type=int, default=50000)
+        parser.add_argument('--reviews', type=int, default=20000)
+        parser.add_argument('--notifications', type=int, default=20000)
+        parser.add_argument('--open-loans', type=float, default=0.1, help="Share of the loans that are still out")
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        if CustomUser.objects.filter(username__startswith='bench').exists():
+            raise CommandError("This database already has a generated dataset, generate into an empty one to keep runs comparable")
+        if options['books'] < 1 or options['users'] < 1:
+            raise CommandError("--books and --users must be at least 1")
+        rng = random.Random(options['seed'])
+        self.batch_size = options['batch_size']
+        # Dates are spread over the year before a fixed day rather than before today, so reruns match exactly
+        self.end = datetime(2025, 1, 1, tzinfo=dt_timezone.utc)
+        started = time.perf_counter()
+
+        with transaction.atomic(), historical_timestamps(CustomUser, Transaction, Review, Notification):
+            user_ids = self.step('users', self.users(rng, options['users']))
+            book_ids = self.step('books', self.books(rng, options['books']))
+            self.step('transactions', self.transactions(rng, options['transactions'], user_ids, book_ids, options['open_loans']))
+            self.step('reviews', self.reviews(rng, options['reviews'], user_ids, book_ids))
+            self.step('notifications', self.notifications(rng, options['notifications'], user_ids))
+
+        # Bulk inserts skip the signals, so the rating totals, trends, versions and cached pages are brought up to date here
+        call_command('rebuild_rating_aggregates', stdout=self.stdout)
+        call_command('rebuild_trends', stdout=self.stdout)
+        ResourceVersion.bump('books', 'reviews')
+        bump_generations('books')
+        self.stdout.write(self.style.SUCCESS(
+            f"Dataset (seed {options['seed']}) generated in {time.perf_counter() - started:.1f}s. Members log in as bench000001... "
+            f"with the password {PASSWORD!r}"))
+
+    def step(self, name, batches):
+        started = time.perf_counter()
+        ids = []
+        for model, batch in batches:
+            ids += [row.pk for row in model.objects.bulk_create(batch)]
+        self.stdout.write(f"  {len(ids)} {name} in {time.perf_counter() - started:.1f}s")
+        return ids
+
+    def batched(self, model, rows):
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) == self.batch_size:
+                yield model, batch
+                batch = []
+        if batch:
+            yield model, batch
+
+    def moment(self, rng, days_back=365):
+        return self.end - timedelta(seconds=rng.randrange(days_back * 86400))
+
+    def users(self, rng, count):
+        password = make_password(PASSWORD, salt='librovbench') # Hashed once, hashing per member would take minutes
+        def rows():
+            for number in range(1, count + 1):
+                joined = self.moment(rng, 730)
+                yield CustomUser(username=f'bench{number:06d}', email=f'bench{number:06d}@example.com', password=password,
+                                 first_name=rng.choice(WORDS).title(), last_name=rng.choice(NAMES),
+                                 date_joined=joined, date_of_membership=joined.date())
+        return self.batched(CustomUser, rows())
+
+    def books(self, rng, count):
+        def rows():
+            for number in range(count):
+                yield Book(
+                    title=' '.join(rng.choice(WORDS).title() for _ in range(rng.randint(2, 5))),
+                    author=f'{rng.choice(NAMES)} {rng.choice(NAMES)}',
+                    isbn=f'{9790000000000 + number}',
+                    genre=rng.choice(GENRES),
+                    published_date=date(1950, 1, 1) + timedelta(days=rng.randint(0, 27000)),
+                    available_copies=rng.randint(0, 8),
+                )
+        return self.batched(Book, rows())
+
+    def transactions(self, rng, count, user_ids, book_ids, open_share):
+        open_loans = set() # unique_open_loan allows one open loan per member and book
+        def rows():
+            for _ in range(count):
+                user_id, book_id = rng.choice(user_ids), rng.choice(book_ids)
+                checkout = self.moment(rng)
+                returned = None
+                if rng.random() >= open_share or (user_id, book_id) in open_loans:
+                    returned = checkout + timedelta(seconds=rng.randrange(30 * 86400))
+                else:
+                    open_loans.add((user_id, book_id))
+                yield Transaction(user_id=user_id, book_id=book_id, checkout_date=checkout,
+                                  expected_return_date=checkout + timedelta(days=14), return_date=returned)
+        return self.batched(Transaction, rows())
+
+    def reviews(self, rng, count, user_ids, book_ids):
+        count = min(count, len(user_ids) * len(book_ids))
+        def rows():
+            reviewed = set() # One review per member and book
+            while len(reviewed) < count:
+                pair = (rng.choice(user_ids), rng.choice(book_ids))
+                if pair in reviewed:
+                    continue
+                reviewed.add(pair)
+                created = self.moment(rng)
+                yield Review(user_id=pair[0], book_id=pair[1], review_text=rng.choice(REVIEW_TEXTS),
+                             rating=rng.choices(range(1, 6), weights=[1, 2, 4, 6, 5])[0], created_at=created, updated_at=created)
+        return self.batched(Review, rows())
+
+    def notifications(self, rng, count, user_ids):
+        def rows():
+            for _ in range(count):
+                yield Notification(recipient_id=rng.choice(user_ids), is_read=rng.random() < 0.6, created_at=self.moment(rng),
+                                   message=f'"{" ".join(rng.choice(WORDS).title() for _ in range(3))}" is ready for pick up.')
+        return self.batched(Notification, rows())
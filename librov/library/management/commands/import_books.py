@@ -0,0 +1,121 @@
+import csv
+import json
+import time
+from pathlib import Path
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from library.models import Book, ResourceVersion
+from library.signals import book_copies_changed
+
+
+IMPORT_FIELDS = ['title', 'author', 'isbn', 'genre', 'published_date', 'available_copies']
+
+
+class Command(BaseCommand):
+    help = ("Streams books from a CSV or NDJSON file into the catalog, inserting new ISBNs and updating existing ones "
+            "in chunks. Existing books keep their available_copies, which loans and holds keep track of, unless "
+            "--overwrite-copies is given. Rows that fail validation are written to a rejects file next to the input.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=['csv', 'ndjson'], help="Defaults to the file extension")
+        parser.add_argument('--chunk-size', type=int, default=2000)
+        parser.add_argument('--rejects', help="Where to write rejected rows, defaults to <path>.rejects.<format>")
+        parser.add_argument('--overwrite-copies', action='store_true',
+                            help="Set available_copies of books that already exist from the file too, e.g. after a stocktake. "
+                                 "Copies on loan or set aside for holds are not in the count, so the file has to leave them out")
+
+    def handle(self, *args, **options):
+        path = Path(options['path'])
+        if not path.exists():
+            raise CommandError(f"{path} does not exist")
+        file_format = options['format'] or ('ndjson' if path.suffix in ('.ndjson', '.jsonl') else 'csv')
+        rejects_path = Path(options['rejects'] or f'{path}.rejects.{file_format}')
+        update_fields = [field for field in IMPORT_FIELDS if field != 'isbn' and (options['overwrite_copies'] or field != 'available_copies')]
+
+        started = time.perf_counter()
+        read = upserted = rejected = 0
+        chunk = {}
+        with path.open(newline='', encoding='utf-8-sig') as source, rejects_path.open('w', newline='', encoding='utf-8') as rejects:
+            reject = self.reject_writer(rejects, file_format)
+            for line_number, row in self.read_rows(source, file_format):
+                read += 1
+                try:
+                    book = self.clean_row(row)
+                except ValidationError as error:
+                    rejected += 1
+                    reject(row, line_number, '; '.join(f'{field}: {" ".join(messages)}' for field, messages in error.message_dict.items()))
+                    continue
+                chunk[book.isbn] = book # A repeated ISBN within a chunk keeps its last row, one statement can't upsert a row twice
+                if len(chunk) >= options['chunk_size']:
+                    upserted += self.upsert(chunk, update_fields)
+                    chunk = {}
+            if chunk:
+                upserted += self.upsert(chunk, update_fields)
+        ResourceVersion.bump('reviews') # Reviews show book titles, which the import may have changed
+
+        elapsed = time.perf_counter() - started
+        if not rejected:
+            rejects_path.unlink()
+        self.stdout.write(self.style.SUCCESS(
+            f"{read} rows read, {upserted} books inserted or updated, {rejected} rejected in {elapsed:.1f}s "
+            f"({read / elapsed if elapsed else read:.0f} rows/s)"))
+        if rejected:
+            self.stdout.write(f"Rejected rows written to {rejects_path}")
+
+    def read_rows(self, source, file_format):
+        if file_format == 'csv':
+            for line_number, row in enumerate(csv.DictReader(source), start=2):
+                yield line_number, row
+            return
+        for line_number, line in enumerate(source, start=1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                row = {'_raw': line.rstrip('\n')}
+            yield line_number, row if isinstance(row, dict) else {'_raw': line.rstrip('\n')}
+
+    def clean_row(self, row):
+        # The same checks the model fields make (required, max_length, dates, positive copies), without a query per row
+        if '_raw' in row:
+            raise ValidationError({'row': ['Not a JSON object']})
+        errors = {}
+        values = {}
+        for name in IMPORT_FIELDS:
+            field = Book._meta.get_field(name)
+            value = row.get(name)
+            if isinstance(value, str):
+                value = value.strip()
+                if name == 'isbn':
+                    value = Book.normalize_isbn(value)
+            if value in (None, '') and name == 'available_copies':
+                value = field.default
+            try:
+                values[name] = field.clean(value, None)
+            except ValidationError as error:
+                errors[name] = error.messages
+        if errors:
+            raise ValidationError(errors)
+        return Book(**values)
+
+    def upsert(self, chunk, update_fields):
+        with transaction.atomic():
+            books = Book.objects.bulk_create(list(chunk.values()), update_conflicts=True, unique_fields=['isbn'], update_fields=update_fields)
+            # bulk_create skips save signals, so versions and cached pages are updated the way checkouts do it
+            book_copies_changed.send(sender=Book, book_ids=[book.pk for book in books if book.pk is not None])
+        return len(books)
+
+    def reject_writer(self, rejects, file_format):
+        if file_format == 'ndjson':
+            def write(row, line_number, error):
+                rejects.write(json.dumps({**row, '_line': line_number, '_error': error}) + '\n')
+            return write
+        writer = csv.DictWriter(rejects, fieldnames=IMPORT_FIELDS + ['_line', '_error'], extrasaction='ignore')
+        writer.writeheader()
+
+        def write(row, line_number, error):
+            writer.writerow({**row, '_line': line_number, '_error': error})
+        return write
@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Sum
+from library.cache import invalidate_books
+from library.models import Book, ResourceVersion, Review
+
+
+RATING_FIELDS = ['rating_sum', 'rating_count'] + [f'rating_{rating}_count' for rating in range(1, 6)]
+
+
+class Command(BaseCommand):
+    help = "Recalculates the stored rating totals on every book from its reviews"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help="How many books to write per query")
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        # One grouped query over the reviews gives the count per (book, rating), everything else is built from that
+        totals = {}
+        rows = Review.objects.values('book_id', 'rating').annotate(count=Count('id'), total=Sum('rating')).order_by()
+        for row in rows.iterator():
+            book_totals = totals.setdefault(row['book_id'], dict.fromkeys(RATING_FIELDS, 0))
+            book_totals['rating_sum'] += row['total']
+            book_totals['rating_count'] += row['count']
+            if 1 <= row['rating'] <= 5:
+                book_totals[f"rating_{row['rating']}_count"] += row['count']
+
+        updated = 0
+        with transaction.atomic():
+            # Clear every book that has totals, the reviewed ones get their real values written back below
+            rated = Book.objects.exclude(rating_count=0, rating_sum=0)
+            touched = set(rated.values_list('id', flat=True)) | set(totals)
+            rated.update(**dict.fromkeys(RATING_FIELDS, 0))
+            book_ids = list(totals)
+            for start in range(0, len(book_ids), batch_size):
+                books = Book.objects.filter(id__in=book_ids[start:start + batch_size]).only('id', *RATING_FIELDS)
+                for book in books:
+                    for field, value in totals[book.id].items():
+                        setattr(book, field, value)
+                updated += Book.objects.bulk_update(books, RATING_FIELDS)
+            # update() and bulk_update() send no save signals, so the versions and cached pages move here the way the
+            # signals move them
+            ResourceVersion.bump('books', *(f'book:{book_id}' for book_id in sorted(touched)))
+            invalidate_books(sorted(touched))
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt rating totals for {updated} reviewed books"))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+from library.search import install_search_index
+
+
+class Command(BaseCommand):
+    help = "Recreates the full-text search table and triggers for books and re-indexes the whole catalog"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS)
+
+    def handle(self, *args, **options):
+        if not install_search_index(connections[options['database']]):
+            raise CommandError("Full-text search is only available on SQLite databases")
+        self.stdout.write(self.style.SUCCESS("Search index rebuilt"))
@@ -0,0 +1,45 @@
+from collections import defaultdict
+from datetime import timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+from library.models import Book, BookTrend, JobWatermark, Review, Transaction
+
+
+class Command(BaseCommand):
+    help = ("Recalculates the trending scores of every book from the loan and review history. Checkout and reviews "
+            "keep them up to date, this is for filling them in the first time or after bulk imports. Either way the "
+            "scores are rebased on today, which has to happen at least every few years (e.g. monthly from cron, "
+            "with --rebase-only) before the weights outgrow a float.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--half-lives', type=int, default=20,
+                            help="Events older than this many half-lives are skipped, they would add less than a millionth")
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--rebase-only', action='store_true', help="Only move the epoch to today and rescale the stored scores")
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        epoch = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        if options['rebase_only']:
+            BookTrend.rebase(epoch)
+            self.stdout.write(self.style.SUCCESS(f"Trending scores rebased on {epoch:%Y-%m-%d}"))
+            return
+
+        borrow_since = now - timedelta(days=settings.TRENDING_BORROW_HALF_LIFE_DAYS * options['half_lives'])
+        rating_since = now - timedelta(days=settings.TRENDING_RATING_HALF_LIFE_DAYS * options['half_lives'])
+        scores = defaultdict(lambda: {'borrow_score': 0.0, 'rating_score': 0.0})
+        for book_id, checkout_date in Transaction.objects.filter(checkout_date__gte=borrow_since).values_list('book_id', 'checkout_date').iterator():
+            scores[book_id]['borrow_score'] += BookTrend.borrow_weight(checkout_date, epoch)
+        for book_id, rating, created_at in Review.objects.filter(created_at__gte=rating_since).values_list('book_id', 'rating', 'created_at').iterator():
+            scores[book_id]['rating_score'] += (rating - 3) * BookTrend.rating_weight(created_at, epoch)
+
+        genres = dict(Book.objects.filter(id__in=list(scores)).values_list('id', 'genre'))
+        with transaction.atomic():
+            BookTrend.epoch() # Locks the epoch, checkouts and reviews wait rather than add weights against the old one
+            JobWatermark.set(BookTrend.EPOCH_WATERMARK, epoch)
+            BookTrend.objects.all().delete()
+            BookTrend.objects.bulk_create([BookTrend(book_id=book_id, genre=genre, **scores[book_id]) for book_id, genre in genres.items()],
+                                          batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt trending scores for {len(genres)} books, rebased on {epoch:%Y-%m-%d}"))
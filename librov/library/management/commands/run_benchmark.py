@@ -0,0 +1,201 @@
+import json
+import platform
+import random
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone as dt_timezone
+from pathlib import Path
+from urllib.error import HTTPError, URLError
+from urllib.request import Request as URLRequest, urlopen
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from library.authentication import LibraryRefreshToken
+from library.management.wordlists import GENRES, WORDS
+from library.models import Book, CustomUser, Review
+
+
+class Command(BaseCommand):
+    help = ("Drives the library API routes with concurrent requests and reports p50/p95/p99 latency and throughput "
+            "per endpoint. Runs in-process through the full middleware stack, or against a live server with --base-url. "
+            "Meant for a database filled by generate_dataset.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200, help="Requests per endpoint")
+        parser.add_argument('--concurrency', type=int, default=8)
+        parser.add_argument('--warmup', type=int, default=10, help="Untimed requests per endpoint before measuring")
+        parser.add_argument('--endpoints', nargs='+', help="Only run these scenarios, e.g. books-list books-detail")
+        parser.add_argument('--writes', action='store_true', help="Also benchmark checkout and return, which change the data")
+        parser.add_argument('--mixed', action='store_true', help="Send every scenario's requests interleaved in one run instead of one scenario after another")
+        parser.add_argument('--base-url', help="e.g. http://127.0.0.1:8000, otherwise requests are handled in-process")
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--output', help="JSON file for the results, defaults to benchmarks/<timestamp>.json")
+        parser.add_argument('--compare', help="An earlier results file to print the differences against")
+
+    def handle(self, *args, **options):
+        members = list(CustomUser.objects.filter(is_staff=False, username__startswith='bench').order_by('id')[:options['concurrency'] * 4])
+        book_ids = list(Book.objects.order_by('id').values_list('id', flat=True)[:50000])
+        if not members or not book_ids:
+            raise CommandError("No generated members or books, run generate_dataset first")
+        self.tokens = [str(LibraryRefreshToken.for_user(member).access_token) for member in members]
+        self.base_url = options['base_url'].rstrip('/') if options['base_url'] else None
+        self.local = threading.local()
+        rng = random.Random(options['seed'])
+
+        scenarios = self.scenarios(rng, book_ids, options)
+        if options['endpoints']:
+            unknown = set(options['endpoints']) - {name for name, *_ in scenarios}
+            if unknown:
+                raise CommandError(f"Unknown endpoints {', '.join(sorted(unknown))}")
+            scenarios = [scenario for scenario in scenarios if scenario[0] in options['endpoints']]
+
+        results = {}
+        if options['mixed']:
+            # Readers and writers at the same time, which is where lock contention shows up
+            results.update(self.run_scenarios(scenarios, options))
+        else:
+            for scenario in scenarios:
+                results.update(self.run_scenarios([scenario], options))
+
+        report = {
+            'started_at': datetime.now(dt_timezone.utc).isoformat(),
+            'target': self.base_url or 'in-process',
+            'settings': {key: options[key] for key in ('requests', 'concurrency', 'warmup', 'seed', 'writes', 'mixed')},
+            'environment': {
+                'python': platform.python_version(), 'django': django.get_version(), 'database': connection.vendor,
+                'books': Book.objects.count(), 'members': CustomUser.objects.count(), 'reviews': Review.objects.count(),
+            },
+            'endpoints': results,
+        }
+        output = Path(options['output'] or f"benchmarks/{datetime.now():%Y%m%d-%H%M%S}.json")
+        output.parent.mkdir(parents=True, exist_ok=True)
+        output.write_text(json.dumps(report, indent=2))
+        self.stdout.write(self.style.SUCCESS(f"Results written to {output}"))
+        if options['compare']:
+            self.compare(json.loads(Path(options['compare']).read_text()), report)
+
+    def scenarios(self, rng, book_ids, options):
+        # (name, function returning (method, path, body, token)). A token of None means any member's. The functions
+        # pick their parameters from rng, so a given --seed sends the same requests every run
+        lock = threading.Lock()
+        def pick(choices):
+            with lock:
+                return rng.choice(choices)
+        def number(low, high):
+            with lock:
+                return rng.randint(low, high)
+
+        scenarios = [
+            ('books-list', lambda: ('GET', f'/library/books/?page={number(1, 50)}', None, None)),
+            ('books-filter', lambda: ('GET', f'/library/books/?genre={pick(GENRES)}', None, None)),
+            ('books-search', lambda: ('GET', f'/library/books/?search={pick(WORDS)}', None, None)),
+            ('books-search-fts', lambda: ('GET', f'/library/books/?search={pick(WORDS)}&search_mode=fts', None, None)),
+            ('books-cursor', lambda: ('GET', '/library/books/?pagination=cursor&ordering=-published_date', None, None)),
+            ('books-detail', lambda: ('GET', f'/library/books/{pick(book_ids)}/', None, None)),
+            ('reviews-list', lambda: ('GET', f'/library/reviews/?book={pick(book_ids)}', None, None)),
+            ('profile', lambda: ('GET', '/library/profile/', None, None)),
+            ('profile-transactions', lambda: ('GET', '/library/profile/transactions/', None, None)),
+            ('notifications', lambda: ('GET', '/library/notifications/', None, None)),
+        ]
+        if options['writes']:
+            loans = [] # Loans opened by the checkout scenario, handed back by the return scenario
+            def checkout():
+                return 'POST', '/library/transactions/', {'book_id': pick(book_ids)}, None
+            def give_back():
+                with lock:
+                    loan, token = loans.pop() if loans else (None, None)
+                return 'PATCH', '/library/transactions/', {'transaction_id': loan}, token # Only the borrower can return it
+            self.loans = loans
+            scenarios += [('checkout', checkout), ('return', give_back)]
+        return scenarios
+
+    def run_scenarios(self, scenarios, options):
+        # Request n goes to scenario n % len(scenarios), so a mixed run keeps the same blend from start to finish
+        timings = {name: [] for name, _ in scenarios}
+        statuses = {name: {} for name, _ in scenarios}
+        lock = threading.Lock()
+
+        def one(index, timed=True):
+            name, make_request = scenarios[index % len(scenarios)]
+            method, path, body, token = make_request()
+            token = token or self.tokens[index % len(self.tokens)]
+            started = time.perf_counter()
+            status, data = self.send(method, path, body, token)
+            elapsed = time.perf_counter() - started
+            if name == 'checkout' and status == 201:
+                with lock:
+                    self.loans.append((data['id'], token))
+            if timed:
+                with lock:
+                    timings[name].append(elapsed)
+                    statuses[name][status] = statuses[name].get(status, 0) + 1
+
+        with ThreadPoolExecutor(options['concurrency'], thread_name_prefix='bench') as pool:
+            list(pool.map(lambda index: one(index, timed=False), range(options['warmup'] * len(scenarios))))
+            started = time.perf_counter()
+            list(pool.map(one, range(options['requests'] * len(scenarios))))
+            wall = time.perf_counter() - started
+        return {name: self.summarize(name, timings[name], statuses[name], wall) for name, _ in scenarios}
+
+    def summarize(self, name, timings, statuses, wall):
+        timings.sort()
+        result = {
+            'requests': len(timings),
+            'errors': sum(count for status, count in statuses.items() if status >= 400),
+            'statuses': {str(status): count for status, count in sorted(statuses.items())},
+            'throughput_rps': round(len(timings) / wall, 1),
+            'mean_ms': round(statistics.mean(timings) * 1000, 2),
+            'p50_ms': round(percentile(timings, 50) * 1000, 2),
+            'p95_ms': round(percentile(timings, 95) * 1000, 2),
+            'p99_ms': round(percentile(timings, 99) * 1000, 2),
+            'max_ms': round(timings[-1] * 1000, 2),
+        }
+        self.stdout.write(f"{name:<22} {result['throughput_rps']:>8} req/s  p50 {result['p50_ms']:>8}ms  "
+                          f"p95 {result['p95_ms']:>8}ms  p99 {result['p99_ms']:>8}ms  errors {result['errors']}")
+        return result
+
+    def send(self, method, path, body, token):
+        headers = {'HTTP_AUTHORIZATION': f'Bearer {token}'}
+        if self.base_url:
+            request = URLRequest(self.base_url + path, method=method, data=json.dumps(body).encode() if body else None,
+                                 headers={'Authorization': f'Bearer {token}', 'Content-Type': 'application/json'})
+            try:
+                with urlopen(request, timeout=60) as response:
+                    return response.status, json.loads(response.read() or b'null')
+            except HTTPError as error:
+                return error.code, None
+            except URLError as error:
+                raise CommandError(f"Could not reach {self.base_url}: {error.reason}")
+        client = getattr(self.local, 'client', None)
+        if client is None:
+            host = next((host for host in settings.ALLOWED_HOSTS if host not in ('*', '') and not host.startswith('.')), 'testserver')
+            client = self.local.client = Client(HTTP_HOST=host, raise_request_exception=False) # Errors count as 500s instead of stopping the run
+        response = getattr(client, method.lower())(path, body, content_type='application/json', **headers) if body else \
+            getattr(client, method.lower())(path, **headers)
+        data = response.json() if response.get('Content-Type', '').startswith('application/json') else None
+        return response.status_code, data
+
+    def compare(self, before, after):
+        self.stdout.write(f"\nCompared with {before['started_at']} ({before['target']}):")
+        for name, result in after['endpoints'].items():
+            previous = before['endpoints'].get(name)
+            if not previous:
+                continue
+            changes = '  '.join(f"{key} {change(previous[key], result[key])}" for key in ('throughput_rps', 'p50_ms', 'p95_ms', 'p99_ms'))
+            self.stdout.write(f"  {name:<22} {changes}")
+
+
+def percentile(sorted_values, percent):
+    # Nearest-rank, so p99 of 200 requests is the 198th slowest rather than an interpolated value
+    rank = max(1, -(-len(sorted_values) * percent // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def change(before, after):
+    if not before:
+        return f'{after} (was {before})'
+    return f'{(after - before) / before * 100:+.1f}%'
@@ -0,0 +1,83 @@
+import time
+from datetime import timedelta
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from library.models import JobWatermark, Notification, Transaction
+
+
+WATERMARK = 'scan_overdue_loans'
+
+
+class Command(BaseCommand):
+    help = ("Sends reminders for open loans that became due soon or overdue since the last run. Meant for cron, "
+            "e.g. every 15 minutes. Only loans whose due date crossed a threshold since the previous run are read.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--due-soon-days', type=float, default=2, help="How long before the due date the first reminder goes out")
+        parser.add_argument('--chunk-size', type=int, default=1000)
+        parser.add_argument('--since', help="Scan from this ISO datetime instead of the stored watermark")
+        parser.add_argument('--dry-run', action='store_true', help="Count what would be sent without writing anything")
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        now = timezone.now()
+        due_soon = timedelta(days=options['due_soon_days'])
+        if options['since']:
+            since = parse_datetime(options['since'])
+            if since is None:
+                raise CommandError("--since must be an ISO datetime, e.g. 2025-01-31T00:00:00Z")
+            if timezone.is_naive(since):
+                since = timezone.make_aware(since)
+        else:
+            since = JobWatermark.get(WATERMARK)
+
+        # Overdue: the due date passed since the last run. Due soon: the due date entered the reminder window since the last run.
+        # The first run has no watermark and goes through every open loan that is already past either threshold.
+        # Loans already due belong to the overdue scan, so a dry run (which claims nothing) doesn't count them twice.
+        overdue_window = (since, now)
+        due_soon_window = (max(since + due_soon, now) if since else now, now + due_soon)
+        overdue = self.scan(overdue_window, Transaction.REMINDER_OVERDUE, options,
+                            lambda title, due: f'"{title}" was due back on {due:%d %B %Y} and is now overdue. Please return it as soon as you can.')
+        reminded = self.scan(due_soon_window, Transaction.REMINDER_DUE_SOON, options,
+                             lambda title, due: f'Reminder: "{title}" is due back on {due:%d %B %Y}.')
+
+        if not options['dry_run']:
+            JobWatermark.set(WATERMARK, now)
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"{overdue} overdue and {reminded} due-soon reminders {'would be ' if options['dry_run'] else ''}sent in {elapsed:.2f}s"))
+
+    def scan(self, window, stage, options, message):
+        start, end = window
+        loans = Transaction.objects.filter(return_date__isnull=True, expected_return_date__lte=end, reminder_stage__lt=stage)
+        if start is not None:
+            loans = loans.filter(expected_return_date__gt=start)
+        # Walks the (return_date, expected_return_date) index in keyset chunks, memory stays flat however many loans match
+        loans = loans.order_by('expected_return_date', 'id').values_list('id', 'user_id', 'book__title', 'expected_return_date')
+        sent = 0
+        position = None
+        while True:
+            chunk_query = loans
+            if position is not None:
+                due, loan_id = position
+                chunk_query = loans.filter(Q(expected_return_date__gt=due) | Q(expected_return_date=due, id__gt=loan_id))
+            chunk = list(chunk_query[:options['chunk_size']])
+            if not chunk:
+                return sent
+            position = (chunk[-1][3], chunk[-1][0])
+            if options['dry_run']:
+                sent += len(chunk)
+                continue
+            with transaction.atomic():
+                # Raising the stage first means a loan is only ever reminded once per stage, even if runs overlap or --since rewinds
+                ids = [loan_id for loan_id, *_ in chunk]
+                claimed = set(Transaction.objects.filter(id__in=ids, reminder_stage__lt=stage).values_list('id', flat=True))
+                Transaction.objects.filter(id__in=claimed).update(reminder_stage=stage)
+                Notification.objects.bulk_create([
+                    Notification(recipient_id=user_id, message=message(title, timezone.localtime(due)))
+                    for loan_id, user_id, title, due in chunk if loan_id in claimed
+                ])
+            sent += len(claimed)
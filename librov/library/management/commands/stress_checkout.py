@@ -0,0 +1,112 @@
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import date
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connection
+from django.db.models import Count
+from rest_framework.test import APIRequestFactory, force_authenticate
+from library.models import Book, CustomUser, Transaction
+from library.views import TransactionViewset
+
+
+class Command(BaseCommand):
+    help = ("Hammers checkout and return from many threads at once against a throwaway book and members, "
+            "checks that no copies were oversold or lost and reports checkout throughput")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=16, help="Members checking out at the same time")
+        parser.add_argument('--copies', type=int, default=5, help="Copies of the contested book")
+        parser.add_argument('--rounds', type=int, default=20)
+        parser.add_argument('--keep', action='store_true', help="Keep the generated book and members afterwards")
+
+    def handle(self, *args, **options):
+        threads, copies, rounds = options['threads'], options['copies'], options['rounds']
+        prefix = f'stress-{uuid.uuid4().hex[:8]}'
+        book = Book.objects.create(title=f'{prefix} book', author='Stress Test', isbn=prefix[-13:],
+                                   genre='Test', published_date=date.today(), available_copies=copies)
+        users = [CustomUser.objects.create_user(f'{prefix}-{n}', f'{prefix}-{n}@example.com') for n in range(threads)]
+
+        # Without rate limits, the members here check out far more often than the 'transactions' rate allows
+        checkout_view = TransactionViewset.as_view({'post': 'create'}, throttle_classes=[])
+        return_view = TransactionViewset.as_view({'patch': 'return_book'}, throttle_classes=[])
+        factory = APIRequestFactory()
+        barrier = threading.Barrier(threads)
+        results = Counter()
+        violations = []
+        checkout_seconds = []
+        lock = threading.Lock()
+
+        def call(view, method, user, data):
+            request = getattr(factory, method)('/library/transactions/', data, format='json')
+            force_authenticate(request, user=user)
+            for _ in range(5): # SQLite may report "database is locked" while another writer holds the lock
+                try:
+                    return view(request)
+                except OperationalError:
+                    with lock:
+                        results['locked_retries'] += 1
+                    time.sleep(0.01)
+            return None
+
+        def member(user):
+            try:
+                for _ in range(rounds):
+                    barrier.wait()
+                    started = time.perf_counter()
+                    # Every member fires two checkouts of the same book: at most one may succeed
+                    responses = [call(checkout_view, 'post', user, {'book_id': book.id}) for _ in range(2)]
+                    elapsed = time.perf_counter() - started
+                    loans = [r.data['id'] for r in responses if r is not None and r.status_code == 201]
+                    with lock:
+                        checkout_seconds.append(elapsed)
+                        results['checkouts'] += len(loans)
+                        results['rejected'] += sum(1 for r in responses if r is not None and r.status_code == 400)
+                        results['failed'] += sum(1 for r in responses if r is None)
+                        if len(loans) > 1:
+                            violations.append(f'{user.username} got {len(loans)} loans of the same book')
+                    barrier.wait()
+                    for loan_id in loans:
+                        # Returning twice must only give the copy back once
+                        responses = [call(return_view, 'patch', user, {'transaction_id': loan_id}) for _ in range(2)]
+                        with lock:
+                            results['returns'] += sum(1 for r in responses if r is not None and r.status_code == 200)
+            finally:
+                connection.close()
+
+        started = time.perf_counter()
+        workers = [threading.Thread(target=member, args=(user,)) for user in users]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        wall = time.perf_counter() - started
+
+        book.refresh_from_db()
+        open_loans = Transaction.objects.filter(book=book, return_date=None).count()
+        duplicates = (Transaction.objects.filter(book=book, return_date=None)
+                      .values('user').annotate(loans=Count('id')).filter(loans__gt=1).count())
+        if book.available_copies + open_loans != copies:
+            violations.append(f'{book.available_copies} available + {open_loans} on loan != {copies} copies')
+        if results['checkouts'] != results['returns']:
+            violations.append(f"{results['checkouts']} checkouts but {results['returns']} returns")
+        if duplicates:
+            violations.append(f'{duplicates} members hold the book twice')
+        if results['checkouts'] > copies * rounds:
+            violations.append(f"{results['checkouts']} checkouts of {copies} copies over {rounds} rounds")
+
+        attempts = results['checkouts'] + results['rejected'] + results['failed']
+        self.stdout.write(f"{threads} threads, {copies} copies, {rounds} rounds in {wall:.2f}s")
+        self.stdout.write(f"checkout attempts: {attempts} ({results['checkouts']} succeeded, {results['rejected']} rejected, "
+                          f"{results['failed']} failed, {results['locked_retries']} lock retries)")
+        # Each member's checkout phase overlaps with everybody else's, so the average phase length is the wall time they took
+        self.stdout.write(f"checkout throughput: {attempts / (sum(checkout_seconds) / threads):.1f} attempts/s, "
+                          f"{results['checkouts'] / wall:.1f} successful checkouts/s over the whole run")
+
+        if not options['keep']:
+            book.delete()
+            CustomUser.objects.filter(username__startswith=prefix).delete()
+        if violations:
+            raise CommandError('Invariants violated:\n' + '\n'.join(violations))
+        self.stdout.write(self.style.SUCCESS("All invariants held"))
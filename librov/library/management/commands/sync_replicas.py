@@ -0,0 +1,29 @@
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+from library.routers import record_sync, replica_aliases
+
+
+class Command(BaseCommand):
+    help = ("Copies the default SQLite database into every read replica in LIBROV_READ_REPLICAS with SQLite's online "
+            "backup, while both stay in use. Run it from cron; how often sets how far the replicas can lag behind, "
+            "keep REPLICA_PIN_SECONDS longer than that.")
+
+    def handle(self, *args, **options):
+        replicas = replica_aliases()
+        if not replicas:
+            raise CommandError("No read replicas configured, set LIBROV_READ_REPLICAS")
+        source = connections[DEFAULT_DB_ALIAS]
+        if source.vendor != 'sqlite':
+            raise CommandError("sync_replicas only copies SQLite databases, use the database's own replication otherwise")
+        source.ensure_connection()
+        for alias in replicas:
+            started = time.perf_counter()
+            target = connections[alias]
+            target.ensure_connection()
+            synced_at = time.time()
+            # Copies in steps of 1000 pages, so writers on default are only held up for a moment at a time
+            source.connection.backup(target.connection, pages=1000)
+            target.close()
+            record_sync(alias, synced_at) # Clients that wrote before the copy started can read from it again
+            self.stdout.write(self.style.SUCCESS(f"{alias} ({target.settings_dict['NAME']}) synced in {time.perf_counter() - started:.2f}s"))
@@ -0,0 +1,10 @@
+# The vocabulary the synthetic datasets are made of: benchmark_search, generate_dataset and run_benchmark draw
+# titles, names and genres from it, and the benchmarks search for the same words.
+
+WORDS = [
+    'river', 'shadow', 'garden', 'empire', 'winter', 'silver', 'night', 'ocean', 'secret', 'forest', 'castle',
+    'dragon', 'storm', 'glass', 'island', 'mountain', 'letter', 'history', 'journey', 'memory', 'light', 'stone',
+    'fire', 'queen', 'voyage', 'market', 'station', 'harbor', 'engine', 'theory', 'kingdom', 'orchard', 'signal',
+]
+NAMES = ['Adeyemi', 'Okafor', 'Mensah', 'Smith', 'Garcia', 'Tanaka', 'Nguyen', 'Kowalski', 'Haddad', 'Ibrahim']
+GENRES = ['Fantasy', 'History', 'Science', 'Romance', 'Thriller', 'Poetry', 'Biography', 'Travel']
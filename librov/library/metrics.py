@@ -0,0 +1,179 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import ExitStack
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.db import connections
+from . import authentication
+
+
+# Per-endpoint request metrics, kept in process memory and rendered in the Prometheus text format at /metrics.
+# Each worker process counts its own requests; Prometheus adds them up when every worker is scraped (or when
+# there is just the one). Recording a request is a handful of dict updates under a lock, cheap enough to leave on.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10) # Seconds
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100) # Queries per request, a jump here is usually an N+1
+
+_lock = threading.Lock()
+_requests = {} # (endpoint, method, status) -> count
+_endpoints = {} # (endpoint, method) -> EndpointStats
+
+
+class EndpointStats:
+    __slots__ = ('latency_buckets', 'latency_sum', 'query_buckets', 'queries', 'query_time', 'count')
+
+    def __init__(self):
+        self.latency_buckets = [0] * (len(LATENCY_BUCKETS) + 1) # The last one is +Inf
+        self.query_buckets = [0] * (len(QUERY_BUCKETS) + 1)
+        self.latency_sum = self.query_time = 0.0
+        self.queries = self.count = 0
+
+
+def record(endpoint, method, status, duration, queries, query_time):
+    with _lock:
+        key = (endpoint, method, status)
+        _requests[key] = _requests.get(key, 0) + 1
+        stats = _endpoints.get((endpoint, method))
+        if stats is None:
+            stats = _endpoints[(endpoint, method)] = EndpointStats()
+        stats.count += 1
+        stats.latency_sum += duration
+        stats.latency_buckets[bisect_left(LATENCY_BUCKETS, duration)] += 1
+        stats.queries += queries
+        stats.query_time += query_time
+        stats.query_buckets[bisect_left(QUERY_BUCKETS, queries)] += 1
+
+
+def reset():
+    with _lock:
+        _requests.clear()
+        _endpoints.clear()
+
+
+class QueryRecorder:
+    # A database execute_wrapper counting the queries a request runs and the time they take, without DEBUG's query log
+    def __init__(self):
+        self.count = 0
+        self.time = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.time += time.perf_counter() - started
+            self.count += 1
+
+
+class MetricsMiddleware:
+    # Goes first in MIDDLEWARE so the latency covers the whole stack. Requests are labelled with the name of the
+    # URL pattern they resolved to (books-list, transactions, profile, ...), 'unmatched' when nothing matched.
+    # A streaming response is timed up to its first byte, its queries after that are not counted.
+    # Works both ways, so under ASGI it doesn't force the async views back onto a thread.
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        recorder = QueryRecorder()
+        started = time.perf_counter()
+        with self.recording(recorder):
+            response = self.get_response(request)
+        self.finish(request, response, started, recorder)
+        return response
+
+    async def __acall__(self, request):
+        # Connections belong to a thread, and the ORM runs on the thread sync_to_async gives the request's sync work
+        # (sync views and async queries alike), not on the event loop's. So the wrappers go on that thread's connections
+        recorder = QueryRecorder()
+        started = time.perf_counter()
+        recording = await sync_to_async(self.recording)(recorder)
+        try:
+            response = await self.get_response(request)
+        finally:
+            await sync_to_async(recording.close)()
+        self.finish(request, response, started, recorder)
+        return response
+
+    @staticmethod
+    def recording(recorder):
+        stack = ExitStack()
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(recorder))
+        return stack
+
+    @staticmethod
+    def finish(request, response, started, recorder):
+        duration = time.perf_counter() - started
+        match = getattr(request, 'resolver_match', None)
+        endpoint = match.view_name if match and match.view_name else 'unmatched'
+        record(endpoint, request.method, response.status_code, duration, recorder.count, recorder.time)
+
+
+def _labels(**labels):
+    return ','.join(f'{name}="{_escape(value)}"' for name, value in labels.items())
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _histogram(lines, name, labels, bounds, buckets, total, count):
+    cumulative = 0
+    for bound, observed in zip((*bounds, '+Inf'), buckets):
+        cumulative += observed
+        lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+    lines.append(f'{name}_sum{{{labels}}} {total}')
+    lines.append(f'{name}_count{{{labels}}} {count}')
+
+
+def render():
+    with _lock:
+        requests = sorted(_requests.items())
+        endpoints = sorted((key, (list(s.latency_buckets), s.latency_sum, list(s.query_buckets), s.queries, s.query_time, s.count))
+                           for key, s in _endpoints.items())
+    lines = [
+        '# HELP librov_http_requests_total Requests handled, by URL name, method and status code.',
+        '# TYPE librov_http_requests_total counter',
+    ]
+    for (endpoint, method, status), count in requests:
+        lines.append(f'librov_http_requests_total{{{_labels(endpoint=endpoint, method=method, status=status)}}} {count}')
+
+    lines += [
+        '# HELP librov_http_request_duration_seconds Time spent handling a request, by URL name and method.',
+        '# TYPE librov_http_request_duration_seconds histogram',
+    ]
+    for (endpoint, method), (latency_buckets, latency_sum, _, _, _, count) in endpoints:
+        _histogram(lines, 'librov_http_request_duration_seconds', _labels(endpoint=endpoint, method=method),
+                   LATENCY_BUCKETS, latency_buckets, latency_sum, count)
+
+    lines += [
+        '# HELP librov_db_queries_per_request SQL queries run by a single request, by URL name and method.',
+        '# TYPE librov_db_queries_per_request histogram',
+    ]
+    for (endpoint, method), (_, _, query_buckets, queries, _, count) in endpoints:
+        _histogram(lines, 'librov_db_queries_per_request', _labels(endpoint=endpoint, method=method),
+                   QUERY_BUCKETS, query_buckets, queries, count)
+
+    lines += [
+        '# HELP librov_db_query_duration_seconds_total Time spent in SQL queries, by URL name and method.',
+        '# TYPE librov_db_query_duration_seconds_total counter',
+    ]
+    for (endpoint, method), (_, _, _, _, query_time, _) in endpoints:
+        lines.append(f'librov_db_query_duration_seconds_total{{{_labels(endpoint=endpoint, method=method)}}} {query_time}')
+
+    auth = authentication.stats()
+    for name, kind, text in [('hits', 'counter', 'Requests whose token resolved to a cached user.'),
+                             ('misses', 'counter', 'Requests that looked their token\'s user up in the database.'),
+                             ('evictions', 'counter', 'Cached users dropped to stay within AUTH_USER_CACHE_SIZE.'),
+                             ('size', 'gauge', 'Users in the cache.')]:
+        metric = f'librov_auth_user_cache_{name}' + ('_total' if kind == 'counter' else '')
+        lines += [f'# HELP {metric} {text}', f'# TYPE {metric} {kind}', f'{metric} {auth[name]}']
+    return '\n'.join(lines) + '\n'
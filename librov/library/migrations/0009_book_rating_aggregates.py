@@ -0,0 +1,64 @@
+# Generated by Django 5.1.4 on 2026-10-18 04:13
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def backfill_rating_aggregates(apps, schema_editor):
+    Book = apps.get_model('library', 'Book')
+    Review = apps.get_model('library', 'Review')
+    totals = {}
+    for row in Review.objects.values('book_id', 'rating').annotate(count=Count('id')).order_by():
+        book_totals = totals.setdefault(row['book_id'], {'rating_sum': 0, 'rating_count': 0})
+        book_totals['rating_sum'] += row['rating'] * row['count']
+        book_totals['rating_count'] += row['count']
+        if 1 <= row['rating'] <= 5:
+            book_totals[f"rating_{row['rating']}_count"] = row['count']
+    for book_id, book_totals in totals.items():
+        Book.objects.filter(pk=book_id).update(**book_totals)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0008_rename_user_notification_recipient'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='rating_1_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='rating_2_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='rating_3_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='rating_4_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='rating_5_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='rating_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='rating_sum',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(backfill_rating_aggregates, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,46 @@
+from django.db import migrations
+
+
+# The SQL as it stood when this migration was written, library.search may change after it. rebuild_search_index
+# puts the current version in place.
+CREATE_FTS_SQL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS library_book_fts USING fts5(title, author, isbn, genre, content='library_book', "
+    "content_rowid='id', tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+    "CREATE TRIGGER IF NOT EXISTS library_book_fts_insert AFTER INSERT ON library_book BEGIN "
+    "INSERT INTO library_book_fts(rowid, title, author, isbn, genre) VALUES (new.id, new.title, new.author, new.isbn, new.genre); END",
+    "CREATE TRIGGER IF NOT EXISTS library_book_fts_delete AFTER DELETE ON library_book BEGIN "
+    "INSERT INTO library_book_fts(library_book_fts, rowid, title, author, isbn, genre) "
+    "VALUES ('delete', old.id, old.title, old.author, old.isbn, old.genre); END",
+    "CREATE TRIGGER IF NOT EXISTS library_book_fts_update AFTER UPDATE OF title, author, isbn, genre ON library_book BEGIN "
+    "INSERT INTO library_book_fts(library_book_fts, rowid, title, author, isbn, genre) "
+    "VALUES ('delete', old.id, old.title, old.author, old.isbn, old.genre); "
+    "INSERT INTO library_book_fts(rowid, title, author, isbn, genre) VALUES (new.id, new.title, new.author, new.isbn, new.genre); END",
+    "INSERT INTO library_book_fts(library_book_fts) VALUES ('rebuild')",
+]
+
+DROP_FTS_SQL = [
+    "DROP TRIGGER IF EXISTS library_book_fts_insert",
+    "DROP TRIGGER IF EXISTS library_book_fts_delete",
+    "DROP TRIGGER IF EXISTS library_book_fts_update",
+    "DROP TABLE IF EXISTS library_book_fts",
+]
+
+
+def run_on_sqlite(statements):
+    # FTS5 is SQLite only, other databases search with icontains
+    def run(apps, schema_editor):
+        if schema_editor.connection.vendor == 'sqlite':
+            for statement in statements:
+                schema_editor.execute(statement)
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0009_book_rating_aggregates'),
+    ]
+
+    operations = [
+        migrations.RunPython(run_on_sqlite(CREATE_FTS_SQL), run_on_sqlite(DROP_FTS_SQL)),
+    ]
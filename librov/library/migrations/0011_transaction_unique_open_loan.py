@@ -0,0 +1,34 @@
+# Generated by Django 5.1.4 on 2026-10-18 04:19
+
+from django.db import migrations, models
+from django.db.models import Count, F
+
+
+def close_duplicate_open_loans(apps, schema_editor):
+    # Checkouts that raced each other before this constraint could leave a member with two open loans of one book.
+    # The first stays open, the others are closed as returned the moment they were made and their copies go back
+    # on the shelf, the way they would have been turned away had the constraint been there.
+    Book = apps.get_model('library', 'Book')
+    Transaction = apps.get_model('library', 'Transaction')
+    duplicated = (Transaction.objects.filter(return_date__isnull=True).values('user_id', 'book_id')
+                  .annotate(count=Count('id')).filter(count__gt=1).order_by())
+    for pair in duplicated:
+        loans = Transaction.objects.filter(user_id=pair['user_id'], book_id=pair['book_id'], return_date__isnull=True)
+        extra = list(loans.order_by('checkout_date', 'id').values_list('id', flat=True)[1:])
+        Transaction.objects.filter(id__in=extra).update(return_date=F('checkout_date'))
+        Book.objects.filter(id=pair['book_id']).update(available_copies=F('available_copies') + len(extra))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0010_book_search_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(close_duplicate_open_loans, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='transaction',
+            constraint=models.UniqueConstraint(condition=models.Q(('return_date__isnull', True)), fields=('user', 'book'), name='unique_open_loan'),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.1.4 on 2026-10-18 04:54
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0017_book_similarity'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BookTrend',
+            fields=[
+                ('book', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='trend', serialize=False, to='library.book')),
+                ('genre', models.CharField(max_length=100)),
+                ('borrow_score', models.FloatField(default=0)),
+                ('rating_score', models.FloatField(default=0)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['-borrow_score'], name='trend_borrowed_idx'), models.Index(fields=['genre', '-borrow_score'], name='trend_genre_borrowed_idx'), models.Index(fields=['-rating_score'], name='trend_rated_idx'), models.Index(fields=['genre', '-rating_score'], name='trend_genre_rated_idx')],
+            },
+        ),
+    ]
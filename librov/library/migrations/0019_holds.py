@@ -0,0 +1,30 @@
+# Generated by Django 5.1.4 on 2026-10-18 04:56
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0018_book_trend'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Hold',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.PositiveSmallIntegerField(choices=[(0, 'waiting'), (1, 'ready'), (2, 'fulfilled'), (3, 'expired'), (4, 'cancelled')], default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('ready_until', models.DateTimeField(blank=True, null=True)),
+                ('book', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='holds', to='library.book')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='holds', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['book', 'status', 'created_at', 'id'], name='hold_queue_idx'), models.Index(fields=['status', 'ready_until'], name='hold_expiry_idx')],
+                'constraints': [models.UniqueConstraint(condition=models.Q(('status__in', [0, 1])), fields=('user', 'book'), name='unique_active_hold')],
+            },
+        ),
+    ]
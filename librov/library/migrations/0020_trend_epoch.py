@@ -0,0 +1,29 @@
+from datetime import datetime, timezone
+
+from django.db import migrations
+
+
+# The epoch the trending scores were weighted against so far, stored so rebuild_trends can move it and so there
+# is a row for writers to lock while a rebase rescales the scores
+
+TREND_EPOCH = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+def store_trend_epoch(apps, schema_editor):
+    JobWatermark = apps.get_model('library', 'JobWatermark')
+    JobWatermark.objects.get_or_create(name='trend_epoch', defaults={'value': TREND_EPOCH})
+
+
+def remove_trend_epoch(apps, schema_editor):
+    apps.get_model('library', 'JobWatermark').objects.filter(name='trend_epoch').delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0019_holds'),
+    ]
+
+    operations = [
+        migrations.RunPython(store_trend_epoch, remove_trend_epoch),
+    ]
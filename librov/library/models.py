@@ -1,6 +1,11 @@
-from django.db import models
+import time
+from datetime import datetime, timezone as dt_timezone
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import F
+from django.db.models.functions import Coalesce
 from django.contrib.auth.models import AbstractUser, BaseUserManager
-from django.utils.timezone import now, timedelta
+from django.utils.timezone import localtime, now, timedelta
 from django.core.validators import MinValueValidator, MaxValueValidator # For my Review Ratings, so ratings are between 1 to 5
 
 # Defining a function to calculate expected date of return in my Transaction model
@@ -32,9 +37,20 @@ class CustomUser(AbstractUser):
     date_of_membership = models.DateField(auto_now_add=True, editable=False)
     is_active = models.BooleanField(default=True)
     bio = models.TextField(blank=True, null=True) # So members can say a little about themselves, the genre of books they like etc. When I become really good, I will include a function to recommend books to users based on the genre they like.
+    token_version = models.PositiveIntegerField(default=0, editable=False) # In every token as a claim, tokens with an older one are refused
     # No need to add other fields as AbstractUser already has them
     
     objects = CustomUserManager()
+    
+    def save(self, *args, **kwargs):
+        # set_password() leaves the raw password in _password until the save. Django's hash upgrade on login saves
+        # the rehashed password without it, so only a real password change logs out the tokens issued before it
+        if self._password is not None and self.pk is not None:
+            self.token_version += 1
+            if kwargs.get('update_fields') is not None:
+                kwargs['update_fields'] = {*kwargs['update_fields'], 'token_version'}
+        super().save(*args, **kwargs)
+
     def __str__(self):
         return self.username
     
@@ -45,30 +61,225 @@ class Book(models.Model):
     genre = models.CharField(max_length=100)
     published_date = models.DateField()
     available_copies = models.PositiveIntegerField(default=0)
+    # Running totals of the ratings on this book, kept up to date by the Review signals so that listing books
+    # does not need to aggregate the reviews table for every row. rebuild_rating_aggregates can repair them.
+    rating_sum = models.PositiveIntegerField(default=0, editable=False)
+    rating_count = models.PositiveIntegerField(default=0, editable=False)
+    rating_1_count = models.PositiveIntegerField(default=0, editable=False)
+    rating_2_count = models.PositiveIntegerField(default=0, editable=False)
+    rating_3_count = models.PositiveIntegerField(default=0, editable=False)
+    rating_4_count = models.PositiveIntegerField(default=0, editable=False)
+    rating_5_count = models.PositiveIntegerField(default=0, editable=False)
+    
+    class Meta:
+        indexes = [
+            # The catalog filters (filterset_fields), isbn already has the unique index
+            models.Index(fields=['genre'], name='book_genre_idx'),
+            models.Index(fields=['author'], name='book_author_idx'),
+            models.Index(fields=['available_copies'], name='book_available_idx'),
+            # ?ordering=published_date and ?ordering=title, with id as the tie-breaker the cursor pages on
+            models.Index(fields=['published_date', 'id'], name='book_published_idx'),
+            models.Index(fields=['title', 'id'], name='book_title_idx'),
+        ]
     
     def __str__(self):
         return self.title #So the string representation of the model is title
     
+    @staticmethod
+    def normalize_isbn(value):
+        # How ISBNs are stored: '978-0 261' and '9780261' are the same book, a trailing check digit x is X
+        return value.replace('-', '').replace(' ', '').upper()
+    
+    @property
+    def average_rating(self):
+        if not self.rating_count:
+            return None
+        return round(self.rating_sum / self.rating_count, 2)
+    
+    @property
+    def rating_histogram(self):
+        return {rating: getattr(self, f'rating_{rating}_count') for rating in range(1, 6)}
+    
+    @staticmethod
+    def rating_aggregate_changes(rating, sign):
+        # The F() updates needed to add (sign=1) or remove (sign=-1) a single rating from a book's aggregates
+        changes = {
+            'rating_sum': F('rating_sum') + sign * rating,
+            'rating_count': F('rating_count') + sign,
+        }
+        if 1 <= rating <= 5:
+            changes[f'rating_{rating}_count'] = F(f'rating_{rating}_count') + sign
+        return changes
+    
 class Transaction(models.Model):
     user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='transactions')
     book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='transactions')
     checkout_date = models.DateTimeField(auto_now_add=True)
     expected_return_date = models.DateTimeField(default=calc_expected_return_date) #Every book borrowed should have an expected return date which is auto generated to be two weeks from the date of checkout
     return_date = models.DateTimeField(null=True, blank=True)
+    reminder_stage = models.PositiveSmallIntegerField(default=0, editable=False) # The last reminder scan_overdue_loans sent for this loan
+    
+    REMINDER_NONE = 0
+    REMINDER_DUE_SOON = 1
+    REMINDER_OVERDUE = 2
+    
+    class Meta:
+        indexes = [
+            # Open loans ordered by due date, what the overdue scan walks through
+            models.Index(fields=['return_date', 'expected_return_date'], name='transaction_due_idx'),
+            # A member's loans newest first, for the profile and profile/transactions/
+            models.Index(fields=['user', '-checkout_date', '-id'], name='transaction_user_recent_idx'),
+        ]
+        constraints = [
+            # A member can only have one open loan of the same book, enforced by the database so that two
+            # checkouts racing each other can't both get through
+            models.UniqueConstraint(fields=['user', 'book'], condition=models.Q(return_date__isnull=True), name='unique_open_loan'),
+        ]
     
     def __str__(self):
         return f'{self.user.username} - {self.book.title}'
     
 
+# The waiting list for a book with no copies left. Members queue in the order they asked, and a returned copy goes
+# to the head of the queue instead of the shelf: the hold becomes ready, the member is notified and has
+# HOLD_PICKUP_DAYS to check the book out before expire_holds passes the copy on.
+class Hold(models.Model):
+    WAITING = 0
+    READY = 1 # A copy is set aside for this member, it is not in available_copies
+    FULFILLED = 2
+    EXPIRED = 3
+    CANCELLED = 4
+    STATUS_CHOICES = [(WAITING, 'waiting'), (READY, 'ready'), (FULFILLED, 'fulfilled'), (EXPIRED, 'expired'), (CANCELLED, 'cancelled')]
+    ACTIVE = [WAITING, READY]
+    
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='holds')
+    book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='holds')
+    status = models.PositiveSmallIntegerField(choices=STATUS_CHOICES, default=WAITING)
+    created_at = models.DateTimeField(auto_now_add=True)
+    ready_until = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        indexes = [
+            # The queue of a book in order, the head of it is the first entry of this index for (book, WAITING)
+            models.Index(fields=['book', 'status', 'created_at', 'id'], name='hold_queue_idx'),
+            # Ready holds by deadline, what expire_holds walks through
+            models.Index(fields=['status', 'ready_until'], name='hold_expiry_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'book'], condition=models.Q(status__in=[0, 1]), name='unique_active_hold'),
+        ]
+    
+    def __str__(self):
+        return f'{self.user_id} waiting for {self.book_id} ({self.get_status_display()})'
+    
+    @classmethod
+    def queue_position(cls):
+        # An annotation, 1 for the head of the queue and None for holds that aren't waiting. Counts the holds ahead
+        # along the queue index, in the same query as the holds themselves
+        ahead = (cls.objects.filter(book_id=models.OuterRef('book_id'), status=cls.WAITING)
+                 .filter(models.Q(created_at__lt=models.OuterRef('created_at')) | models.Q(created_at=models.OuterRef('created_at'), id__lt=models.OuterRef('id')))
+                 .order_by().values('book_id').annotate(count=models.Count('id')).values('count'))
+        return models.Case(models.When(status=cls.WAITING, then=Coalesce(models.Subquery(ahead), 0) + 1), output_field=models.IntegerField())
+    
+    @classmethod
+    def hand_off(cls, book_ids):
+        # Called inside the transaction that freed one copy of each of these books. Sets the copy aside for the
+        # head of each queue and notifies them, returns the ids of the books whose copy went to a hold: those
+        # copies must not go back into available_copies.
+        ready_until = now() + timedelta(days=settings.HOLD_PICKUP_DAYS)
+        ready = []
+        for book_id in book_ids:
+            while True:
+                head = cls.objects.filter(book_id=book_id, status=cls.WAITING).order_by('created_at', 'id').select_related('book').first()
+                if head is None:
+                    break
+                if Transaction.objects.filter(user_id=head.user_id, book_id=book_id, return_date=None).exists():
+                    # Already has a copy, checked out while the hold was being placed. Out of the queue, not handed a second one
+                    cls.objects.filter(id=head.id, status=cls.WAITING).update(status=cls.FULFILLED)
+                    continue
+                # Conditional, in case the member cancelled since the read
+                if cls.objects.filter(id=head.id, status=cls.WAITING).update(status=cls.READY, ready_until=ready_until):
+                    ready.append(head)
+                    break
+        Notification.objects.bulk_create([
+            Notification(recipient_id=hold.user_id, message=f'"{hold.book.title}" is waiting for you. Check it out by '
+                                                            f'{localtime(ready_until):%d %B %Y} or it goes to the next member in line.')
+            for hold in ready
+        ])
+        return {hold.book_id for hold in ready}
+    
+
+class NotificationManager(models.Manager):
+    def feed_for(self, user, condition=None, receipt=None):
+        # A member's notifications: their personal ones plus every broadcast sent since they joined, merged in SQL with
+        # UNION ALL so the result can still be ordered, counted and sliced. condition (a Q on id/created_at) is applied
+        # to both halves, because a union can not be filtered afterwards. receipt is the member's last read broadcast
+        # id when the caller already has it (the async views read it up front), otherwise it is looked up here.
+        if receipt is None:
+            receipt = BroadcastReceipt.objects.filter(user=user).values_list('last_read', flat=True).first() or 0
+        personal = self.filter(recipient=user)
+        broadcasts = BroadcastNotification.objects.filter(created_at__gte=user.date_joined)
+        if condition is not None:
+            personal = personal.filter(condition)
+            broadcasts = broadcasts.filter(condition)
+        personal = personal.annotate(kind=models.Value('personal')).values('id', 'message', 'created_at', 'is_read', 'kind')
+        broadcasts = broadcasts.annotate(
+            is_read=models.Case(models.When(id__lte=receipt, then=True), default=False, output_field=models.BooleanField()),
+            kind=models.Value('broadcast'),
+        ).values('id', 'message', 'created_at', 'is_read', 'kind') # Annotations come after model fields, so both halves list is_read after created_at
+        return personal.union(broadcasts, all=True).order_by('-created_at', '-id')
+
+
 class Notification(models.Model):
     recipient = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='notifications')
     message = models.TextField()
     is_read = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
     
+    objects = NotificationManager()
+    
+    class Meta:
+        indexes = [
+            # The personal half of the feed, one member's notifications newest first
+            models.Index(fields=['recipient', '-created_at', '-id'], name='notification_recent_idx'),
+        ]
+    
     def __str__(self):
         return f'Notification for {self.recipient.username}: {self.message[:50]}'
     
+
+# A message for every member is stored once here instead of once per member in Notification.
+# Members see the broadcasts sent since they joined when they read their notifications.
+class BroadcastNotification(models.Model):
+    message = models.TextField()
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    
+    def __str__(self):
+        return f'Broadcast: {self.message[:50]}'
+    
+    
+class BroadcastReceipt(models.Model):
+    user = models.OneToOneField(CustomUser, on_delete=models.CASCADE, related_name='broadcast_receipt')
+    last_read = models.BigIntegerField(default=0) # The newest broadcast id the member has seen, everything up to it counts as read
+    
+    def __str__(self):
+        return f'{self.user.username} has read broadcasts up to {self.last_read}'
+    
+    @classmethod
+    def advance(cls, user, broadcast_id):
+        # Only ever moves forward, so an older page loaded late can't mark newer broadcasts unread again
+        if not cls.objects.filter(user=user, last_read__lt=broadcast_id).update(last_read=broadcast_id):
+            cls.objects.get_or_create(user=user, defaults={'last_read': broadcast_id})
+    
+    @classmethod
+    async def aadvance(cls, user, broadcast_id):
+        if not await cls.objects.filter(user=user, last_read__lt=broadcast_id).aupdate(last_read=broadcast_id):
+            await cls.objects.aget_or_create(user=user, defaults={'last_read': broadcast_id})
+    
+    @classmethod
+    async def last_read_for(cls, user):
+        return await cls.objects.filter(user=user).values_list('last_read', flat=True).afirst() or 0
+    
 class Review(models.Model):
     book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='reviews')
     user = models.ForeignKey(CustomUser, on_delete=models.CASCADE)
@@ -77,11 +288,31 @@ class Review(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     class Meta:
-        unique_together = ['book', 'user']
+        unique_together = ['book', 'user'] # Its index also serves ?book= lookups
+        indexes = [
+            # Covers the per-book rating aggregates (rebuild_rating_aggregates) without reading the review rows
+            models.Index(fields=['book', 'rating'], name='review_book_rating_idx'),
+            # The review listing pages newest first by default
+            models.Index(fields=['-created_at', '-id'], name='review_recent_idx'),
+        ]
     
     def __str__(self):
         return f'Review by {self.user.username} for {self.book.title}'
     
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance.remember_rating() # So the signals know which rating to take off the book when this review changes
+        return instance
+    
+    def remember_rating(self):
+        self._saved_rating = (self.__dict__.get('book_id'), self.__dict__.get('rating'))
+    
+    def save(self, *args, **kwargs):
+        # The review and the book's rating aggregates are written together or not at all
+        with transaction.atomic(using=kwargs.get('using')):
+            super().save(*args, **kwargs)
+    
     
 class BookRequest(models.Model):
     user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='book_requests')
@@ -91,4 +322,139 @@ class BookRequest(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     
     def __str__(self):
-        return f'{self.title} by {self.author} requested by {self.user.username}'
\ No newline at end of file
+        return f'{self.title} by {self.author} requested by {self.user.username}'    
+    
+# Where a scheduled job got to last time, so the next run only picks up what is new since then
+class JobWatermark(models.Model):
+    name = models.CharField(max_length=64, primary_key=True)
+    value = models.DateTimeField()
+    
+    def __str__(self):
+        return f'{self.name} at {self.value}'
+    
+    @classmethod
+    def get(cls, name):
+        return cls.objects.filter(name=name).values_list('value', flat=True).first()
+    
+    @classmethod
+    def set(cls, name, value):
+        cls.objects.update_or_create(name=name, defaults={'value': value})
+    
+    
+# Version stamps for conditional GETs. Every write to a book or review replaces the stamp of the resource and of
+# its collection ('books', 'book:<id>', 'reviews', 'review:<id>'), so ETag/Last-Modified checks only read this table.
+class ResourceVersion(models.Model):
+    key = models.CharField(max_length=64, primary_key=True)
+    version = models.BigIntegerField()
+    updated_at = models.DateTimeField()
+    
+    def __str__(self):
+        return f'{self.key} v{self.version}'
+    
+    @classmethod
+    def bump(cls, *keys):
+        # One upsert for all the keys. Nanosecond stamps instead of counters, so the upsert needs no read first
+        stamp = now()
+        version = time.time_ns()
+        cls.objects.bulk_create(
+            [cls(key=key, version=version, updated_at=stamp) for key in dict.fromkeys(keys)],
+            update_conflicts=True, unique_fields=['key'], update_fields=['version', 'updated_at'],
+        )
+    
+    @classmethod
+    def lookup(cls, *keys):
+        return {row.key: row for row in cls.objects.filter(key__in=keys)}
+    
+    @classmethod
+    async def alookup(cls, *keys):
+        return {row.key: row async for row in cls.objects.filter(key__in=keys)}
+    
+    
+# Books borrowed or reviewed by the same members, precomputed by build_recommendations. Each book keeps its top
+# neighbours ranked from 1, so books/<id>/similar/ and the recommendations read a bounded number of rows by index.
+class BookSimilarity(models.Model):
+    book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='similarities')
+    similar = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='neighbour_of')
+    rank = models.PositiveSmallIntegerField()
+    score = models.FloatField() # Cosine similarity of the two books' sets of members, 0 to 1
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['book', 'rank'], name='unique_similarity_rank'),
+        ]
+    
+    def __str__(self):
+        return f'{self.book_id} ~ {self.similar_id} ({self.score:.3f})'
+
+    
+    
+# Trending leaderboards with exponentially decayed scores. An event at time t adds 2 ** ((t - epoch) / half-life)
+# to its book's score, so a borrow from one half-life ago counts half as much as one now. Scores are never decayed
+# in place: every score would shrink by the same factor, which doesn't change the order, so the boards only divide
+# by it when showing a score. The weights double every half-life and would leave a float about 20 years after the
+# epoch, so rebuild_trends moves the epoch forward and scales the stored scores down to match. The epoch is the
+# 'trend_epoch' JobWatermark, read in the same transaction as any score it is used for.
+class BookTrend(models.Model):
+    TREND_EPOCH = datetime(2024, 1, 1, tzinfo=dt_timezone.utc) # Until rebuild_trends first moves it
+    EPOCH_WATERMARK = 'trend_epoch'
+    
+    book = models.OneToOneField(Book, on_delete=models.CASCADE, primary_key=True, related_name='trend')
+    genre = models.CharField(max_length=100) # Copied from the book, so a genre's board is one range of an index
+    borrow_score = models.FloatField(default=0) # Checkouts, half-life TRENDING_BORROW_HALF_LIFE_DAYS
+    rating_score = models.FloatField(default=0) # Review stars above (or below) 3, half-life TRENDING_RATING_HALF_LIFE_DAYS
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['-borrow_score'], name='trend_borrowed_idx'),
+            models.Index(fields=['genre', '-borrow_score'], name='trend_genre_borrowed_idx'),
+            models.Index(fields=['-rating_score'], name='trend_rated_idx'),
+            models.Index(fields=['genre', '-rating_score'], name='trend_genre_rated_idx'),
+        ]
+    
+    def __str__(self):
+        return f'{self.book_id} borrowed {self.borrow_score:.3g} rated {self.rating_score:.3g}'
+    
+    @classmethod
+    def epoch(cls):
+        # Locked when the caller is about to add a weight, so a rebase can't rescale the scores in between
+        epochs = JobWatermark.objects.filter(name=cls.EPOCH_WATERMARK)
+        if transaction.get_connection().in_atomic_block:
+            epochs = epochs.select_for_update()
+        return epochs.values_list('value', flat=True).first() or cls.TREND_EPOCH
+    
+    @classmethod
+    def epoch_subquery(cls):
+        # For reading the epoch in the same statement as the scores it applies to
+        return models.Subquery(JobWatermark.objects.filter(name=cls.EPOCH_WATERMARK).values('value')[:1])
+    
+    @staticmethod
+    def weight(moment, half_life_days, epoch):
+        return 2 ** ((moment - epoch).total_seconds() / (half_life_days * 86400))
+    
+    @classmethod
+    def borrow_weight(cls, moment, epoch):
+        return cls.weight(moment, settings.TRENDING_BORROW_HALF_LIFE_DAYS, epoch)
+    
+    @classmethod
+    def rating_weight(cls, moment, epoch):
+        return cls.weight(moment, settings.TRENDING_RATING_HALF_LIFE_DAYS, epoch)
+    
+    @classmethod
+    def rebase(cls, epoch):
+        # Moves the epoch and scales every stored score by what an event at the old epoch weighs at the new one
+        with transaction.atomic():
+            old = cls.epoch()
+            cls.objects.update(borrow_score=F('borrow_score') * cls.borrow_weight(old, epoch),
+                               rating_score=F('rating_score') * cls.rating_weight(old, epoch))
+            JobWatermark.set(cls.EPOCH_WATERMARK, epoch)
+    
+    @classmethod
+    def add(cls, book_ids, **increments):
+        # e.g. add([1, 2], borrow_score=w). Books without a row get one first, then one F() update covers them all
+        book_ids = list(dict.fromkeys(book_ids))
+        existing = set(cls.objects.filter(book_id__in=book_ids).values_list('book_id', flat=True))
+        missing = [book_id for book_id in book_ids if book_id not in existing]
+        if missing:
+            genres = dict(Book.objects.filter(id__in=missing).values_list('id', 'genre'))
+            cls.objects.bulk_create([cls(book_id=book_id, genre=genre) for book_id, genre in genres.items()], ignore_conflicts=True)
+        cls.objects.filter(book_id__in=book_ids).update(**{field: F(field) + value for field, value in increments.items()})
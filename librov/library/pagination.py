@@ -0,0 +1,208 @@
+import json
+from asgiref.sync import sync_to_async
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from django.core.serializers.json import DjangoJSONEncoder
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.core.paginator import InvalidPage
+from django.db import connections
+from django.db.models import Q
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    # Cursor pagination that always seeks on (ordering field, id), so page 1000 costs the same as page 1 and
+    # rows added while a client is paging never shift what it sees. No COUNT(*) unless the client asks for it.
+    page_size = api_settings.PAGE_SIZE
+    cursor_query_param = 'cursor'
+    count_query_param = 'count'
+    default_ordering = '-id'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.count = self.get_count(queryset, request)
+        return self.set_page(list(self.page_queryset(queryset, request, view)))
+    
+    async def apaginate_queryset(self, queryset, request, view=None):
+        # The same page read through the async ORM, for the async read views
+        self.count = await self.aget_count(queryset, request)
+        return self.set_page([row async for row in self.page_queryset(queryset, request, view)])
+    
+    def page_queryset(self, queryset, request, view):
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        self.ordering = self.get_ordering(request, view)
+        self.field = self.ordering.lstrip('-')
+        self.descending = self.ordering.startswith('-')
+
+        self.position, self.reverse = self.decode_cursor(request, queryset)
+        descending = self.descending != self.reverse # Going back to the previous page walks the keys the other way
+        if self.position is not None:
+            queryset = self.filter_after(queryset, self.position, descending, view)
+        ordering = [self.ordering_term(self.field, descending)]
+        if self.field != 'id':
+            ordering.append(self.ordering_term('id', descending)) # So rows sharing a value still have a fixed order
+        return queryset.order_by(*ordering)[:self.page_size + 1]
+    
+    def set_page(self, rows):
+        has_more = len(rows) > self.page_size
+        rows = rows[:self.page_size]
+        if self.reverse:
+            rows.reverse()
+            self.has_next, self.has_previous = self.position is not None, has_more
+        else:
+            self.has_next, self.has_previous = has_more, self.position is not None
+        self.page = rows
+        return rows
+
+    def get_ordering(self, request, view):
+        # Honours ?ordering= for the view's ordering_fields (first field only), otherwise the view's cursor_ordering
+        default = getattr(view, 'cursor_ordering', self.default_ordering)
+        allowed = set(getattr(view, 'ordering_fields', None) or []) | {'id', default.lstrip('-')}
+        requested = request.query_params.get(api_settings.ORDERING_PARAM, '').split(',')[0].strip()
+        if requested and requested.lstrip('-') in allowed:
+            return requested
+        return default
+
+    @staticmethod
+    def ordering_term(field, descending):
+        return f'-{field}' if descending else field
+
+    def filter_after(self, queryset, position, descending, view):
+        value, pk = position
+        lookup = 'lt' if descending else 'gt'
+        if self.field == 'id':
+            condition = Q(**{f'id__{lookup}': pk})
+        else:
+            condition = Q(**{f'{self.field}__{lookup}': value}) | Q(**{self.field: value, f'id__{lookup}': pk})
+        if hasattr(view, 'filter_keyset'):
+            return view.filter_keyset(queryset, condition) # Views listing a UNION have to push the condition into each half
+        return queryset.filter(condition)
+
+    def get_count(self, queryset, request):
+        mode = request.query_params.get(self.count_query_param)
+        if mode == 'exact':
+            return queryset.count()
+        if mode == 'estimate':
+            return estimate_count(queryset)
+        return None
+    
+    async def aget_count(self, queryset, request):
+        mode = request.query_params.get(self.count_query_param)
+        if mode == 'exact':
+            return await queryset.acount()
+        if mode == 'estimate':
+            return await sync_to_async(estimate_count)(queryset)
+        return None
+
+    def decode_cursor(self, request, queryset):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None, False
+        try:
+            cursor = json.loads(urlsafe_b64decode(encoded.encode('ascii')))
+            if cursor['o'] != self.ordering:
+                raise ValueError('The cursor belongs to a different ordering')
+            value = cursor['v']
+            if self.field != 'id' and value is not None:
+                value = queryset.model._meta.get_field(self.field).to_python(value)
+            return (value, int(cursor['id'])), bool(cursor.get('r'))
+        except (TypeError, ValueError, KeyError, DjangoValidationError):
+            raise ValidationError({self.cursor_query_param: self.invalid_cursor_message}) # A bad cursor is the client's mistake, not a missing page
+
+    def encode_cursor(self, row, reverse):
+        value = row[self.field] if isinstance(row, dict) else getattr(row, self.field)
+        pk = row['id'] if isinstance(row, dict) else row.pk
+        if hasattr(value, 'isoformat'):
+            value = value.isoformat() # Keeps the microseconds, which DjangoJSONEncoder would cut off
+        payload = json.dumps({'o': self.ordering, 'v': value, 'id': pk, 'r': int(reverse)}, cls=DjangoJSONEncoder)
+        return replace_query_param(self.base_url, self.cursor_query_param, urlsafe_b64encode(payload.encode()).decode())
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        return self.encode_cursor(self.page[-1], reverse=False)
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        if not self.page:
+            return remove_query_param(self.base_url, self.cursor_query_param)
+        return self.encode_cursor(self.page[0], reverse=True)
+
+    def get_paginated_response(self, data):
+        body = {'next': self.get_next_link(), 'previous': self.get_previous_link()}
+        if self.count is not None:
+            body['count'] = self.count
+        body['results'] = data
+        return Response(body)
+
+
+def estimate_count(queryset):
+    # A cheap row count for unfiltered listings, read from the planner statistics instead of scanning the table.
+    # Filtered querysets have no cheap estimate, so they report None.
+    if queryset.query.where or getattr(queryset.query, 'combinator', None):
+        return None
+    table = queryset.model._meta.db_table
+    connection = connections[queryset.db]
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute("SELECT reltuples::bigint FROM pg_class WHERE relname = %s", [table])
+            row = cursor.fetchone()
+            if row and row[0] >= 0:
+                return row[0]
+        elif connection.vendor == 'sqlite':
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_stat1'")
+            if cursor.fetchone():
+                cursor.execute("SELECT stat FROM sqlite_stat1 WHERE tbl = %s LIMIT 1", [table])
+                row = cursor.fetchone()
+                if row:
+                    return int(row[0].split()[0])
+    # No statistics yet (ANALYZE never ran), the highest id is an index lookup and close enough
+    return queryset.order_by('-id').values_list('id', flat=True).first() or 0
+
+
+class LibraryPagination(PageNumberPagination):
+    # Page numbers stay the default so existing clients keep working. Sending ?pagination=cursor (or following a
+    # next link that has a cursor in it) switches a request over to KeysetPagination.
+    mode_query_param = 'pagination'
+    keyset_class = KeysetPagination
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.keyset = None
+        if request.query_params.get(self.mode_query_param) == 'cursor' or self.keyset_class.cursor_query_param in request.query_params:
+            self.keyset = self.keyset_class()
+            self.display_page_controls = False
+            return self.keyset.paginate_queryset(queryset, request, view)
+        return super().paginate_queryset(queryset, request, view)
+
+    async def apaginate_queryset(self, queryset, request, view=None):
+        # PageNumberPagination.paginate_queryset with the count and the page rows read through the async ORM
+        self.keyset = None
+        if request.query_params.get(self.mode_query_param) == 'cursor' or self.keyset_class.cursor_query_param in request.query_params:
+            self.keyset = self.keyset_class()
+            self.display_page_controls = False
+            return await self.keyset.apaginate_queryset(queryset, request, view)
+        page_size = self.get_page_size(request)
+        if not page_size:
+            return None
+        paginator = self.django_paginator_class(queryset, page_size)
+        paginator.count = await queryset.acount() # Paginator.count is a cached_property, set here it is never counted synchronously
+        page_number = self.get_page_number(request, paginator)
+        try:
+            self.page = paginator.page(page_number)
+        except InvalidPage as exc:
+            raise NotFound(self.invalid_page_message.format(page_number=page_number, message=str(exc)))
+        self.page.object_list = [row async for row in self.page.object_list]
+        if paginator.num_pages > 1 and self.template is not None:
+            self.display_page_controls = True
+        self.request = request
+        return list(self.page)
+    
+    def get_paginated_response(self, data):
+        if self.keyset is not None:
+            return self.keyset.get_paginated_response(data)
+        return super().get_paginated_response(data)
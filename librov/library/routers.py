@@ -0,0 +1,132 @@
+import hashlib
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DEFAULT_DB_ALIAS, connections
+from rest_framework import permissions
+
+
+# Read/write split. Writes always go to default. Reads go to a replica only while ReplicaRoutingMiddleware has
+# picked one for the current request, so management commands, the shell and anything outside a request keep
+# reading from default. The choice lives in a context variable, which keeps threads and async tasks apart.
+
+_read_alias = ContextVar('librov_read_alias', default=None)
+
+
+@contextmanager
+def use_primary():
+    # Reads in this block go to default even during a replica-routed request
+    token = _read_alias.set(None)
+    try:
+        yield
+    finally:
+        _read_alias.reset(token)
+
+
+def replica_aliases():
+    return [alias for alias in settings.DATABASES if alias.startswith('replica')]
+
+
+def synced_key(alias):
+    return f'replica:synced:{alias}'
+
+
+def record_sync(alias, started):
+    # sync_replicas stores when each copy started. Everything committed on default before then is on the replica
+    cache.set(synced_key(alias), started, None)
+
+
+class ReadReplicaRouter:
+    def db_for_read(self, model, **hints):
+        alias = _read_alias.get()
+        # Reads inside a transaction on default (checkout, return, the batch paths) must see that transaction
+        if alias is None or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return alias
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True # Replicas hold the same rows as default
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
+
+
+class ReplicaRoutingMiddleware:
+    # GET, HEAD and OPTIONS read from a replica picked for the whole request. Replicas are only as fresh as the last
+    # sync_replicas run, and a member who just checked a book out has to see the loan on their profile straight
+    # away, so a client that wrote something reads only from replicas synced since its last write, or from default
+    # while there are none. The last write is remembered for REPLICA_PIN_SECONDS, which has to be longer than the
+    # time between syncs. Clients are told apart by their Authorization header (or session cookie), so this works
+    # for API clients that keep no cookies. The write times and sync times are kept in the default cache, which
+    # every worker and the sync_replicas cron job have to share.
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.replicas = replica_aliases()
+        if self.replicas and isinstance(caches['default'], LocMemCache):
+            raise ImproperlyConfigured("Read replicas need a cache every process shares, set LIBROV_CACHE_DIR")
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        alias, client = self.route(request)
+        token = _read_alias.set(alias)
+        try:
+            response = self.get_response(request)
+        finally:
+            _read_alias.reset(token)
+        self.pin(request, client)
+        return response
+
+    async def __acall__(self, request):
+        alias, client = self.route(request)
+        token = _read_alias.set(alias)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _read_alias.reset(token)
+        self.pin(request, client)
+        return response
+
+    def route(self, request):
+        # The replica this request reads from (None for default), and the key the client is pinned under
+        if not self.replicas:
+            return None, None
+        client = self.client_key(request)
+        if request.method not in permissions.SAFE_METHODS:
+            return None, client
+        if not client:
+            return random.choice(self.replicas), client
+        # One cache round trip for the client's last write and every replica's last sync
+        stamps = cache.get_many([client, *map(synced_key, self.replicas)])
+        written = stamps.get(client)
+        if written is None:
+            return random.choice(self.replicas), client
+        fresh = [alias for alias in self.replicas if stamps.get(synced_key(alias), 0) > written]
+        return (random.choice(fresh) if fresh else None), client
+
+    def pin(self, request, client):
+        # Taken once the response is ready, so the write has been committed
+        if client and request.method not in permissions.SAFE_METHODS:
+            cache.set(client, time.time(), settings.REPLICA_PIN_SECONDS)
+
+    @staticmethod
+    def client_key(request):
+        identity = request.headers.get('Authorization') or request.COOKIES.get(settings.SESSION_COOKIE_NAME)
+        if not identity:
+            return None
+        return f'replica:pinned:{hashlib.md5(identity.encode()).hexdigest()}'
@@ -0,0 +1,111 @@
+import re
+from django.db import connections
+from rest_framework.filters import SearchFilter
+from .models import Book
+
+
+# Full-text search for the catalog. On SQLite the books are mirrored into an FTS5 table (kept in sync by
+# triggers, so saves, deletes and bulk imports are all covered) and ?search_mode=fts searches that index
+# instead of running icontains over every row.
+
+FTS_TABLE = 'library_book_fts'
+FTS_COLUMNS = ['title', 'author', 'isbn', 'genre']
+
+ISBN_PATTERN = re.compile(r'^(\d{9}[\dXx]|\d{13})$')
+
+_columns = ', '.join(FTS_COLUMNS)
+_new_values = ', '.join(f'new.{column}' for column in FTS_COLUMNS)
+_old_values = ', '.join(f'old.{column}' for column in FTS_COLUMNS)
+
+CREATE_FTS_SQL = [
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5({_columns}, content='library_book', content_rowid='id', "
+    f"tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+    f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_insert AFTER INSERT ON library_book BEGIN "
+    f"INSERT INTO {FTS_TABLE}(rowid, {_columns}) VALUES (new.id, {_new_values}); END",
+    f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_delete AFTER DELETE ON library_book BEGIN "
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, {_columns}) VALUES ('delete', old.id, {_old_values}); END",
+    # Only the searchable columns re-index a book, so checkouts changing available_copies cost nothing here
+    f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_update AFTER UPDATE OF {_columns} ON library_book BEGIN "
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, {_columns}) VALUES ('delete', old.id, {_old_values}); "
+    f"INSERT INTO {FTS_TABLE}(rowid, {_columns}) VALUES (new.id, {_new_values}); END",
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')",
+]
+
+DROP_FTS_SQL = [
+    f"DROP TRIGGER IF EXISTS {FTS_TABLE}_insert",
+    f"DROP TRIGGER IF EXISTS {FTS_TABLE}_delete",
+    f"DROP TRIGGER IF EXISTS {FTS_TABLE}_update",
+    f"DROP TABLE IF EXISTS {FTS_TABLE}",
+]
+
+
+def install_search_index(connection):
+    # Creates the FTS table and its triggers if they are missing and re-indexes every book. SQLite drops
+    # triggers when Django rebuilds a table during a migration, so rebuild_search_index calls this again.
+    if connection.vendor != 'sqlite':
+        return False
+    with connection.cursor() as cursor:
+        for statement in CREATE_FTS_SQL:
+            cursor.execute(statement)
+    _fts_ready.pop(connection.alias, None)
+    return True
+
+
+def remove_search_index(connection):
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        for statement in DROP_FTS_SQL:
+            cursor.execute(statement)
+    _fts_ready.pop(connection.alias, None)
+
+
+_fts_ready = {}
+
+
+def search_index_available(alias):
+    if alias not in _fts_ready:
+        connection = connections[alias]
+        available = False
+        if connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s", [FTS_TABLE])
+                available = cursor.fetchone() is not None
+        _fts_ready[alias] = available
+    return _fts_ready[alias]
+
+
+def build_match_query(terms):
+    # Every term has to match (FTS5 ANDs terms next to each other) and is treated as a prefix, so typing
+    # "harr pot" already finds Harry Potter. Terms are quoted so user input can't use FTS5 query syntax.
+    return ' '.join('"{}"*'.format(term.replace('"', '""')) for term in terms)
+
+
+class BookSearchFilter(SearchFilter):
+    # Works exactly like DRF's SearchFilter unless the client asks for ?search_mode=fts
+    search_mode_param = 'search_mode'
+
+    def filter_queryset(self, request, queryset, view):
+        if request.query_params.get(self.search_mode_param) != 'fts' or not search_index_available(queryset.db):
+            return super().filter_queryset(request, queryset, view)
+
+        terms = [term.strip('"') for term in self.get_search_terms(request)]
+        terms = [term for term in terms if term]
+        if not terms:
+            return queryset
+
+        # A lone ISBN goes straight to the unique index on isbn
+        if len(terms) == 1:
+            isbn = Book.normalize_isbn(terms[0])
+            if ISBN_PATTERN.match(isbn):
+                matches = queryset.filter(isbn=isbn)
+                if matches.exists():
+                    return matches
+
+        return queryset.extra(
+            tables=[FTS_TABLE],
+            where=[f'{FTS_TABLE}.rowid = {Book._meta.db_table}.id', f'{FTS_TABLE} MATCH %s'],
+            params=[build_match_query(terms)],
+            select={'search_rank': f'{FTS_TABLE}.rank'},
+            order_by=['search_rank'],
+        )
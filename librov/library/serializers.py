@@ -1,12 +1,78 @@
 from rest_framework import serializers
-from .models import Book,Transaction,Notification, Review, BookRequest, Notification
+from rest_framework.permissions import SAFE_METHODS
+from .models import Book,Transaction,Notification, Review, BookRequest, Notification, Hold
 from django.contrib.auth import get_user_model
-from django.db import models
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Q
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
+from .authentication import LibraryRefreshToken
 
 CustomUser = get_user_model()
 
 
-class UserRegistrationSerializer(serializers.ModelSerializer):
+class DynamicFieldsMixin:
+    """
+    Lets clients ask for part of a resource: ?fields=id,title keeps only those fields and ?omit=average_rating drops
+    fields. Fields that are left out are never computed, and optimize_queryset trims the query to match.
+    Only the view's own serializer reads the query string, nested serializers always render in full. Writes
+    ignore both, a POST or PATCH is validated against every field.
+    """
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        request = self.context.get('request')
+        view = self.context.get('view')
+        if request is None or view is None or not hasattr(view, 'get_serializer_class') or type(self) is not view.get_serializer_class():
+            return
+        if request.method not in SAFE_METHODS:
+            return
+        fields = request.query_params.get('fields')
+        omit = request.query_params.get('omit')
+        if fields:
+            wanted = {name.strip() for name in fields.split(',')}
+            for name in set(self.fields) - wanted:
+                self.fields.pop(name)
+        if omit:
+            for name in {name.strip() for name in omit.split(',')} & set(self.fields):
+                self.fields.pop(name)
+    
+    def optimize_queryset(self, queryset):
+        # Loads only the columns the remaining fields read and joins only the relations they follow.
+        # SerializerMethodFields declare what they read in Meta.method_field_sources, if one doesn't the columns are left alone.
+        if getattr(queryset.query, 'combinator', None):
+            return queryset
+        opts = queryset.model._meta
+        method_sources = getattr(self.Meta, 'method_field_sources', {})
+        columns, joins, restrict = {opts.pk.name}, set(), True
+        for name, field in self.fields.items():
+            if field.write_only:
+                continue
+            if isinstance(field, serializers.SerializerMethodField):
+                if name in method_sources:
+                    columns.update(method_sources[name])
+                else:
+                    restrict = False
+                continue
+            if field.source == '*':
+                restrict = False
+                continue
+            path = field.source.split('.')
+            try:
+                opts.get_field(path[0])
+            except FieldDoesNotExist:
+                restrict = False # A property or method on the model, which could read anything
+                continue
+            for depth in range(1, len(path)):
+                joins.add('__'.join(path[:depth]))
+            columns.update('__'.join(path[:depth]) for depth in range(1, len(path) + 1))
+        if joins:
+            queryset = queryset.select_related(*joins)
+        if restrict:
+            queryset = queryset.only(*columns)
+        return queryset
+
+
+class UserRegistrationSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     password = serializers.CharField(write_only=True, required=True, style={'input_type': 'password'})
     
     class Meta:
@@ -22,19 +88,25 @@ class UserRegistrationSerializer(serializers.ModelSerializer):
             )
             return user
         
-class BookSerializer(serializers.ModelSerializer):
+class BookSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     average_rating = serializers.SerializerMethodField()
     class Meta:
         model = Book
-        fields = ['id', 'title', 'author', 'genre', 'isbn', 'published_date', 'available_copies', 'average_rating']
+        fields = ['id', 'title', 'author', 'genre', 'isbn', 'published_date', 'available_copies', 'average_rating', 'rating_count']
+        read_only_fields = ['rating_count']
+        method_field_sources = {'average_rating': ['rating_sum', 'rating_count']}
         
     def get_average_rating(self, obj):
-        reviews = obj.reviews.all()
-        if reviews.exists():
-            return round(reviews.aggregate(models.Avg('rating'))['rating__avg'], 2)
-        return None
+        return obj.average_rating # Read from the stored rating totals, so no extra queries per book
 
-class TransactionSerializer(serializers.ModelSerializer):
+
+class ScoredBookSerializer(BookSerializer):
+    # Books from the similarity index, with how strongly they are recommended
+    score = serializers.FloatField(read_only=True)
+    class Meta(BookSerializer.Meta):
+        fields = BookSerializer.Meta.fields + ['score']
+
+class TransactionSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     book_title = serializers.CharField(source='book.title', read_only=True)
     class Meta:
         model = Transaction
@@ -42,7 +114,30 @@ class TransactionSerializer(serializers.ModelSerializer):
         
         
         
-class ReviewSerializer(serializers.ModelSerializer):
+class HoldSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
+    book_id = serializers.PrimaryKeyRelatedField(source='book', queryset=Book.objects.all())
+    book_title = serializers.CharField(source='book.title', read_only=True)
+    status = serializers.CharField(source='get_status_display', read_only=True)
+    position = serializers.SerializerMethodField()
+    class Meta:
+        model = Hold
+        fields = ['id', 'book_id', 'book_title', 'status', 'position', 'created_at', 'ready_until']
+        read_only_fields = ['created_at', 'ready_until']
+        method_field_sources = {'position': ['book', 'status', 'created_at']}
+        
+    def get_position(self, obj):
+        # 1 for the head of the queue. Listed holds come with it annotated (Hold.queue_position), a hold on its own,
+        # e.g. one just placed, counts the holds ahead along the queue index
+        if obj.status != Hold.WAITING:
+            return None
+        if hasattr(obj, 'position'):
+            return obj.position
+        ahead = Hold.objects.filter(book_id=obj.book_id, status=Hold.WAITING).filter(
+            Q(created_at__lt=obj.created_at) | Q(created_at=obj.created_at, id__lt=obj.id))
+        return ahead.count() + 1
+        
+        
+class ReviewSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     user = serializers.ReadOnlyField(source='user.username')
     book_title = serializers.CharField(source='book.title', read_only=True)
     class Meta:
@@ -50,14 +145,14 @@ class ReviewSerializer(serializers.ModelSerializer):
         fields = ['id', 'book',  'book_title', 'user', 'review_text', 'rating', 'created_at', 'updated_at']
         read_only_fields = ['user', 'created_at', 'updated_at', "book_title"]
         
-class BookRequestSerializer(serializers.ModelSerializer):
+class BookRequestSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     username = serializers.ReadOnlyField(source='user.username')
     class Meta:
         model = BookRequest
         fields = ['id', 'user', 'username', 'title', 'author', 'description', 'created_at']
         read_only_fields = ['user', 'username', 'created_at']
         
-class NotificationSerializer(serializers.ModelSerializer):
+class NotificationSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     recipient = serializers.ReadOnlyField(source='recipient.username')
     
     class Meta:
@@ -66,13 +161,59 @@ class NotificationSerializer(serializers.ModelSerializer):
         read_only_fields = ['recipient', 'created_at']
         
         
+class NotificationFeedSerializer(DynamicFieldsMixin, serializers.Serializer):
+    # For the merged personal + broadcast rows from Notification.objects.feed_for, which are dicts rather than models
+    recipient = serializers.SerializerMethodField()
+    message = serializers.CharField(read_only=True)
+    created_at = serializers.DateTimeField(read_only=True)
+    kind = serializers.CharField(read_only=True)
+    is_read = serializers.BooleanField(read_only=True)
+    
+    def get_recipient(self, obj):
+        return self.context['request'].user.username
+        
+        
 class GeneralNotificationSerializer(serializers.Serializer):
     message = serializers.CharField(max_length=255)
+    
+    
+MAX_BATCH_SIZE = 50 # The most books a single batch checkout or return can carry
+
+class BatchCheckoutSerializer(serializers.Serializer):
+    book_ids = serializers.ListField(child=serializers.IntegerField(min_value=1), allow_empty=False, max_length=MAX_BATCH_SIZE)
+    all_or_nothing = serializers.BooleanField(default=False) # When true, one failing book means none of them are checked out
+    
+    
+class BatchReturnSerializer(serializers.Serializer):
+    transaction_ids = serializers.ListField(child=serializers.IntegerField(min_value=1), allow_empty=False, max_length=MAX_BATCH_SIZE)
+    all_or_nothing = serializers.BooleanField(default=False)
         
 
-class UserProfileSerializer(serializers.ModelSerializer):
-    transactions = TransactionSerializer(many=True, read_only=True,)
-    notifications = NotificationSerializer(many=True, read_only=True)
+PROFILE_RECENT_ITEMS = 5 # How many transactions and notifications the profile shows, the rest are on profile/transactions/ and profile/notifications/
+
+class UserProfileSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
+    transactions = serializers.SerializerMethodField()
+    transaction_count = serializers.SerializerMethodField()
+    notifications = serializers.SerializerMethodField()
+    notification_count = serializers.SerializerMethodField()
     class Meta:
         model = CustomUser
-        fields = ['username', 'id', 'email', 'date_of_membership', 'bio', 'notifications', 'transactions']
+        fields = ['username', 'id', 'email', 'date_of_membership', 'bio', 'notifications', 'notification_count', 'transactions', 'transaction_count']
+        
+    def get_transactions(self, obj):
+        recent = Transaction.objects.filter(user=obj).select_related('book').order_by('-checkout_date', '-id')[:PROFILE_RECENT_ITEMS]
+        return TransactionSerializer(recent, many=True).data
+    
+    def get_transaction_count(self, obj):
+        return obj.transactions.count()
+    
+    def get_notifications(self, obj):
+        recent = Notification.objects.feed_for(obj)[:PROFILE_RECENT_ITEMS]
+        return NotificationFeedSerializer(recent, many=True, context=self.context).data
+    
+    def get_notification_count(self, obj):
+        return Notification.objects.feed_for(obj).count()
+
+
+class LibraryTokenObtainPairSerializer(TokenObtainPairSerializer):
+    token_class = LibraryRefreshToken # Adds the token_version claim CachedJWTAuthentication checks
@@ -0,0 +1,134 @@
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.db.models import F
+from django.dispatch import Signal, receiver
+from django.utils import timezone
+from .models import Book, BookTrend, CustomUser, Review, ResourceVersion, Transaction
+from .cache import invalidate_books
+from .authentication import evict
+
+
+# Sent by checkout and return (and anything else that changes copies with a bulk UPDATE, which Django's
+# save signals never see) with the ids of the books whose available_copies changed.
+book_copies_changed = Signal()
+
+# Sent by checkout and batch checkout with the ids of the books that were just lent out
+books_checked_out = Signal()
+
+
+# Keeping the rating aggregates on Book in step with its reviews. Every change is applied with F() expressions,
+# so two reviews saved at the same time can not overwrite each other's totals.
+
+@receiver(pre_save, sender=Review)
+def snapshot_previous_rating(sender, instance, raw=False, **kwargs):
+    if raw or instance.pk is None:
+        return
+    saved_rating = getattr(instance, '_saved_rating', None)
+    if saved_rating is None or None in saved_rating:
+        # The review was not loaded from the database (or its rating was deferred), so look up what is stored
+        stored = Review.objects.filter(pk=instance.pk).values_list('book_id', 'rating').first()
+        instance._saved_rating = stored
+
+
+@receiver(post_save, sender=Review)
+def update_rating_aggregates_on_save(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    previous = None if created else getattr(instance, '_saved_rating', None)
+    current = (instance.book_id, instance.rating)
+    if previous != current:
+        weight = BookTrend.rating_weight(instance.created_at, BookTrend.epoch()) # A review counts from when it was written, edits included
+        if previous:
+            old_book_id, old_rating = previous
+            Book.objects.filter(pk=old_book_id).update(**Book.rating_aggregate_changes(old_rating, -1))
+            BookTrend.add([old_book_id], rating_score=-(old_rating - 3) * weight)
+        Book.objects.filter(pk=instance.book_id).update(**Book.rating_aggregate_changes(instance.rating, 1))
+        BookTrend.add([instance.book_id], rating_score=(instance.rating - 3) * weight)
+    instance._previous_book_id = previous[0] if previous else None # For bump_review_version, which runs after the snapshot is replaced
+    instance.remember_rating()
+
+
+@receiver(post_delete, sender=Review)
+def update_rating_aggregates_on_delete(sender, instance, **kwargs):
+    Book.objects.filter(pk=instance.book_id).update(**Book.rating_aggregate_changes(instance.rating, -1))
+    weight = BookTrend.rating_weight(instance.created_at, BookTrend.epoch())
+    BookTrend.objects.filter(book_id=instance.book_id).update(rating_score=F('rating_score') - (instance.rating - 3) * weight)
+
+
+# Trending boards
+
+@receiver(books_checked_out)
+def add_checkouts_to_trends(sender, book_ids, **kwargs):
+    BookTrend.add(book_ids, borrow_score=BookTrend.borrow_weight(timezone.now(), BookTrend.epoch()))
+
+
+@receiver(post_save, sender=Book)
+def move_trend_to_genre(sender, instance, raw=False, **kwargs):
+    if not raw:
+        BookTrend.objects.filter(book=instance).exclude(genre=instance.genre).update(genre=instance.genre)
+
+
+# Conditional GET versions. Reviews show their book's title and books show their average rating, so a change
+# to one also moves the collection version of the other.
+
+@receiver(post_save, sender=Book)
+@receiver(post_delete, sender=Book)
+def bump_book_version(sender, instance, raw=False, **kwargs):
+    if not raw:
+        ResourceVersion.bump('books', f'book:{instance.pk}', 'reviews')
+
+
+@receiver(book_copies_changed)
+def bump_book_versions_for_copies(sender, book_ids, **kwargs):
+    ResourceVersion.bump('books', *(f'book:{book_id}' for book_id in book_ids))
+
+
+@receiver(post_save, sender=Review)
+@receiver(post_delete, sender=Review)
+def bump_review_version(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    keys = ['reviews', f'review:{instance.pk}', 'books', f'book:{instance.book_id}']
+    previous_book_id = getattr(instance, '_previous_book_id', None)
+    if previous_book_id and previous_book_id != instance.book_id:
+        keys.append(f'book:{previous_book_id}') # The review moved to another book, so the old one's rating changed too
+    ResourceVersion.bump(*keys)
+
+
+# Response cache invalidation, only the entries a change can actually affect
+
+@receiver(post_save, sender=Book)
+@receiver(post_delete, sender=Book)
+def invalidate_book_cache(sender, instance, raw=False, **kwargs):
+    if not raw:
+        invalidate_books([instance.pk])
+
+
+@receiver(book_copies_changed)
+def invalidate_book_cache_for_copies(sender, book_ids, **kwargs):
+    invalidate_books(book_ids)
+
+
+@receiver(post_save, sender=Review)
+@receiver(post_delete, sender=Review)
+def invalidate_reviewed_book_cache(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    book_ids = {instance.book_id, getattr(instance, '_previous_book_id', None)} - {None}
+    invalidate_books(book_ids)
+
+
+@receiver(post_save, sender=Transaction)
+@receiver(post_delete, sender=Transaction)
+def invalidate_loaned_book_cache(sender, instance, raw=False, **kwargs):
+    # Covers loans edited outside checkout and return, e.g. in the admin
+    if not raw:
+        invalidate_books([instance.book_id])
+
+
+# Cached JWT users. A save can deactivate the member or change their password, so the cached copy goes
+# whatever changed
+
+@receiver(post_save, sender=CustomUser)
+@receiver(post_delete, sender=CustomUser)
+def evict_cached_user(sender, instance, **kwargs):
+    evict(instance.pk)
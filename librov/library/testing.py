@@ -0,0 +1,19 @@
+import tempfile
+from pathlib import Path
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+
+
+class LibraryTestRunner(DiscoverRunner):
+    # The tests take and reset token buckets, in a throwaway THROTTLE_DATABASE rather than the one the site's
+    # workers share on this host
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        self.throttle_directory = tempfile.TemporaryDirectory()
+        self.throttle_settings = override_settings(THROTTLE_DATABASE=Path(self.throttle_directory.name) / 'throttle.sqlite3')
+        self.throttle_settings.enable()
+
+    def teardown_test_environment(self, **kwargs):
+        self.throttle_settings.disable()
+        self.throttle_directory.cleanup()
+        super().teardown_test_environment(**kwargs)
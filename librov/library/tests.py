@@ -1,3 +1,1374 @@
-from django.test import TestCase
+import csv
+import json
+import multiprocessing
+import re
+import tempfile
+import threading
+import time
+from base64 import urlsafe_b64encode
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone as dt_timezone
+from io import StringIO
+from unittest import mock
+from urllib.parse import parse_qs, urlsplit
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.db.migrations.executor import MigrationExecutor
+from django.http import HttpResponse
+from django.test import AsyncClient, AsyncRequestFactory, RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve
+from django.utils import timezone
+from rest_framework import views
+from rest_framework.request import Request
+from rest_framework.response import Response
+from rest_framework.test import APIRequestFactory, force_authenticate
+from . import authentication, metrics, throttling
+from .management.commands import scan_overdue_loans
+from .models import (Book, BookSimilarity, BookTrend, BroadcastNotification, BroadcastReceipt, CustomUser, Hold, JobWatermark, Notification,
+                     Review, Transaction)
+from .routers import ReplicaRoutingMiddleware, record_sync
+from .search import FTS_TABLE
+from .serializers import MAX_BATCH_SIZE, HoldSerializer
+from .signals import books_checked_out
+from .throttling import EndpointTokenBucketThrottle, LoadSheddingMiddleware, TokenBucketThrottle, UserTokenBucketThrottle
+from .views import (AsyncBookDetailView, AsyncBookListView, AsyncNotificationListView, AsyncReviewListView, BatchConflict,
+                    BookExportView, BookViewSet, NotificationListView, ProfileTransactionListView, Reviews, TransactionViewset)
 
-# Create your tests here.
+HOST = 'VordaNick.pythonanywhere.com' # The only entry in ALLOWED_HOSTS
+
+
+def bearer(user):
+    return f'Bearer {authentication.LibraryRefreshToken.for_user(user).access_token}'
+
+
+class QueryPlanTests(TestCase):
+    # Runs EXPLAIN QUERY PLAN on the querysets the views actually build and fails when one of them reads a whole
+    # table instead of going through an index. SQLite only: the plan wording is SQLite's.
+    factory = APIRequestFactory()
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user('reader', 'reader@example.com', 'password')
+        cls.book = Book.objects.create(title='The Hobbit', author='Tolkien', isbn='9780261103573', genre='Fantasy', published_date='1937-09-21',
+                                       available_copies=1)
+
+    def setUp(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('Query plans are checked on SQLite')
+        cache.clear()
+        throttling.reset()
+
+    def query_plan(self, queryset):
+        # A queryset, or the SQL of one executed_queries() caught, which has its parameters filled in
+        sql, params = (queryset, []) if isinstance(queryset, str) else queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+            return [row[-1] for row in cursor.fetchall()]
+
+    def assertNoFullScan(self, queryset):
+        plan = self.query_plan(queryset)
+        # "SCAN <table>" with no index after it is a full table scan. "SCAN <table> USING INDEX" walks an index in order,
+        # "SCAN subquery" reads rows a subquery already found, e.g. when a union is counted
+        full_scans = [step for step in plan if re.match(r'SCAN (?!subquery)\w+( AS \w+)?$', step)]
+        self.assertFalse(full_scans, f'Full table scan in {plan}')
+        return plan
+
+    def assertNoSort(self, plan):
+        self.assertFalse([step for step in plan if 'TEMP B-TREE' in step], f'Sorts in a temporary b-tree: {plan}')
+
+    def view_queryset(self, view_class, query='', **view_kwargs):
+        request = Request(self.factory.get(f'/{query}'))
+        request.user = self.user
+        view = view_class(request=request, format_kwarg=None, args=(), kwargs={}, **view_kwargs)
+        return view.filter_queryset(view.get_queryset())
+
+    def executed_queries(self, table, run, containing=''):
+        # The SELECTs on <table> that run() sends, for the queries an action or a command builds as it goes
+        with CaptureQueriesContext(connection) as context:
+            run()
+        queries = [query['sql'] for query in context.captured_queries
+                   if query['sql'].startswith('SELECT') and f'FROM "{table}"' in query['sql'] and containing in query['sql']]
+        self.assertTrue(queries, f'Nothing read {table}')
+        return queries
+
+    def request(self, method, path, data=None):
+        response = getattr(self.client, method)(path, data, content_type='application/json', HTTP_HOST=HOST, HTTP_AUTHORIZATION=bearer(self.user))
+        self.assertLess(response.status_code, 300, response.content)
+        return response
+
+    def test_book_filters(self):
+        for query in ['?genre=Fantasy', '?author=Tolkien', '?available_copies=0', '?isbn=9780261103573']:
+            with self.subTest(query=query):
+                self.assertNoFullScan(self.view_queryset(BookViewSet, query, action='list'))
+
+    def test_book_orderings(self):
+        for ordering in ['title', '-published_date']:
+            with self.subTest(ordering=ordering):
+                queryset = self.view_queryset(BookViewSet, f'?ordering={ordering}', action='list')
+                tie_breaker = '-id' if ordering.startswith('-') else 'id' # The way the cursor pagination orders them
+                self.assertNoSort(self.assertNoFullScan(queryset.order_by(ordering, tie_breaker)[:10]))
+
+    def test_open_loan_lookup(self):
+        # What the batch checkout and the hold queue look up, next to checkout's unique_open_loan constraint
+        checkout = lambda: self.request('post', '/library/transactions/batch/', {'book_ids': [self.book.pk]})
+        for sql in self.executed_queries('library_transaction', checkout, '"return_date" IS NULL'):
+            self.assertNoFullScan(sql)
+
+    def test_profile_transactions(self):
+        queryset = self.view_queryset(ProfileTransactionListView)[:10]
+        self.assertNoSort(self.assertNoFullScan(queryset))
+
+    def test_personal_notifications(self):
+        # The page and its count, through the view that serves them
+        Notification.objects.create(recipient=self.user, message='Your hold is ready')
+        notifications = lambda: self.request('get', '/library/profile/notifications/')
+        for sql in self.executed_queries('library_notification', notifications):
+            self.assertNoFullScan(sql)
+
+    def test_notification_feed(self):
+        # The union itself is sorted once both halves are read, each half has to use an index
+        self.assertNoFullScan(self.view_queryset(NotificationListView)[:10])
+
+    def test_reviews_of_book(self):
+        self.assertNoFullScan(self.view_queryset(Reviews, f'?book={self.book.pk}', action='list'))
+
+    def test_reviews_newest_first(self):
+        reviews = lambda: self.request('get', '/library/reviews/?pagination=cursor')
+        for sql in self.executed_queries('library_review', reviews, 'ORDER BY'):
+            self.assertNoSort(self.assertNoFullScan(sql))
+
+    def test_bulk_availability(self):
+        for query in ['?isbns=9780261103573,9780000000000', f'?ids={self.book.pk},999']:
+            with self.subTest(query=query):
+                availability = lambda: self.request('get', f'/library/books/availability/{query}')
+                for sql in self.executed_queries('library_book', availability):
+                    self.assertNoFullScan(sql)
+
+    def test_hold_queue_head(self):
+        # The next member in line is the first entry of the queue index, however long the queue is
+        Transaction.objects.create(user=self.user, book=self.book)
+        loan = Transaction.objects.get()
+        give_back = lambda: self.request('patch', '/library/transactions/', {'transaction_id': loan.pk})
+        for sql in self.executed_queries('library_hold', give_back, 'ORDER BY'):
+            self.assertNoSort(self.assertNoFullScan(sql))
+        expire = lambda: call_command('expire_holds', stdout=StringIO())
+        for sql in self.executed_queries('library_hold', expire, '"ready_until" <'):
+            self.assertNoFullScan(sql)
+
+    def test_trending_boards(self):
+        for board in ['borrowed', 'rated']:
+            for genre in ['', 'Fantasy']:
+                with self.subTest(board=board, genre=genre):
+                    cache.clear()
+                    trending = lambda: self.request('get', f'/library/books/trending/?board={board}&genre={genre}')
+                    for sql in self.executed_queries('library_booktrend', trending):
+                        self.assertNoSort(self.assertNoFullScan(sql))
+
+    def test_rating_aggregates(self):
+        rebuild = lambda: call_command('rebuild_rating_aggregates', stdout=StringIO())
+        for sql in self.executed_queries('library_review', rebuild, 'COUNT'):
+            plan = self.query_plan(sql)
+            self.assertTrue([step for step in plan if 'COVERING INDEX review_book_rating_idx' in step], plan)
+
+
+def take_tokens(count):
+    # Run in a child process, as another worker would
+    view = SlowView.as_view()
+    statuses = []
+    for _ in range(count):
+        request = APIRequestFactory().get('/')
+        force_authenticate(request, CustomUser(pk=1, username='member1'))
+        statuses.append(view(request).status_code)
+    return statuses
+
+
+class SlowView(views.APIView):
+    # Stands in for a view doing real work, without touching the database
+    authentication_classes = []
+    permission_classes = []
+    throttle_classes = [UserTokenBucketThrottle, EndpointTokenBucketThrottle]
+    throttle_scope = 'transactions'
+    
+    def get(self, request):
+        time.sleep(0.005)
+        return Response({})
+
+
+@override_settings(REST_FRAMEWORK={
+    'DEFAULT_THROTTLE_RATES': {'user': '100/s', 'anon': '3/min', 'transactions': '20/s'},
+})
+class ThrottleTests(SimpleTestCase):
+    factory = APIRequestFactory()
+    view = staticmethod(SlowView.as_view())
+
+    def setUp(self):
+        throttling.reset()
+
+    def get(self, user=None, ip='10.0.0.1'):
+        request = self.factory.get('/', REMOTE_ADDR=ip)
+        if user:
+            force_authenticate(request, user)
+        return self.view(request)
+
+    def member(self, pk):
+        return CustomUser(pk=pk, username=f'member{pk}')
+
+    def test_burst_then_refill(self):
+        clock = [1000.0]
+        with mock.patch.object(TokenBucketThrottle, 'timer', lambda self: clock[0]):
+            self.assertEqual([self.get().status_code for _ in range(4)], [200, 200, 200, 429])
+            self.assertEqual(self.get()['Retry-After'], '20') # One token comes back every 20 seconds at 3/min
+            clock[0] += 20
+            self.assertEqual(self.get().status_code, 200)
+            self.assertEqual(self.get().status_code, 429)
+
+    def test_clients_have_their_own_buckets(self):
+        for _ in range(3):
+            self.get(ip='10.0.0.1')
+        self.assertEqual(self.get(ip='10.0.0.1').status_code, 429)
+        self.assertEqual(self.get(ip='10.0.0.2').status_code, 200)
+        self.assertEqual(self.get(self.member(1)).status_code, 200) # Members are counted by id, not address
+
+    def test_scope_comes_from_the_throttle_or_the_view(self):
+        class LoginThrottle(TokenBucketThrottle):
+            scope = 'anon'
+        self.assertEqual(EndpointTokenBucketThrottle().get_scope(None, SlowView()), 'transactions')
+        self.assertEqual(LoginThrottle().get_scope(None, SlowView()), 'anon')
+        self.assertTrue(TokenBucketThrottle().allow_request(None, views.APIView())) # No scope, no limit
+
+    def test_endpoint_bucket_is_tighter_than_the_user_bucket(self):
+        with mock.patch.object(TokenBucketThrottle, 'timer', lambda self: 1000.0):
+            statuses = [self.get(self.member(1)).status_code for _ in range(30)]
+        self.assertEqual(statuses.count(200), 20) # The 'transactions' rate runs out before the 'user' one
+
+    def test_workers_share_buckets_and_never_overdraw_them(self):
+        with mock.patch.object(TokenBucketThrottle, 'timer', lambda self: 1000.0):
+            with ProcessPoolExecutor(4, mp_context=multiprocessing.get_context('fork')) as pool:
+                statuses = [status for result in pool.map(take_tokens, [15] * 4) for status in result]
+            self.assertEqual(statuses.count(200), 20) # Exactly the burst of 'transactions', across all four processes
+            self.assertEqual(self.get(self.member(1)).status_code, 429) # And this process sees the bucket they emptied
+
+    def test_abusers_only_empty_their_own_buckets(self):
+        # Four members hammering checkout at once get their burst each and 429s after it, while a fifth member
+        # sending a request now and then is never turned away. The clock stands still, so no bucket refills meanwhile
+        def hammer(pk):
+            return [self.get(self.member(pk)).status_code for _ in range(40)]
+
+        with mock.patch.object(TokenBucketThrottle, 'timer', lambda self: 1000.0):
+            with ThreadPoolExecutor(4) as pool:
+                abusers = [pool.submit(hammer, pk) for pk in range(2, 6)]
+                well_behaved = [self.get(self.member(1)).status_code for _ in range(10)]
+                abused = [future.result() for future in abusers]
+        self.assertEqual(well_behaved, [200] * 10)
+        for statuses in abused:
+            self.assertEqual(statuses, [200] * 20 + [429] * 20) # Once empty, a bucket stays empty
+
+
+@override_settings(MAX_CONCURRENT_REQUESTS=2, MAX_QUEUED_REQUESTS=1, QUEUE_TIMEOUT_SECONDS=1)
+class LoadSheddingTests(SimpleTestCase):
+    def setUp(self):
+        self.release = threading.Event()
+        self.running = threading.Semaphore(0)
+        def get_response(request):
+            self.running.release()
+            self.release.wait(5)
+            return HttpResponse()
+        self.middleware = LoadSheddingMiddleware(get_response)
+        self.request = RequestFactory().get('/library/books/')
+
+    def test_sheds_past_the_queue(self):
+        with ThreadPoolExecutor(3) as pool:
+            running = [pool.submit(self.middleware, self.request) for _ in range(2)]
+            for _ in running:
+                self.running.acquire(timeout=5)
+            queued = pool.submit(self.middleware, self.request)
+            while not self.middleware.waiting:
+                time.sleep(0.001)
+            started = time.perf_counter()
+            shed = self.middleware(self.request)
+            self.assertLess(time.perf_counter() - started, 0.1) # Turned away without waiting
+            self.assertEqual(shed.status_code, 503)
+            self.assertEqual(shed['Retry-After'], '1')
+            self.release.set()
+            self.assertEqual([future.result().status_code for future in [*running, queued]], [200, 200, 200])
+        self.assertEqual((self.middleware.active, self.middleware.waiting), (0, 0))
+
+    def test_queued_request_gives_up_after_the_timeout(self):
+        with ThreadPoolExecutor(2) as pool:
+            running = [pool.submit(self.middleware, self.request) for _ in range(2)]
+            for _ in running:
+                self.running.acquire(timeout=5)
+            self.assertEqual(self.middleware(self.request).status_code, 503)
+            self.release.set()
+        self.assertEqual(self.middleware(self.request).status_code, 200)
+
+
+class TokenVersionTests(TestCase):
+    def setUp(self):
+        authentication.clear()
+        throttling.reset() # The token endpoint's buckets
+        self.user = CustomUser.objects.create_user('reader', 'reader@example.com', 'first-password')
+
+    def login(self, password):
+        response = self.client.post('/library/token/', {'username': 'reader', 'password': password}, HTTP_HOST=HOST)
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()['access']
+
+    def profile(self, token):
+        return self.client.get('/library/profile/', HTTP_HOST=HOST, HTTP_AUTHORIZATION=f'Bearer {token}')
+
+    def test_password_change_revokes_older_tokens(self):
+        old = self.login('first-password')
+        self.assertEqual(self.profile(old).status_code, 200)
+        self.user.set_password('second-password')
+        self.user.save()
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.token_version, 1)
+        response = self.profile(old)
+        self.assertEqual((response.status_code, response.json()['code']), (401, 'token_revoked'))
+        self.assertEqual(self.profile(self.login('second-password')).status_code, 200)
+
+    def test_saving_without_a_new_password_keeps_tokens(self):
+        token = self.login('first-password')
+        self.user.bio = 'Mostly fantasy'
+        self.user.save()
+        self.assertEqual(self.profile(token).status_code, 200)
+
+    @override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.PBKDF2PasswordHasher',
+                                         'django.contrib.auth.hashers.MD5PasswordHasher'])
+    def test_hash_upgrade_on_login_keeps_the_new_token(self):
+        CustomUser.objects.filter(pk=self.user.pk).update(password=make_password('first-password', hasher='md5'))
+        token = self.login('first-password') # check_password rehashes with PBKDF2 and saves only the password
+        self.user.refresh_from_db()
+        self.assertTrue(self.user.password.startswith('pbkdf2_sha256$'))
+        self.assertEqual(self.user.token_version, 0)
+        self.assertEqual(self.profile(token).status_code, 200)
+
+
+class DynamicFieldsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.member = CustomUser.objects.create_user('reader', 'reader@example.com', 'password')
+        cls.staff = CustomUser.objects.create_user('librarian', 'librarian@example.com', 'password', is_staff=True)
+        cls.book = Book.objects.create(title='The Hobbit', author='Tolkien', isbn='9780261103573', genre='Fantasy', published_date='1937-09-21')
+
+    def setUp(self):
+        cache.clear()
+        throttling.reset()
+
+    def post(self, path, data, user):
+        return self.client.post(path, data, content_type='application/json', HTTP_HOST=HOST, HTTP_AUTHORIZATION=bearer(user))
+
+    def test_reads_are_trimmed(self):
+        response = self.client.get(f'/library/books/{self.book.pk}/?fields=id,title', HTTP_HOST=HOST)
+        self.assertEqual(response.json(), {'id': self.book.pk, 'title': 'The Hobbit'})
+
+    def test_writes_validate_every_field(self):
+        response = self.post('/library/reviews/?fields=id,book', {'book': self.book.pk}, self.member)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('review_text', response.json())
+        self.assertFalse(Review.objects.exists())
+
+        response = self.post('/library/books/?fields=id', {}, self.staff)
+        self.assertEqual(response.status_code, 400)
+        self.assertTrue({'title', 'isbn'} <= set(response.json()))
+
+
+class KeysetPaginationTests(TestCase):
+    # 25 books with only five titles between them, so ordering by title has to break ties on id
+    @classmethod
+    def setUpTestData(cls):
+        Book.objects.bulk_create(Book(title=f'Volume {number % 5}', author='Author', isbn=f'9780000000{number:03d}', genre='Fantasy',
+                                      published_date='2000-01-01') for number in range(25))
+
+    def setUp(self):
+        cache.clear()
+        throttling.reset()
+
+    def get(self, url):
+        parts = urlsplit(url)
+        response = self.client.get(f'{parts.path}?{parts.query}', HTTP_HOST=HOST)
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()
+
+    def walk(self, url):
+        # Follows the next links to the end, returning the ids of every page
+        pages = []
+        while url:
+            page = self.get(url)
+            pages.append([book['id'] for book in page['results']])
+            url = page['next']
+        return pages
+
+    def test_every_book_once(self):
+        for ordering, key in [('id', lambda book: book.pk), ('-id', lambda book: -book.pk),
+                              ('title', lambda book: (book.title, book.pk)), ('-title', lambda book: (book.title, book.pk))]:
+            with self.subTest(ordering=ordering):
+                expected = [book.pk for book in sorted(Book.objects.all(), key=key, reverse=ordering == '-title')]
+                pages = self.walk(f'/library/books/?pagination=cursor&ordering={ordering}')
+                self.assertEqual([len(page) for page in pages], [10, 10, 5])
+                self.assertEqual(sum(pages, []), expected)
+
+    def test_books_added_while_paging_do_not_shift_pages(self):
+        first = self.get('/library/books/?pagination=cursor')
+        Book.objects.create(title='Volume 0', author='Author', isbn='9780000000999', genre='Fantasy', published_date='2000-01-01')
+        Book.objects.filter(pk=first['results'][0]['id']).delete()
+        expected = list(Book.objects.order_by('id').values_list('id', flat=True))[9:19]
+        self.assertEqual([book['id'] for book in self.get(first['next'])['results']], expected)
+
+    def test_previous_link(self):
+        first = self.get('/library/books/?pagination=cursor&ordering=title')
+        self.assertIsNone(first['previous'])
+        second = self.get(first['next'])
+        third = self.get(second['next'])
+        self.assertIsNone(third['next'])
+
+        back = self.get(third['previous'])
+        self.assertEqual(back['results'], second['results'])
+        self.assertEqual(back['next'], second['next'])
+        back = self.get(back['previous'])
+        self.assertEqual(back['results'], first['results'])
+        self.assertIsNone(back['previous'])
+
+    def test_invalid_cursor(self):
+        id_cursor = parse_qs(urlsplit(self.get('/library/books/?pagination=cursor')['next']).query)['cursor'][0]
+        tampered = urlsafe_b64encode(b'{"o": "published_date", "v": "not a date", "id": 1}').decode()
+        for query in ['cursor=garbage', 'cursor=%C3%A9', f'cursor={id_cursor}&ordering=title', f'cursor={tampered}&ordering=published_date',
+                      'cursor=' + urlsafe_b64encode(b'[1]').decode(), 'cursor=' + urlsafe_b64encode(b'{"o": "id", "v": 1, "id": "x"}').decode()]:
+            with self.subTest(query=query):
+                response = self.client.get(f'/library/books/?{query}', HTTP_HOST=HOST)
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(response.json(), {'cursor': 'Invalid cursor'})
+
+    def test_count_only_on_request(self):
+        self.assertNotIn('count', self.get('/library/books/?pagination=cursor'))
+        self.assertEqual(self.get('/library/books/?pagination=cursor&count=exact')['count'], 25)
+        self.assertEqual(self.get('/library/books/?pagination=cursor&count=exact&title=Volume 1')['count'], 5)
+        self.assertGreaterEqual(self.get('/library/books/?pagination=cursor&count=estimate')['count'], 25)
+        self.assertNotIn('count', self.get('/library/books/?pagination=cursor&count=estimate&title=Volume 1')) # No cheap estimate once filtered
+
+    def test_page_numbers_stay_the_default(self):
+        page = self.get('/library/books/?page=2')
+        self.assertEqual(page['count'], 25)
+        self.assertEqual(len(page['results']), 10)
+        self.assertIn('page=3', page['next'])
+        self.assertNotIn('cursor', page['next'])
+
+
+class SearchIndexTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.hobbit = Book.objects.create(title='The Hobbit', author='J. R. R. Tolkien', isbn='9780261103573', genre='Fantasy', published_date='1937-09-21')
+        cls.dune = Book.objects.create(title='Dune', author='Frank Herbert', isbn='9780441013593', genre='Science Fiction', published_date='1965-08-01')
+
+    def setUp(self):
+        cache.clear()
+        throttling.reset()
+
+    def indexed(self, query):
+        # The books the FTS table itself matches, without going through the view
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s ORDER BY rowid', [query])
+            return [row[0] for row in cursor.fetchall()]
+
+    def search(self, terms):
+        response = self.client.get('/library/books/', {'search': terms, 'search_mode': 'fts'}, HTTP_HOST=HOST)
+        self.assertEqual(response.status_code, 200, response.content)
+        return [book['id'] for book in response.json()['results']]
+
+    def test_triggers_keep_the_index_in_step(self):
+        book = Book.objects.create(title='Neuromancer', author='William Gibson', isbn='9780441569595', genre='Cyberpunk', published_date='1984-07-01')
+        self.assertEqual(self.indexed('neuromancer'), [book.pk])
+
+        book.title = 'Count Zero'
+        book.save()
+        self.assertEqual(self.indexed('neuromancer'), [])
+        self.assertEqual(self.indexed('count zero'), [book.pk])
+
+        Book.objects.filter(pk=book.pk).update(genre='Science Fiction') # Bulk updates are covered as well
+        self.assertEqual(self.indexed('genre:science'), [self.dune.pk, book.pk])
+
+        book.delete()
+        self.assertEqual(self.indexed('count'), [])
+        self.assertEqual(self.indexed('gibson'), [])
+
+    def test_terms_match_as_prefixes(self):
+        self.assertEqual(self.search('hob tolk'), [self.hobbit.pk])
+        self.assertEqual(self.search('scien'), [self.dune.pk])
+        self.assertEqual(self.search('Hérbert'), [self.dune.pk]) # Diacritics are folded on both sides
+        self.assertEqual(self.search('hobbit herbert'), []) # Every term has to match
+
+    def test_isbn_goes_to_the_isbn_index(self):
+        for isbn in ['9780261103573', '978-0-261-10357-3']:
+            with self.subTest(isbn=isbn), CaptureQueriesContext(connection) as context:
+                self.assertEqual(self.search(isbn), [self.hobbit.pk])
+            self.assertFalse([query for query in context.captured_queries if 'MATCH' in query['sql']])
+        self.assertEqual(self.search('9780000000000'), []) # An unknown ISBN still falls back to the index
+
+    def test_query_syntax_is_not_interpreted(self):
+        for terms in ['"', '""', 'hobbit"', '"the hobbit', "tolkien's", '(', ')', '*', '-', '^', ':', 'title:dune', 'NEAR(dune',
+                      'dune AND', 'NOT dune', 'OR', '+', '{title}', 'a"b"c', '\\', '%', '_', '.', '--']:
+            with self.subTest(terms=terms):
+                self.search(terms)
+        self.assertEqual(self.search('NOT dune'), []) # NOT is a word to look for, not an operator
+        self.assertEqual(self.search('title:dune'), [])
+
+
+class AvailabilityTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.hobbit = Book.objects.create(title='The Hobbit', author='Tolkien', isbn='9780261103573', genre='Fantasy',
+                                         published_date='1937-09-21', available_copies=3)
+        cls.dune = Book.objects.create(title='Dune', author='Herbert', isbn='9780441013593', genre='Science Fiction',
+                                       published_date='1965-08-01', available_copies=0)
+
+    def setUp(self):
+        cache.clear()
+        throttling.reset()
+
+    def get(self, query):
+        return self.client.get(f'/library/books/availability/?{query}', HTTP_HOST=HOST)
+
+    def test_found_and_missing_books(self):
+        response = self.get(f'ids={self.hobbit.pk},999,{self.dune.pk}')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'availability': {str(self.hobbit.pk): 3, '999': None, str(self.dune.pk): 0}})
+        self.assertEqual(response['Cache-Control'], 'public, max-age=30')
+        response = self.get('isbns=9780441013593, 9780000000000')
+        self.assertEqual(response.json(), {'availability': {'9780441013593': 0, '9780000000000': None}})
+
+    def test_isbns_are_matched_the_way_they_are_stored(self):
+        response = self.get('isbns=978-0-261-10357-3,978 0441013593')
+        self.assertEqual(response.json(), {'availability': {'978-0-261-10357-3': 3, '978 0441013593': 0}})
+
+    def test_duplicate_keys_are_answered_once(self):
+        with self.assertNumQueries(1):
+            response = self.get(f'ids={self.hobbit.pk},{self.hobbit.pk},,{self.hobbit.pk}')
+        self.assertEqual(response.json(), {'availability': {str(self.hobbit.pk): 3}})
+
+    def test_invalid_ids(self):
+        for ids in ['', 'abc', '1,x', '-1', '1.5', '²', '١', '99999999999999999999999', str(2 ** 63)]:
+            with self.subTest(ids=ids):
+                response = self.get(f'ids={ids}')
+                self.assertEqual(response.status_code, 400)
+                self.assertIn('ids', response.json())
+
+    def test_item_cap(self):
+        cap = settings.AVAILABILITY_MAX_ITEMS
+        self.assertEqual(self.get('ids=' + ','.join(map(str, range(1, cap + 1)))).status_code, 200)
+        response = self.get('ids=' + ','.join(map(str, range(1, cap + 2))))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'ids': f'At most {cap} at a time'})
+
+
+class HoldTests(TestCase):
+    # One copy of the book and a queue behind it, driven through the API the way members use it
+    @classmethod
+    def setUpTestData(cls):
+        cls.book = Book.objects.create(title='The Hobbit', author='Tolkien', isbn='9780261103573', genre='Fantasy',
+                                       published_date='1937-09-21', available_copies=1)
+        cls.alice, cls.bob, cls.carol = [CustomUser.objects.create_user(name, f'{name}@example.com', 'password') for name in ['alice', 'bob', 'carol']]
+
+    def setUp(self):
+        cache.clear()
+        throttling.reset()
+
+    def request(self, method, path, user, data=None):
+        return getattr(self.client, method)(path, data, content_type='application/json', HTTP_HOST=HOST, HTTP_AUTHORIZATION=bearer(user))
+
+    def checkout(self, user):
+        return self.request('post', '/library/transactions/', user, {'book_id': self.book.pk})
+
+    def give_back(self, user):
+        loan = Transaction.objects.get(user=user, book=self.book, return_date=None)
+        return self.request('patch', '/library/transactions/', user, {'transaction_id': loan.pk})
+
+    def hold(self, user):
+        response = self.request('post', '/library/holds/', user, {'book_id': self.book.pk})
+        self.assertEqual(response.status_code, 201, response.content)
+        return Hold.objects.get(pk=response.json()['id'])
+
+    def status_of(self, hold):
+        hold.refresh_from_db()
+        return hold.status
+
+    def copies(self):
+        self.book.refresh_from_db()
+        return self.book.available_copies
+
+    def test_listing_holds_counts_positions_in_one_query(self):
+        other = Book.objects.create(title='Dune', author='Herbert', isbn='9780441013593', genre='Science Fiction',
+                                    published_date='1965-08-01', available_copies=0)
+        self.checkout(self.alice)
+        self.hold(self.bob)
+        self.hold(self.carol)
+        def listed():
+            with CaptureQueriesContext(connection) as queries:
+                response = self.request('get', '/library/holds/', self.carol)
+            return [(hold['book_id'], hold['position']) for hold in response.json()['results']], len(queries)
+        one, queries_for_one = listed()
+        self.assertEqual(one, [(self.book.pk, 2)])
+        Hold.objects.create(user=self.alice, book=other)
+        Hold.objects.create(user=self.carol, book=other)
+        two, queries_for_two = listed()
+        self.assertEqual(two, [(self.book.pk, 2), (other.pk, 2)])
+        self.assertEqual(queries_for_one, queries_for_two)
+
+    def test_return_hands_the_copy_to_the_head_of_the_queue(self):
+        self.assertEqual(self.checkout(self.alice).status_code, 201)
+        bobs, carols = self.hold(self.bob), self.hold(self.carol)
+        self.assertEqual(self.give_back(self.alice).status_code, 200)
+        self.assertEqual((self.status_of(bobs), self.status_of(carols), self.copies()), (Hold.READY, Hold.WAITING, 0))
+        self.assertTrue(Notification.objects.filter(recipient=self.bob, message__contains='is waiting for you').exists())
+        self.assertEqual(self.checkout(self.carol).status_code, 400) # Set aside for Bob
+        self.assertEqual(self.checkout(self.bob).status_code, 201)
+        self.assertEqual((self.status_of(bobs), self.copies()), (Hold.FULFILLED, 0))
+
+    def test_cancelling_a_ready_hold_passes_the_copy_on(self):
+        self.checkout(self.alice)
+        bobs, carols = self.hold(self.bob), self.hold(self.carol)
+        self.give_back(self.alice)
+        self.assertEqual(self.request('delete', f'/library/holds/{bobs.pk}/', self.bob).status_code, 204)
+        self.assertEqual((self.status_of(bobs), self.status_of(carols), self.copies()), (Hold.CANCELLED, Hold.READY, 0))
+        self.request('delete', f'/library/holds/{carols.pk}/', self.carol)
+        self.assertEqual(self.copies(), 1) # Nobody left waiting, back on the shelf
+
+    def test_expired_hold_goes_to_the_next_member(self):
+        self.checkout(self.alice)
+        bobs, carols = self.hold(self.bob), self.hold(self.carol)
+        self.give_back(self.alice)
+        Hold.objects.filter(pk=bobs.pk).update(ready_until=timezone.now() - timedelta(minutes=1))
+        call_command('expire_holds', stdout=StringIO())
+        self.assertEqual((self.status_of(bobs), self.status_of(carols), self.copies()), (Hold.EXPIRED, Hold.READY, 0))
+        self.assertEqual(self.checkout(self.carol).status_code, 201)
+
+    def test_checking_out_a_shelved_copy_leaves_the_queue(self):
+        self.checkout(self.alice)
+        bobs, carols = self.hold(self.bob), self.hold(self.carol)
+        Book.objects.filter(pk=self.book.pk).update(available_copies=1) # Staff add a copy before expire_holds runs
+        self.assertEqual(self.checkout(self.bob).status_code, 201)
+        self.assertEqual(self.status_of(bobs), Hold.FULFILLED)
+        self.give_back(self.alice)
+        self.assertEqual((self.status_of(carols), self.copies()), (Hold.READY, 0))
+
+    def test_batch_checkout_claims_ready_holds_and_leaves_the_queue(self):
+        other = Book.objects.create(title='Dune', author='Herbert', isbn='9780441013593', genre='Science Fiction',
+                                    published_date='1965-08-01', available_copies=0)
+        self.checkout(self.alice)
+        bobs = self.hold(self.bob)
+        waiting = Hold.objects.create(user=self.bob, book=other)
+        self.give_back(self.alice)
+        Book.objects.filter(pk=other.pk).update(available_copies=1)
+        response = self.request('post', '/library/transactions/batch/', self.bob, {'book_ids': [self.book.pk, other.pk]})
+        self.assertEqual(response.status_code, 201, response.content)
+        self.assertEqual((self.status_of(bobs), self.status_of(waiting)), (Hold.FULFILLED, Hold.FULFILLED))
+        self.assertEqual(list(Book.objects.filter(pk__in=[self.book.pk, other.pk]).values_list('available_copies', flat=True)), [0, 0])
+
+    def test_hand_off_skips_members_who_already_have_a_copy(self):
+        self.checkout(self.alice)
+        bobs, carols = self.hold(self.bob), self.hold(self.carol)
+        Transaction.objects.create(user=self.bob, book=self.book) # Checked out while the hold was being placed
+        self.give_back(self.alice)
+        self.assertEqual((self.status_of(bobs), self.status_of(carols)), (Hold.FULFILLED, Hold.READY))
+
+    def test_copy_returned_while_the_hold_goes_in_is_handed_over(self):
+        self.checkout(self.alice)
+        save = HoldSerializer.save
+        def return_first(serializer, **kwargs):
+            self.give_back(self.alice) # After the hold view saw no copy, before the hold is in: back on the shelf
+            return save(serializer, **kwargs)
+        with mock.patch.object(HoldSerializer, 'save', return_first):
+            response = self.request('post', '/library/holds/', self.bob, {'book_id': self.book.pk})
+        self.assertEqual(response.status_code, 201, response.content)
+        self.assertEqual((response.json()['status'], self.copies()), ('ready', 0))
+
+
+class NotificationFeedTests(TestCase):
+    # Personal notifications and broadcasts, a day apart and alternating, for a member who joined before all of them
+    @classmethod
+    def setUpTestData(cls):
+        start = timezone.now() - timedelta(days=30)
+        cls.member = CustomUser.objects.create_user('reader', 'reader@example.com', 'password', date_joined=start)
+        cls.messages = []
+        for day in range(1, 13):
+            if day % 3:
+                row = Notification.objects.create(recipient=cls.member, message=f'Personal {day}', is_read=day == 1)
+            else:
+                row = BroadcastNotification.objects.create(message=f'Broadcast {day}')
+            type(row).objects.filter(pk=row.pk).update(created_at=start + timedelta(days=day))
+            cls.messages.append(row.message)
+        cls.messages.reverse() # Newest first, the way the feed lists them
+
+    def setUp(self):
+        cache.clear()
+        throttling.reset()
+
+    def get(self, path='/library/profile/notifications/', user=None):
+        response = self.client.get(path, HTTP_HOST=HOST, HTTP_AUTHORIZATION=bearer(user or self.member))
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()
+
+    def test_personal_and_broadcasts_merged_newest_first(self):
+        first, second = self.get(), self.get('/library/profile/notifications/?page=2')
+        self.assertEqual(first['count'], 12)
+        self.assertEqual([row['message'] for row in first['results'] + second['results']], self.messages)
+        self.assertEqual({row['kind'] for row in first['results']}, {'personal', 'broadcast'})
+
+    def test_cursor_pages_walk_both_halves(self):
+        seen, url = [], '/library/profile/notifications/?pagination=cursor'
+        while url:
+            page = self.get(url)
+            seen += [row['message'] for row in page['results']]
+            url = page['next'] and urlsplit(page['next'])._replace(scheme='', netloc='').geturl()
+        self.assertEqual(seen, self.messages)
+
+    def test_broadcasts_are_read_once_shown(self):
+        is_read = lambda page: {row['message']: row['is_read'] for row in page['results']}
+        self.assertEqual(is_read(self.get()), {message: message == 'Personal 1' for message in self.messages[:10]})
+        self.assertEqual(BroadcastReceipt.objects.get(user=self.member).last_read, BroadcastNotification.objects.latest('id').pk)
+
+        BroadcastNotification.objects.create(message='Broadcast 13')
+        shown = is_read(self.get())
+        self.assertFalse(shown['Broadcast 13'])
+        self.assertTrue(shown['Broadcast 12'] and shown['Broadcast 9'])
+        self.assertFalse(shown['Personal 11']) # Personal notifications keep their own flag
+        self.assertTrue(is_read(self.get())['Broadcast 13'])
+
+    def test_older_page_does_not_unread_newer_broadcasts(self):
+        self.get()
+        receipt = BroadcastReceipt.objects.get(user=self.member).last_read
+        self.get('/library/profile/notifications/?page=2')
+        self.assertEqual(BroadcastReceipt.objects.get(user=self.member).last_read, receipt)
+
+    def test_members_only_see_broadcasts_sent_since_they_joined(self):
+        joined = BroadcastNotification.objects.get(message='Broadcast 6').created_at + timedelta(hours=1)
+        newcomer = CustomUser.objects.create_user('newcomer', 'newcomer@example.com', 'password', date_joined=joined)
+        Notification.objects.create(recipient=newcomer, message='Welcome')
+        messages = [row['message'] for row in self.get(user=newcomer)['results']]
+        self.assertEqual(messages, ['Welcome', 'Broadcast 12', 'Broadcast 9'])
+
+
+class ReplicaRoutingTests(SimpleTestCase):
+    factory = RequestFactory()
+
+    def setUp(self):
+        cache.clear()
+        self.middleware = ReplicaRoutingMiddleware(HttpResponse)
+        self.middleware.replicas = ['replica1', 'replica2'] # Only the routing decision is tested, nothing is read
+
+    def route(self, method='get', token='Bearer a'):
+        return self.middleware.route(getattr(self.factory, method)('/', HTTP_AUTHORIZATION=token))[0]
+
+    def write(self, token='Bearer a'):
+        request = self.factory.post('/', HTTP_AUTHORIZATION=token)
+        self.middleware.pin(request, self.middleware.client_key(request))
+
+    def test_reads_go_to_replicas_and_writes_to_default(self):
+        self.assertIn(self.route(), ['replica1', 'replica2'])
+        self.assertIsNone(self.route('post'))
+
+    def test_client_reads_only_replicas_synced_after_its_write(self):
+        clock = [1000.0]
+        with mock.patch('library.routers.time.time', lambda: clock[0]):
+            record_sync('replica1', 900.0)
+            record_sync('replica2', 900.0)
+            self.write()
+            self.assertIsNone(self.route()) # Both replicas predate the write
+            self.assertIn(self.route(token='Bearer b'), ['replica1', 'replica2']) # Other clients are not held back
+            record_sync('replica2', 1001.0)
+            self.assertEqual({self.route() for _ in range(20)}, {'replica2'})
+
+    def test_replicas_need_a_shared_cache(self):
+        with mock.patch('library.routers.replica_aliases', return_value=['replica1']):
+            with self.assertRaises(ImproperlyConfigured):
+                ReplicaRoutingMiddleware(HttpResponse)
+
+
+class AsyncReadViewTests(TestCase):
+    # The async views have to answer exactly like the DRF views they stand in for
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user('reader', 'reader@example.com', 'password')
+        cls.book = Book.objects.create(title='The Hobbit', author='Tolkien', isbn='9780261103573', genre='Fantasy',
+                                       published_date='1937-09-21', available_copies=2)
+        Book.objects.create(title='Dune', author='Herbert', isbn='9780441013593', genre='Science Fiction', published_date='1965-08-01')
+        Review.objects.create(user=cls.user, book=cls.book, review_text='Second breakfast', rating=5)
+        Notification.objects.create(recipient=cls.user, message='Welcome')
+
+    async def compare(self, async_view_class, path, token=None, **kwargs):
+        headers = {'host': HOST, **({'authorization': bearer(token)} if token else {})}
+        async_view = async_view_class.as_view()
+        sync_view = async_view.view_initkwargs['sync_view']
+        await sync_to_async(cache.clear)()
+        sync_request, async_request = RequestFactory().get(path, headers=headers), AsyncRequestFactory().get(path, headers=headers)
+        async_request.META['HTTP_HOST'] = HOST # AsyncRequestFactory sends its own Host header as well
+        sync_request.resolver_match = async_request.resolver_match = resolve(urlsplit(path).path) # The browsable API links the actions
+        expected = await sync_to_async(sync_view)(sync_request, **kwargs)
+        expected.render()
+        await sync_to_async(cache.clear)()
+        response = await async_view(async_request, **kwargs)
+        response.render()
+        self.assertEqual(response.status_code, expected.status_code, path)
+        csrf_token = re.compile(rb'[A-Za-z0-9]{64}') # The browsable API's, a fresh one per page
+        self.assertEqual(csrf_token.sub(b'', response.content), csrf_token.sub(b'', expected.content), path)
+        for header in ['Content-Type', 'ETag', 'Last-Modified', 'Vary', 'Allow', 'WWW-Authenticate']:
+            self.assertEqual(response.get(header), expected.get(header), f'{header} of {path}')
+        return response
+
+    async def test_books(self):
+        for path in ['/library/books/', '/library/books/?genre=Fantasy&fields=id,title', '/library/books/?ordering=-published_date&page=2',
+                     '/library/books/?pagination=cursor&page_size=1', '/library/books/?format=api']:
+            with self.subTest(path=path):
+                await self.compare(AsyncBookListView, path)
+
+    async def test_book_detail(self):
+        response = await self.compare(AsyncBookDetailView, f'/library/books/{self.book.pk}/', pk=self.book.pk)
+        self.assertEqual(response.status_code, 200)
+        response = await self.compare(AsyncBookDetailView, '/library/books/999/', pk=999)
+        self.assertEqual(response.status_code, 404)
+
+    async def test_reviews(self):
+        await self.compare(AsyncReviewListView, f'/library/reviews/?book={self.book.pk}')
+        await self.compare(AsyncReviewListView, '/library/reviews/?book=999') # Fails validation in the filter
+
+    async def test_notifications_need_a_member(self):
+        response = await self.compare(AsyncNotificationListView, '/library/notifications/')
+        self.assertEqual(response.status_code, 401)
+        response = await self.compare(AsyncNotificationListView, '/library/notifications/', self.user)
+        self.assertEqual(response.status_code, 200)
+
+
+class OpenLoanMigrationTests(TransactionTestCase):
+    # 0011 adds unique_open_loan, which databases with duplicate open loans from before it would fail
+    before = [('library', '0010_book_search_index')]
+    after = [('library', '0011_transaction_unique_open_loan')]
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def tearDown(self):
+        self.migrate(MigrationExecutor(connection).loader.graph.leaf_nodes('library'))
+
+    def test_duplicate_open_loans_are_closed(self):
+        apps = self.migrate(self.before)
+        User, Book, Transaction = [apps.get_model('library', name) for name in ['CustomUser', 'Book', 'Transaction']]
+        user = User.objects.create(username='reader', email='reader@example.com')
+        other = User.objects.create(username='other', email='other@example.com')
+        book = Book.objects.create(title='The Hobbit', author='Tolkien', isbn='9780261103573', genre='Fantasy', published_date='1937-09-21')
+        first, *duplicates = [Transaction.objects.create(user=user, book=book).id for _ in range(3)]
+        others = Transaction.objects.create(user=other, book=book).id
+
+        apps = self.migrate(self.after)
+        Book, Transaction = apps.get_model('library', 'Book'), apps.get_model('library', 'Transaction')
+        self.assertEqual(set(Transaction.objects.filter(return_date__isnull=True).values_list('id', flat=True)), {first, others})
+        for loan in Transaction.objects.filter(id__in=duplicates):
+            self.assertEqual(loan.return_date, loan.checkout_date)
+        self.assertEqual(Book.objects.get().available_copies, 2) # The copies the duplicates took
+
+
+class OverdueScanTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.member = CustomUser.objects.create_user('reader', 'reader@example.com', 'password')
+
+    def lend(self, title, due_in, returned=False):
+        book = Book.objects.create(title=title, author='Author', isbn=f'978{Book.objects.count():010d}', genre='Fantasy', published_date='2000-01-01')
+        return Transaction.objects.create(user=self.member, book=book, expected_return_date=timezone.now() + due_in,
+                                          return_date=timezone.now() if returned else None)
+
+    def scan(self, *args, at=None):
+        stdout = StringIO()
+        with mock.patch.object(timezone, 'now', return_value=at or timezone.now()):
+            call_command('scan_overdue_loans', *args, stdout=stdout)
+        return stdout.getvalue()
+
+    def reminders(self):
+        return sorted(Notification.objects.filter(recipient=self.member).values_list('message', flat=True))
+
+    def test_reminders_go_out_once(self):
+        due_soon = self.lend('Due Soon', timedelta(days=1))
+        overdue = self.lend('Overdue', -timedelta(days=1))
+        self.lend('Due Later', timedelta(days=10))
+        self.lend('Returned', -timedelta(days=1), returned=True)
+
+        output = self.scan()
+        self.assertIn('1 overdue and 1 due-soon reminders sent', output)
+        self.assertEqual([message.split('"')[1] for message in self.reminders()], ['Overdue', 'Due Soon'])
+        self.assertEqual(Transaction.objects.get(pk=due_soon.pk).reminder_stage, Transaction.REMINDER_DUE_SOON)
+        self.assertEqual(Transaction.objects.get(pk=overdue.pk).reminder_stage, Transaction.REMINDER_OVERDUE)
+
+        self.assertIn('0 overdue and 0 due-soon', self.scan())
+        self.assertIn('0 overdue and 0 due-soon', self.scan('--since', '2000-01-01T00:00:00Z')) # Rewound, the claimed stages still hold
+        self.assertEqual(len(self.reminders()), 2)
+
+    def test_watermark_limits_the_scan(self):
+        self.scan()
+        watermark = JobWatermark.get(scan_overdue_loans.WATERMARK)
+        self.assertIsNotNone(watermark)
+        # Due before the last run but never reminded, e.g. its due date was moved back by hand: outside the window
+        self.lend('Moved Back', -timedelta(days=3))
+        self.assertIn('0 overdue and 0 due-soon', self.scan())
+        self.assertGreater(JobWatermark.get(scan_overdue_loans.WATERMARK), watermark)
+        self.assertIn('1 overdue', self.scan('--since', (watermark - timedelta(days=7)).isoformat()))
+
+    def test_dry_run_writes_nothing(self):
+        self.lend('Overdue', -timedelta(days=1))
+        self.assertIn('1 overdue and 0 due-soon reminders would be sent', self.scan('--dry-run'))
+        self.assertEqual(self.reminders(), [])
+        self.assertIsNone(JobWatermark.get(scan_overdue_loans.WATERMARK))
+        self.assertEqual(Transaction.objects.get().reminder_stage, Transaction.REMINDER_NONE)
+
+    def test_due_soon_escalates_to_overdue(self):
+        loan = self.lend('Due Soon', timedelta(days=1))
+        self.scan()
+        self.assertIn('1 overdue and 0 due-soon', self.scan(at=timezone.now() + timedelta(days=2)))
+        self.assertEqual(Transaction.objects.get(pk=loan.pk).reminder_stage, Transaction.REMINDER_OVERDUE)
+        self.assertEqual(len(self.reminders()), 2)
+        self.assertIn('0 overdue and 0 due-soon', self.scan(at=timezone.now() + timedelta(days=3)))
+
+    def test_chunk_boundaries(self):
+        # Loans sharing a due date straddle the chunk edges, each one is still reminded exactly once
+        due = timezone.now() - timedelta(days=1)
+        loans = [self.lend(f'Book {number}', timedelta()) for number in range(7)]
+        Transaction.objects.filter(pk__in=[loan.pk for loan in loans[:5]]).update(expected_return_date=due)
+        for chunk_size in ['1', '2', '3', '7', '100']:
+            with self.subTest(chunk_size=chunk_size):
+                Transaction.objects.update(reminder_stage=Transaction.REMINDER_NONE)
+                Notification.objects.all().delete()
+                self.assertIn('7 overdue and 0 due-soon', self.scan('--chunk-size', chunk_size, '--since', '2000-01-01T00:00:00Z'))
+                self.assertEqual(sorted(message.split('"')[1] for message in self.reminders()), [f'Book {number}' for number in range(7)])
+
+
+class ImportBooksTests(TestCase):
+    def setUp(self):
+        self.book = Book.objects.create(title='Hobbit', author='Tolkien', isbn='9780261103573', genre='Fantasy',
+                                        published_date='1937-09-21', available_copies=2)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = f'{directory.name}/books.csv'
+        with open(self.path, 'w') as books:
+            books.write('title,author,isbn,genre,published_date,available_copies\n'
+                        'The Hobbit,Tolkien,978-0261103573,Fantasy,1937-09-21,10\n'
+                        'Dune,Herbert,9780441013593,Science Fiction,1965-08-01,4\n')
+
+    def copies(self):
+        return dict(Book.objects.values_list('isbn', 'available_copies'))
+
+    def test_existing_books_keep_their_copies(self):
+        call_command('import_books', self.path, stdout=StringIO())
+        self.assertEqual(self.copies(), {'9780261103573': 2, '9780441013593': 4}) # New books take the file's count
+        self.book.refresh_from_db()
+        self.assertEqual(self.book.title, 'The Hobbit')
+
+    def test_overwrite_copies(self):
+        call_command('import_books', self.path, '--overwrite-copies', stdout=StringIO())
+        self.assertEqual(self.copies(), {'9780261103573': 10, '9780441013593': 4})
+
+
+class TrendEpochTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.book = Book.objects.create(title='The Hobbit', author='Tolkien', isbn='9780261103573', genre='Fantasy', published_date='1937-09-21')
+
+    def at(self, *date):
+        return mock.patch('django.utils.timezone.now', return_value=datetime(*date, tzinfo=dt_timezone.utc))
+
+    def checkout(self):
+        with transaction.atomic():
+            books_checked_out.send(sender=Book, book_ids=[self.book.pk])
+
+    def board(self):
+        cache.clear()
+        throttling.reset()
+        return self.client.get('/library/books/trending/', HTTP_HOST=HOST).json()[0]['score']
+
+    def test_rebasing_keeps_the_boards_and_the_weights_finite(self):
+        with self.at(2030, 1, 1):
+            self.checkout()
+            self.checkout()
+            self.assertAlmostEqual(self.board(), 2)
+            call_command('rebuild_trends', '--rebase-only', stdout=StringIO())
+            self.assertAlmostEqual(self.board(), 2)
+            self.assertLess(BookTrend.objects.get().borrow_score, 3)
+        with self.at(2044, 1, 1):
+            with self.assertRaises(OverflowError): # Weighed against 2024 this checkout would not fit in a float
+                BookTrend.borrow_weight(timezone.now(), BookTrend.TREND_EPOCH)
+            call_command('rebuild_trends', '--rebase-only', stdout=StringIO())
+            self.checkout()
+            self.assertAlmostEqual(self.board(), 1) # The 2030 checkouts have long decayed
+
+    def test_rebuild_rebases_on_today(self):
+        with self.at(2030, 1, 1):
+            Transaction.objects.create(user=CustomUser.objects.create_user('reader', 'reader@example.com', 'password'), book=self.book)
+            call_command('rebuild_trends', stdout=StringIO())
+            self.assertEqual(BookTrend.epoch(), timezone.now())
+            self.assertAlmostEqual(BookTrend.objects.get().borrow_score, 1)
+            self.assertAlmostEqual(self.board(), 1)
+
+
+class RecommendationTests(TestCase):
+    def setUp(self):
+        self.books = [Book.objects.create(title=f'Book {n}', author='Tolkien', isbn=f'97802611035{n:02d}', genre='Fantasy',
+                                          published_date='1937-09-21') for n in range(6)]
+        self.members = [CustomUser.objects.create_user(f'member{n}', f'member{n}@example.com', 'password') for n in range(5)]
+        for member, books in [(0, [0, 1, 2]), (1, [1, 2]), (2, [2, 3]), (3, [4, 5])]:
+            for book in books:
+                self.read(member, book)
+
+    def read(self, member, book):
+        Transaction.objects.create(user=self.members[member], book=self.books[book], return_date=timezone.now())
+
+    def build(self, *args):
+        output = StringIO()
+        call_command('build_recommendations', *args, stdout=output)
+        return output.getvalue()
+
+    def stored(self):
+        return list(BookSimilarity.objects.order_by('book_id', 'rank').values_list('book_id', 'similar_id', 'score'))
+
+    def test_incremental_run_loads_only_the_changed_neighbourhood(self):
+        self.build()
+        self.read(1, 3)
+        Review.objects.create(user=self.members[4], book=self.books[0], review_text='Lovely')
+        self.assertIn('4 loaded', self.build()) # Books 4 and 5 only share a member nobody changed
+        incremental = self.stored()
+        self.build('--full')
+        self.assertEqual(incremental, self.stored())
+
+
+class ExportTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.member = CustomUser.objects.create_user('reader', 'reader@example.com', 'password')
+        cls.staff = CustomUser.objects.create_user('librarian', 'librarian@example.com', 'password', is_staff=True)
+        cls.hobbit = Book.objects.create(title='The Hobbit, or There and Back Again', author='Tolkien', isbn='9780261103573', genre='Fantasy',
+                                         published_date='1937-09-21', available_copies=2)
+        cls.dune = Book.objects.create(title='Dune', author='Herbert', isbn='9780441013593', genre='Science Fiction', published_date='1965-08-01')
+        cls.loan = Transaction.objects.create(user=cls.member, book=cls.hobbit)
+        cls.returned = Transaction.objects.create(user=cls.member, book=cls.dune, return_date=timezone.now())
+        cls.review = Review.objects.create(user=cls.member, book=cls.hobbit, review_text='Line one\nline "two"', rating=5)
+
+    def setUp(self):
+        cache.clear()
+        throttling.reset()
+
+    def export(self, path, user=None):
+        headers = {'HTTP_AUTHORIZATION': bearer(user or self.staff)} if user is not False else {}
+        return self.client.get(f'/library/exports/{path}', HTTP_HOST=HOST, **headers)
+
+    def csv_rows(self, path):
+        response = self.export(path)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        return list(csv.reader(b''.join(response.streaming_content).decode().splitlines(keepends=True)))
+
+    def ndjson_rows(self, path):
+        response = self.export(path)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        return [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+
+    def test_staff_only(self):
+        for path in ['books/', 'transactions/', 'reviews/']:
+            with self.subTest(path=path):
+                self.assertEqual(self.export(path, user=False).status_code, 401)
+                self.assertEqual(self.export(path, user=self.member).status_code, 403)
+                self.assertEqual(self.export(path).status_code, 200)
+
+    def test_books(self):
+        rows = self.csv_rows('books/')
+        self.assertEqual(rows[0], ['id', 'title', 'author', 'isbn', 'genre', 'published_date', 'available_copies', 'rating_sum', 'rating_count'])
+        self.assertEqual(rows[1], [str(self.hobbit.pk), 'The Hobbit, or There and Back Again', 'Tolkien', '9780261103573', 'Fantasy',
+                                   '1937-09-21', '2', '5', '1'])
+        self.assertEqual([row[0] for row in rows[1:]], [str(self.hobbit.pk), str(self.dune.pk)])
+
+        rows = self.ndjson_rows('books/?export_format=ndjson&genre=Fantasy')
+        self.assertEqual(rows, [{'id': self.hobbit.pk, 'title': 'The Hobbit, or There and Back Again', 'author': 'Tolkien', 'isbn': '9780261103573',
+                                 'genre': 'Fantasy', 'published_date': '1937-09-21', 'available_copies': 2, 'rating_sum': 5, 'rating_count': 1}])
+
+    def test_transactions(self):
+        rows = self.csv_rows('transactions/')
+        self.assertEqual(rows[0], ['id', 'user_id', 'username', 'book_id', 'book_title', 'book_isbn', 'checkout_date', 'expected_return_date', 'return_date'])
+        loan = Transaction.objects.get(pk=self.loan.pk)
+        self.assertEqual(rows[1], [str(loan.pk), str(self.member.pk), 'reader', str(self.hobbit.pk), self.hobbit.title, '9780261103573',
+                                   loan.checkout_date.isoformat(), loan.expected_return_date.isoformat(), ''])
+        self.assertEqual(len(rows), 3)
+
+        rows = self.ndjson_rows('transactions/?export_format=ndjson&return_date__isnull=false')
+        returned = Transaction.objects.get(pk=self.returned.pk)
+        self.assertEqual([(row['id'], row['book_title'], row['return_date']) for row in rows], [(returned.pk, 'Dune', returned.return_date.isoformat())])
+
+    def test_reviews(self):
+        review = Review.objects.get(pk=self.review.pk)
+        expected = [str(review.pk), str(self.hobbit.pk), self.hobbit.title, str(self.member.pk), 'reader', '5', 'Line one\nline "two"',
+                    review.created_at.isoformat(), review.updated_at.isoformat()]
+        rows = self.csv_rows('reviews/')
+        self.assertEqual(rows[0], ['id', 'book_id', 'book_title', 'user_id', 'username', 'rating', 'review_text', 'created_at', 'updated_at'])
+        self.assertEqual(rows[1:], [expected]) # The quotes and the line break survive the round trip
+
+        rows = self.ndjson_rows(f'reviews/?export_format=ndjson&book={self.hobbit.pk}')
+        self.assertEqual(rows, [dict(zip(['id', 'book_id', 'book_title', 'user_id', 'username', 'rating', 'review_text', 'created_at', 'updated_at'],
+                                         [review.pk, self.hobbit.pk, self.hobbit.title, self.member.pk, 'reader', 5, review.review_text,
+                                          *expected[-2:]]))])
+
+    def test_unknown_format(self):
+        response = self.export('books/?export_format=xml')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'error': 'export_format must be csv or ndjson'})
+
+    def test_rows_stream_in_chunks(self):
+        Book.objects.bulk_create(Book(title=f'Book {number}', author='Author', isbn=f'978{number:010d}', genre='Fantasy',
+                                      published_date='2000-01-01') for number in range(23))
+        expected = list(Book.objects.order_by('id').values_list('id', flat=True))
+        with mock.patch.object(BookExportView, 'chunk_size', 5):
+            with CaptureQueriesContext(connection) as context:
+                response = self.export('books/?export_format=ndjson')
+            self.assertFalse([query for query in context.captured_queries if 'FROM "library_book"' in query['sql']]) # Nothing read yet
+            lines = iter(response.streaming_content)
+            self.assertEqual(json.loads(next(lines))['id'], expected[0])
+            self.assertEqual([json.loads(line)['id'] for line in lines], expected[1:])
+
+
+class MetricsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.book = Book.objects.create(title='The Hobbit', author='Tolkien', isbn='9780261103573', genre='Fantasy', published_date='1937-09-21')
+        cls.member = CustomUser.objects.create_user('reader', 'reader@example.com', 'password')
+        cls.staff = CustomUser.objects.create_user('librarian', 'librarian@example.com', 'password', is_staff=True)
+
+    def setUp(self):
+        cache.clear()
+        throttling.reset()
+        metrics.reset()
+
+    def scrape(self, user=None):
+        headers = {'HTTP_AUTHORIZATION': bearer(user)} if user else {}
+        return self.client.get('/metrics', HTTP_HOST=HOST, **headers)
+
+    def samples(self, text):
+        # {'name{labels}': value} for every sample line of the Prometheus text
+        return {line.rsplit(' ', 1)[0]: float(line.rsplit(' ', 1)[1]) for line in text.splitlines() if line and not line.startswith('#')}
+
+    def queries_of(self, endpoint):
+        return metrics._endpoints[(endpoint, 'GET')].queries
+
+    def test_counts_queries_under_wsgi(self):
+        self.assertEqual(self.client.get('/library/books/', HTTP_HOST=HOST).status_code, 200)
+        self.assertGreater(self.queries_of('books-list'), 0)
+
+    async def test_counts_queries_under_asgi(self):
+        # The queries run on the thread sync_to_async hands the request's sync work to, not the event loop's
+        response = await AsyncClient().get('/library/books/', HTTP_HOST=HOST)
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(self.queries_of('books-list'), 0)
+
+    def test_staff_only(self):
+        self.assertEqual(self.scrape().status_code, 401)
+        self.assertEqual(self.scrape(self.member).status_code, 403)
+        response = self.scrape(self.staff)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+
+    def test_counters_per_route(self):
+        for path in ['/library/books/', '/library/books/', f'/library/books/{self.book.pk}/', '/library/books/999/', '/nowhere/']:
+            self.client.get(path, HTTP_HOST=HOST)
+        text = self.scrape(self.staff).content.decode()
+        samples = self.samples(text)
+
+        self.assertIn('# TYPE librov_http_requests_total counter', text)
+        self.assertEqual(samples['librov_http_requests_total{endpoint="books-list",method="GET",status="200"}'], 2)
+        self.assertEqual(samples['librov_http_requests_total{endpoint="books-detail",method="GET",status="200"}'], 1)
+        self.assertEqual(samples['librov_http_requests_total{endpoint="books-detail",method="GET",status="404"}'], 1)
+        self.assertEqual(samples['librov_http_requests_total{endpoint="unmatched",method="GET",status="404"}'], 1)
+
+        self.assertIn('# TYPE librov_db_queries_per_request histogram', text)
+        labels = 'endpoint="books-list",method="GET"'
+        self.assertEqual(samples[f'librov_db_queries_per_request_count{{{labels}}}'], 2)
+        self.assertEqual(samples[f'librov_db_queries_per_request_sum{{{labels}}}'], self.queries_of('books-list'))
+        self.assertEqual(samples[f'librov_db_queries_per_request_bucket{{{labels},le="+Inf"}}'], 2)
+        self.assertEqual(samples[f'librov_http_request_duration_seconds_count{{{labels}}}'], 2)
+        self.assertIn(f'librov_db_query_duration_seconds_total{{{labels}}}', samples)
+        self.assertNotIn('endpoint="metrics"', text) # A scrape is counted once it has been rendered
+
+
+class RatingAggregateTests(TestCase):
+    # The totals on Book against the reviews they summarise, after each way a review can change
+    @classmethod
+    def setUpTestData(cls):
+        cls.hobbit = Book.objects.create(title='The Hobbit', author='Tolkien', isbn='9780261103573', genre='Fantasy', published_date='1937-09-21')
+        cls.dune = Book.objects.create(title='Dune', author='Herbert', isbn='9780441013593', genre='Science Fiction', published_date='1965-08-01')
+        cls.readers = [CustomUser.objects.create_user(f'reader{number}', f'reader{number}@example.com', 'password') for number in range(3)]
+
+    def setUp(self):
+        cache.clear()
+        throttling.reset()
+
+    def request(self, method, path, user, data=None):
+        response = getattr(self.client, method)(path, data, content_type='application/json', HTTP_HOST=HOST, HTTP_AUTHORIZATION=bearer(user))
+        self.assertLess(response.status_code, 300, response.content)
+        return response
+
+    def review(self, user, book, rating):
+        return self.request('post', '/library/reviews/', user, {'book': book.pk, 'review_text': 'Read it', 'rating': rating}).json()
+
+    def assertRatings(self, book, ratings):
+        book.refresh_from_db()
+        self.assertEqual((book.rating_sum, book.rating_count), (sum(ratings), len(ratings)))
+        self.assertEqual(book.rating_histogram, {rating: ratings.count(rating) for rating in range(1, 6)})
+        average = round(sum(ratings) / len(ratings), 2) if ratings else None
+        cache.clear() # The cached page is only dropped on commit, which never comes inside a TestCase
+        self.assertEqual(self.client.get(f'/library/books/{book.pk}/', HTTP_HOST=HOST).json()['average_rating'], average)
+
+    def test_new_reviews(self):
+        self.review(self.readers[0], self.hobbit, 5)
+        self.review(self.readers[1], self.hobbit, 2)
+        self.assertRatings(self.hobbit, [5, 2])
+        self.assertRatings(self.dune, [])
+
+    def test_rating_changed(self):
+        review = self.review(self.readers[0], self.hobbit, 5)
+        self.review(self.readers[1], self.hobbit, 4)
+        self.request('patch', f'/library/reviews/{review["id"]}/', self.readers[0], {'rating': 1})
+        self.assertRatings(self.hobbit, [1, 4])
+        self.request('patch', f'/library/reviews/{review["id"]}/', self.readers[0], {'review_text': 'Still a 1'}) # The rating stays put
+        self.assertRatings(self.hobbit, [1, 4])
+
+    def test_reviewing_the_same_book_again(self):
+        # The second POST updates the member's review rather than adding one
+        first = self.review(self.readers[0], self.hobbit, 3)
+        second = self.review(self.readers[0], self.hobbit, 5)
+        self.assertEqual(first['id'], second['id'])
+        self.assertRatings(self.hobbit, [5])
+
+    def test_review_deleted(self):
+        review = self.review(self.readers[0], self.hobbit, 5)
+        self.review(self.readers[1], self.hobbit, 2)
+        self.request('delete', f'/library/reviews/{review["id"]}/', self.readers[0])
+        self.assertRatings(self.hobbit, [2])
+
+    def test_review_moved_to_another_book(self):
+        review = Review.objects.get(pk=self.review(self.readers[0], self.hobbit, 4)['id'])
+        review.book = self.dune
+        review.save()
+        self.assertRatings(self.hobbit, [])
+        self.assertRatings(self.dune, [4])
+
+    def test_reviews_not_read_from_the_database(self):
+        # Saved from an instance built by hand, or with the rating deferred, the stored rating is looked up first
+        review = Review.objects.get(pk=self.review(self.readers[0], self.hobbit, 4)['id'])
+        Review(pk=review.pk, book=self.hobbit, user=self.readers[0], review_text='Rewritten', rating=2, created_at=review.created_at).save()
+        self.assertRatings(self.hobbit, [2])
+
+        deferred = Review.objects.only('review_text').get(pk=review.pk)
+        deferred.rating = 3
+        deferred.save()
+        self.assertRatings(self.hobbit, [3])
+
+    def test_aggregates_match_a_rebuild(self):
+        for reader, rating in zip(self.readers, [5, 3, 3]):
+            self.review(reader, self.hobbit, rating)
+        self.review(self.readers[0], self.hobbit, 1)
+        Review.objects.filter(user=self.readers[1]).delete()
+        totals = list(Book.objects.order_by('id').values_list('rating_sum', 'rating_count', *(f'rating_{rating}_count' for rating in range(1, 6))))
+        call_command('rebuild_rating_aggregates', stdout=StringIO())
+        self.assertEqual(list(Book.objects.order_by('id').values_list('rating_sum', 'rating_count', *(f'rating_{rating}_count' for rating in range(1, 6)))), totals)
+
+
+class RatingRepairTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.book = Book.objects.create(title='The Hobbit', author='Tolkien', isbn='9780261103573', genre='Fantasy', published_date='1937-09-21')
+        Review.objects.create(user=CustomUser.objects.create_user('reader', 'reader@example.com', 'password'), book=cls.book,
+                              review_text='Second breakfast', rating=4)
+
+    def setUp(self):
+        cache.clear()
+        throttling.reset()
+
+    def get(self, **headers):
+        return self.client.get(f'/library/books/{self.book.pk}/', HTTP_HOST=HOST, **headers)
+
+    def test_repair_moves_the_book_version(self):
+        Book.objects.filter(pk=self.book.pk).update(rating_sum=40, rating_count=4) # Drifted, e.g. by a raw SQL fix
+        etag = self.get()['ETag']
+        call_command('rebuild_rating_aggregates', stdout=StringIO())
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_repair_drops_cached_pages(self):
+        Book.objects.filter(pk=self.book.pk).update(rating_sum=40, rating_count=4)
+        self.assertEqual(self.get().json()['average_rating'], 10)
+        with self.captureOnCommitCallbacks(execute=True): # The cached pages go once the repair is committed
+            call_command('rebuild_rating_aggregates', stdout=StringIO())
+        self.assertEqual(self.get().json()['average_rating'], 4)
+
+
+class BatchTransactionTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.member = CustomUser.objects.create_user('reader', 'reader@example.com', 'password')
+        cls.hobbit = Book.objects.create(title='The Hobbit', author='Tolkien', isbn='9780261103573', genre='Fantasy',
+                                         published_date='1937-09-21', available_copies=2)
+        cls.dune = Book.objects.create(title='Dune', author='Herbert', isbn='9780441013593', genre='Science Fiction',
+                                       published_date='1965-08-01', available_copies=0)
+
+    def setUp(self):
+        cache.clear()
+        throttling.reset()
+
+    def batch(self, method, data):
+        return getattr(self.client, method)('/library/transactions/batch/', data, content_type='application/json',
+                                            HTTP_HOST=HOST, HTTP_AUTHORIZATION=bearer(self.member))
+
+    def copies(self):
+        return dict(Book.objects.values_list('title', 'available_copies'))
+
+    def test_some_books_unavailable(self):
+        response = self.batch('post', {'book_ids': [self.hobbit.pk, self.dune.pk]})
+        self.assertEqual(response.status_code, 207)
+        hobbit, dune = response.json()['results']
+        self.assertEqual((hobbit['book_id'], hobbit['status']), (self.hobbit.pk, 'checked_out'))
+        self.assertEqual(dune, {'book_id': self.dune.pk, 'status': 'failed', 'error': 'Book is currently unavailable'})
+        self.assertEqual(self.copies(), {'The Hobbit': 1, 'Dune': 0})
+
+    def test_all_or_nothing_rolls_everything_back(self):
+        response = self.batch('post', {'book_ids': [self.hobbit.pk, self.dune.pk], 'all_or_nothing': True})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual([result['status'] for result in response.json()['results']], ['failed', 'failed'])
+        self.assertEqual(self.copies(), {'The Hobbit': 2, 'Dune': 0})
+        self.assertFalse(Transaction.objects.exists())
+
+    def test_repeated_ids_are_returned_once(self):
+        loan = self.batch('post', {'book_ids': [self.hobbit.pk, self.hobbit.pk]}).json()['results'][0]['transaction']
+        response = self.batch('patch', {'transaction_ids': [loan['id'], loan['id']]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([result['status'] for result in response.json()['results']], ['returned'])
+        self.assertEqual(self.copies()['The Hobbit'], 2) # One copy back, not two
+
+    def test_conflicts_are_retried(self):
+        attempts = []
+        checkout = TransactionViewset._batch_checkout
+        def conflict_once(view, *args):
+            attempts.append(args)
+            if len(attempts) == 1:
+                raise BatchConflict() # As when a copy went between the read and the update
+            return checkout(view, *args)
+        with mock.patch.object(TransactionViewset, '_batch_checkout', conflict_once):
+            response = self.batch('post', {'book_ids': [self.hobbit.pk]})
+        self.assertEqual((response.status_code, len(attempts)), (201, 2))
+        self.assertEqual(self.copies()['The Hobbit'], 1) # Taken once, by the attempt that went through
+        with mock.patch.object(TransactionViewset, '_batch_checkout', side_effect=BatchConflict):
+            self.assertEqual(self.batch('post', {'book_ids': [self.dune.pk]}).status_code, 409) # Gives up after batch_attempts
+
+    def test_item_limit(self):
+        response = self.batch('post', {'book_ids': list(range(1, MAX_BATCH_SIZE + 2))})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('book_ids', response.json())
+        self.assertEqual(self.batch('patch', {'transaction_ids': list(range(1, MAX_BATCH_SIZE + 2))}).status_code, 400)
@@ -0,0 +1,247 @@
+import asyncio
+import itertools
+import math
+import os
+import sqlite3
+import threading
+import time
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.http import JsonResponse
+from rest_framework.settings import api_settings
+from rest_framework.throttling import BaseThrottle
+
+
+# Rate limits as token buckets. A bucket holds up to <num> tokens of a '<num>/<period>' rate and refills
+# continuously, so a client can burst to <num> requests and then gets <num> per period. Buckets live in their own
+# SQLite file, THROTTLE_DATABASE, which every worker process on the host shares. Taking a token is a single
+# INSERT ... ON CONFLICT DO UPDATE ... RETURNING, so two workers racing on one bucket can't both take its last token.
+# Buckets of a hundred tokens or more hand a process a few tokens at a time, which it gives out to that client's next
+# requests without the database. Tokens a process doesn't give out in time are lost, never handed out twice.
+# A bucket only gains tokens with time, so once it turns a client away the process knows it stays empty until the
+# next token is due. Until then the client's requests to views using that bucket get a 429 without the database,
+# and without taking tokens from the view's other buckets either, the request is turned away whatever they hold.
+
+PERIODS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+PURGE_EVERY = 1000 # Requests per process between deleting buckets that have filled up again
+
+LEASE_FRACTION = 20 # A process takes up to 1/20th of a bucket at a time, buckets under 40 tokens are taken one by one
+
+_local = threading.local() # One connection per thread, sqlite3 connections can't be shared
+_calls = itertools.count()
+_empty_until = {} # bucket key -> when its next token is due, as last seen by this process
+_leased = {} # bucket key -> (tokens this process took but hasn't given out yet, until when it may)
+_leased_lock = threading.Lock()
+
+TAKE_TOKEN = """
+    INSERT INTO bucket (key, tokens, updated, expires, granted) VALUES (:key, :capacity - :want, :now, :expires, :want)
+    ON CONFLICT (key) DO UPDATE SET
+        granted = min(:want, CAST(min(:capacity, tokens + (:now - updated) * :rate) AS INTEGER)),
+        tokens = min(:capacity, tokens + (:now - updated) * :rate) - min(:want, CAST(min(:capacity, tokens + (:now - updated) * :rate) AS INTEGER)),
+        updated = :now,
+        expires = :expires
+    RETURNING granted, tokens
+"""
+
+
+def parse_rate(rate):
+    # '30/min' -> (30, 60), the period is read from its first letter like DRF does
+    num, period = rate.split('/')
+    return int(num), PERIODS[period[0]]
+
+
+def connection():
+    # A new connection after a fork too, a forked worker must not use its parent's
+    key = (str(settings.THROTTLE_DATABASE), os.getpid())
+    if getattr(_local, 'key', None) != key:
+        db = sqlite3.connect(key[0], timeout=5, isolation_level=None)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=OFF') # Losing the last few buckets in a crash only lets a few requests through
+        db.execute('CREATE TABLE IF NOT EXISTS bucket (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL, '
+                   'expires REAL NOT NULL, granted INTEGER NOT NULL) WITHOUT ROWID')
+        db.execute('CREATE INDEX IF NOT EXISTS bucket_expires_idx ON bucket (expires)')
+        _local.db, _local.key = db, key
+    return _local.db
+
+
+def reset():
+    connection().execute('DELETE FROM bucket')
+    _empty_until.clear()
+    _leased.clear()
+
+
+class TokenBucketThrottle(BaseThrottle):
+    # Takes its rate from DEFAULT_THROTTLE_RATES by scope: its own scope when a subclass sets one, otherwise the
+    # view's throttle_scope, the way DRF's ScopedRateThrottle does. Views without either aren't limited by it
+    timer = time.time # Wall clock, the buckets are shared between processes
+    scope = None
+
+    def get_scope(self, request, view):
+        return self.scope or getattr(view, 'throttle_scope', None)
+
+    def get_ident_key(self, request):
+        if request.user and request.user.is_authenticated:
+            return f'user:{request.user.pk}'
+        return f'ip:{self.get_ident(request)}'
+
+    def get_bucket(self, request, view):
+        # (key, rate) of the bucket this request takes a token from, None when the view isn't limited by this throttle
+        scope = self.get_scope(request, view)
+        rate = api_settings.DEFAULT_THROTTLE_RATES.get(scope) if scope else None
+        if rate is None:
+            return None
+        return f'{scope}:{self.get_ident_key(request)}', rate
+
+    def known_empty_until(self, request, view, now):
+        # The latest time one of the view's buckets is known to be empty until, or None
+        untils = [_empty_until.get(bucket[0], now) for bucket in (
+            throttle.get_bucket(request, view) for throttle in view.get_throttles() if isinstance(throttle, TokenBucketThrottle)
+        ) if bucket]
+        return max(untils) if untils and max(untils) > now else None
+
+    def allow_request(self, request, view):
+        bucket = self.get_bucket(request, view)
+        if bucket is None:
+            return True
+        key, rate = bucket
+        capacity, period = parse_rate(rate)
+        now = self.timer()
+        empty_until = self.known_empty_until(request, view, now)
+        if empty_until is not None:
+            self.wait_seconds = empty_until - now
+            return False
+        with _leased_lock:
+            leased, until = _leased.get(key, (0, now))
+            if leased and now < until:
+                _leased[key] = (leased - 1, until)
+                return True
+        want = max(1, capacity // LEASE_FRACTION)
+        db = connection()
+        granted, tokens = db.execute(TAKE_TOKEN, {
+            'key': key, 'capacity': capacity, 'rate': capacity / period, 'want': want,
+            'now': now, 'expires': now + period, # An untouched bucket is full again after a period, then it can go
+        }).fetchone()
+        if next(_calls) % PURGE_EVERY == 0:
+            db.execute('DELETE FROM bucket WHERE expires < ?', (now,))
+            for stale in [other for other, until in list(_empty_until.items()) if until <= now]:
+                _empty_until.pop(stale, None)
+            for stale in [other for other, (_, until) in list(_leased.items()) if until <= now]:
+                _leased.pop(stale, None)
+        if not granted:
+            self.wait_seconds = (1 - tokens) * period / capacity
+            _empty_until[key] = now + self.wait_seconds
+            return False
+        if granted > 1:
+            # The rest is ours for as long as the bucket takes to earn it back, then it is as if it had stayed there
+            with _leased_lock:
+                _leased[key] = (granted - 1, now + (granted - 1) * period / capacity)
+        return True
+
+    def wait(self):
+        return self.wait_seconds
+
+
+class UserTokenBucketThrottle(TokenBucketThrottle):
+    # Every request, by member ('user' rate) or by IP address for anonymous clients ('anon' rate)
+    def get_scope(self, request, view):
+        return 'user' if request.user and request.user.is_authenticated else 'anon'
+
+
+class EndpointTokenBucketThrottle(TokenBucketThrottle):
+    # A separate, usually tighter bucket per client for views that set throttle_scope, e.g. checkout or token
+    pass
+
+
+class LoadSheddingMiddleware:
+    # Caps the requests this process handles at once at MAX_CONCURRENT_REQUESTS. Up to MAX_QUEUED_REQUESTS more
+    # wait for a slot for at most QUEUE_TIMEOUT_SECONDS, anything past that gets a 503 with Retry-After straight
+    # away, while it is still cheap to turn away. A streamed response gives its slot back once streaming starts.
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.limit = settings.MAX_CONCURRENT_REQUESTS
+        self.queue = settings.MAX_QUEUED_REQUESTS
+        self.timeout = settings.QUEUE_TIMEOUT_SECONDS
+        self.condition = threading.Condition()
+        self.active = self.waiting = 0
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        if not self.limit or request.path in settings.LOAD_SHEDDING_EXEMPT_PATHS:
+            return self.get_response(request)
+        if not self.enter():
+            return self.shed()
+        try:
+            return self.get_response(request)
+        finally:
+            self.leave()
+
+    async def __acall__(self, request):
+        if not self.limit or request.path in settings.LOAD_SHEDDING_EXEMPT_PATHS:
+            return await self.get_response(request)
+        if not await self.aenter():
+            return self.shed()
+        try:
+            return await self.get_response(request)
+        finally:
+            self.leave()
+
+    def admit(self):
+        # True when the request can run now, None when it has to queue, False when the queue is full too
+        if self.active < self.limit:
+            self.active += 1
+            return True
+        if self.waiting >= self.queue:
+            return False
+        return None
+
+    def enter(self):
+        with self.condition:
+            admitted = self.admit()
+            if admitted is not None:
+                return admitted
+            self.waiting += 1
+            try:
+                if not self.condition.wait_for(lambda: self.active < self.limit, self.timeout):
+                    return False
+                self.active += 1
+                return True
+            finally:
+                self.waiting -= 1
+
+    async def aenter(self):
+        # The event loop can't block on the condition, so queued requests check back every few milliseconds
+        with self.condition:
+            admitted = self.admit()
+            if admitted is not None:
+                return admitted
+            self.waiting += 1
+        deadline = time.monotonic() + self.timeout
+        try:
+            while time.monotonic() < deadline:
+                await asyncio.sleep(0.005)
+                with self.condition:
+                    if self.active < self.limit:
+                        self.active += 1
+                        return True
+            return False
+        finally:
+            with self.condition:
+                self.waiting -= 1
+
+    def leave(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+    def shed(self):
+        response = JsonResponse({'detail': 'The server is busy, try again shortly.'}, status=503)
+        response['Retry-After'] = str(math.ceil(self.timeout))
+        return response
@@ -1,10 +1,14 @@
+from django.conf import settings
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from rest_framework_simplejwt.views import TokenObtainPairView,TokenRefreshView
+from rest_framework_simplejwt.views import TokenRefreshView
 from .views import(
      BookViewSet,TransactionViewset,NotificationListView,
      NotificationCreateView, UserProfileView, UserRegistrationView,
-     Reviews, BookRequestView, GeneralNotificationView
+     Reviews, BookRequestView, GeneralNotificationView, ProfileTransactionListView,
+     BookExportView, TransactionExportView, ReviewExportView,
+     AsyncBookListView, AsyncBookDetailView, AsyncReviewListView, AsyncNotificationListView, TokenObtainView,
+     ProfileRecommendationView, HoldListCreateView, HoldCancelView
 )
 
 router = DefaultRouter()
@@ -16,16 +20,41 @@ transaction_view = TransactionViewset.as_view({
     'patch': 'return_book'
 })
 
+batch_transaction_view = TransactionViewset.as_view({
+    'post': 'batch_create',
+    'patch': 'batch_return'
+})
+
 
 urlpatterns = [
-    path('token/', TokenObtainPairView.as_view(), name="obtain_token"),
+    path('token/', TokenObtainView.as_view(), name="obtain_token"),
     path('token/refresh/', TokenRefreshView.as_view(), name="refresh_token"),
     path('', include(router.urls)),
     path('transactions/', transaction_view, name='transactions'),
+    path('transactions/batch/', batch_transaction_view, name='batch-transactions'),
+    path('holds/', HoldListCreateView.as_view(), name='holds'),
+    path('holds/<int:pk>/', HoldCancelView.as_view(), name='hold-cancel'),
     path('profile/', UserProfileView.as_view(), name='profile'),
+    path('profile/transactions/', ProfileTransactionListView.as_view(), name='profile-transactions'),
+    path('profile/notifications/', NotificationListView.as_view(), name='profile-notifications'),
+    path('profile/recommendations/', ProfileRecommendationView.as_view(), name='profile-recommendations'),
     path('register/', UserRegistrationView.as_view(), name='register'),
     path('requests/', BookRequestView.as_view(), name='book-requests'),
     path('notifications/', NotificationListView.as_view(), name='user-notifications'),
     path('notifications/create/', NotificationCreateView.as_view(), name='create_notifications'),
-    path('notifications/general/', GeneralNotificationView.as_view(), name='general-notifications')
+    path('notifications/general/', GeneralNotificationView.as_view(), name='general-notifications'),
+    path('exports/books/', BookExportView.as_view(), name='export-books'),
+    path('exports/transactions/', TransactionExportView.as_view(), name='export-transactions'),
+    path('exports/reviews/', ReviewExportView.as_view(), name='export-reviews'),
 ]
+
+if settings.ASYNC_READ_VIEWS:
+    # With LIBROV_ASYNC_VIEWS=1 the busiest reads are served by the async views, on the same URLs and names as the
+    # routes they stand in for. <int:pk> so that books/cache-stats/ still reaches the router
+    urlpatterns = [
+        path('books/', AsyncBookListView.as_view(), name='books-list'),
+        path('books/<int:pk>/', AsyncBookDetailView.as_view(), name='books-detail'),
+        path('reviews/', AsyncReviewListView.as_view(), name='review-list'),
+        path('profile/notifications/', AsyncNotificationListView.as_view(), name='profile-notifications'),
+        path('notifications/', AsyncNotificationListView.as_view(), name='user-notifications'),
+    ] + urlpatterns
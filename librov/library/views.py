@@ -1,79 +1,383 @@
-from rest_framework import viewsets, status, generics, permissions, views
+from rest_framework import viewsets, status, generics, permissions, views, exceptions
 from rest_framework.response import Response
-from .models import Book, Transaction, Notification, CustomUser, Review, BookRequest
+from .models import Book, Transaction, Notification, CustomUser, Review, BookRequest, BroadcastNotification, BroadcastReceipt, ResourceVersion, BookSimilarity, BookTrend, Hold
 from .serializers import(
      BookSerializer, ReviewSerializer, TransactionSerializer,
      NotificationSerializer, UserProfileSerializer,
-     UserRegistrationSerializer, BookRequestSerializer, GeneralNotificationSerializer
+     UserRegistrationSerializer, BookRequestSerializer, GeneralNotificationSerializer,
+     BatchCheckoutSerializer, BatchReturnSerializer, NotificationFeedSerializer, ScoredBookSerializer,
+     HoldSerializer
 )
 from .permissions import IsStaffOrReadOnly, IsAuthorOrReadOnly
-import datetime
+from .search import BookSearchFilter
+from .signals import book_copies_changed, books_checked_out
+from .cache import catalog_cache, response_cache_key, record, stats as cache_stats
+from . import metrics
+from .routers import use_primary
+from .holds import hand_off_shelved_copy, release_copies
+from django.conf import settings
+from rest_framework.decorators import action
 from rest_framework.generics import RetrieveAPIView
 from django.shortcuts import render
-from rest_framework_simplejwt.tokens import RefreshToken
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.views import View
+from django.core.exceptions import ValidationError as DjangoValidationError
+from asgiref.sync import sync_to_async
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date, quote_etag
+import csv
+import hashlib
+import json
+from .authentication import LibraryRefreshToken
+from rest_framework_simplejwt.views import TokenObtainPairView
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework.filters import SearchFilter, OrderingFilter
 from rest_framework import serializers
 
 
 
-class BookViewSet(viewsets.ModelViewSet):
+class SparseFieldsetMixin:
+    # Trims reads down to what ?fields= / ?omit= leave in the serializer (see DynamicFieldsMixin). Writes always load whole rows.
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        if self.request.method in permissions.SAFE_METHODS:
+            queryset = self.get_serializer().optimize_queryset(queryset)
+        return queryset
+    
+    
+class ConditionalGetMixin:
+    # ETag and Last-Modified for list and detail reads, built from ResourceVersion alone. A client sending back
+    # If-None-Match / If-Modified-Since gets a 304 before the books or reviews tables are queried at all.
+    version_collection = None # e.g. 'books'
+    version_item = None # e.g. 'book', detail reads use the key 'book:<pk>'
+    
+    def list(self, request, *args, **kwargs):
+        return self.conditional_response(request, self.version_key(kwargs), super().list, *args, **kwargs)
+    
+    def retrieve(self, request, *args, **kwargs):
+        return self.conditional_response(request, self.version_key(kwargs), super().retrieve, *args, **kwargs)
+    
+    def version_key(self, kwargs):
+        pk = kwargs.get(self.lookup_url_kwarg or self.lookup_field)
+        return self.version_collection if pk is None else f'{self.version_item}:{pk}'
+    
+    def conditional_response(self, request, key, handler, *args, **kwargs):
+        etag, last_modified, not_modified = self.check_validators(request, key, ResourceVersion.lookup(key).get(key))
+        if not_modified is not None:
+            return not_modified
+        return self.add_validators(handler(request, *args, **kwargs), etag, last_modified)
+    
+    def check_validators(self, request, key, stamp):
+        version = stamp.version if stamp else 0
+        # The body also depends on the query string (filters, fields, page) and on the renderer picked
+        signature = f'{key}:{version}:{request.get_full_path()}:{request.accepted_media_type}'
+        etag = quote_etag(hashlib.md5(signature.encode()).hexdigest())
+        last_modified = int(stamp.updated_at.timestamp()) if stamp else None
+        return etag, last_modified, get_conditional_response(request._request, etag=etag, last_modified=last_modified)
+    
+    def add_validators(self, response, etag, last_modified):
+        if response.status_code == status.HTTP_200_OK:
+            response['ETag'] = etag
+            if last_modified is not None:
+                response['Last-Modified'] = http_date(last_modified)
+            patch_vary_headers(response, ['Accept'])
+        return response
+    
+    
+class CatalogCacheMixin:
+    # Serves list and detail reads from the response cache in library/cache.py. The serialized data is cached
+    # rather than the rendered response, so JSON and the browsable API share entries.
+    def list(self, request, *args, **kwargs):
+        return self.cached_response(request, self.cache_generation(kwargs), super().list, *args, **kwargs)
+    
+    def retrieve(self, request, *args, **kwargs):
+        return self.cached_response(request, self.cache_generation(kwargs), super().retrieve, *args, **kwargs)
+    
+    def cache_generation(self, kwargs):
+        pk = kwargs.get(self.lookup_url_kwarg or self.lookup_field)
+        return 'books' if pk is None else f'book:{pk}'
+    
+    def cached_response(self, request, generation_name, handler, *args, **kwargs):
+        key, data = self.cache_lookup(request, generation_name)
+        if data is not None:
+            return Response(data)
+        with use_primary(): # A lagging replica's rows would be cached under the new generation and outlive the sync
+            response = handler(request, *args, **kwargs)
+        return self.cache_store(key, response)
+    
+    def cache_lookup(self, request, generation_name):
+        key = response_cache_key(request, generation_name)
+        data = catalog_cache().get(key)
+        record(hit=data is not None)
+        return key, data
+    
+    def cache_store(self, key, response):
+        if response.status_code == status.HTTP_200_OK:
+            catalog_cache().set(key, response.data, settings.CATALOG_CACHE_TIMEOUT)
+        return response
+    
+    
+class BookViewSet(ConditionalGetMixin, CatalogCacheMixin, SparseFieldsetMixin, viewsets.ModelViewSet):
     permission_classes = [IsStaffOrReadOnly] # This is a custom permission I created so that only staff can add, edit, or delete books
     queryset = Book.objects.all()
     serializer_class = BookSerializer
-    filter_backends = [DjangoFilterBackend, SearchFilter, OrderingFilter]
+    filter_backends = [DjangoFilterBackend, BookSearchFilter, OrderingFilter] # BookSearchFilter is SearchFilter plus ?search_mode=fts for the full-text index
     filterset_fields = ['title', 'author', 'isbn', 'available_copies', 'genre']
     search_fields = ['title', 'author', 'isbn', 'genre']
     ordering_fields = ['title', 'published_date']
+    cursor_ordering = 'id' # What ?pagination=cursor pages on when no ordering is given
+    version_collection = 'books'
+    version_item = 'book'
+    
+    @action(detail=False, url_path='cache-stats', permission_classes=[permissions.IsAdminUser])
+    def cache_stats(self, request):
+        return Response(cache_stats())
+    
+    @action(detail=False, authentication_classes=[], permission_classes=[permissions.AllowAny])
+    def availability(self, request):
+        # Copies on the shelf for a whole reading list in one query: ?ids=1,2,3 or ?isbns=978...,978..., up to
+        # AVAILABILITY_MAX_ITEMS. Public and without authentication, so a shared cache can keep it for a little while.
+        # Books that don't exist come back as null
+        lookup = 'isbn' if 'isbns' in request.query_params else 'id'
+        keys = [key.strip() for key in request.query_params.get(f'{lookup}s', '').split(',') if key.strip()]
+        if not keys:
+            raise exceptions.ValidationError({'ids': 'Send ?ids= or ?isbns=, separated by commas'})
+        if len(keys) > settings.AVAILABILITY_MAX_ITEMS:
+            raise exceptions.ValidationError({f'{lookup}s': f'At most {settings.AVAILABILITY_MAX_ITEMS} at a time'})
+        if lookup == 'id':
+            # ASCII digits only, isdigit() alone lets superscripts through. Past a signed 64-bit integer the database
+            # can't compare them
+            if not all(key.isascii() and key.isdigit() and int(key) < 2 ** 63 for key in keys):
+                raise exceptions.ValidationError({'ids': 'Book ids are whole numbers'})
+            keys = [int(key) for key in keys]
+        # ISBNs are answered as sent and looked up the way import_books stores them, without dashes or spaces
+        stored = {key: Book.normalize_isbn(key) if lookup == 'isbn' else key for key in keys}
+        found = dict(Book.objects.filter(**{f'{lookup}__in': set(stored.values())}).values_list(lookup, 'available_copies'))
+        response = Response({'availability': {key: found.get(stored[key]) for key in keys}})
+        response['Cache-Control'] = f'public, max-age={settings.AVAILABILITY_MAX_AGE}'
+        return response
+    
+    trending_boards = {'borrowed': 'borrow_score', 'rated': 'rating_score'}
+    
+    @action(detail=False, serializer_class=ScoredBookSerializer)
+    def trending(self, request):
+        # ?board=borrowed (default) or rated, ?genre= for one genre's board, ?limit= up to 50. Read from BookTrend by
+        # index, scores are shown decayed to now
+        board = request.query_params.get('board', 'borrowed')
+        if board not in self.trending_boards:
+            raise exceptions.ValidationError({'board': f"Choose one of {', '.join(self.trending_boards)}"})
+        try:
+            limit = min(max(int(request.query_params.get('limit', 10)), 1), 50)
+        except ValueError:
+            raise exceptions.ValidationError({'limit': 'A whole number is required'})
+        field = self.trending_boards[board]
+        half_life = settings.TRENDING_BORROW_HALF_LIFE_DAYS if board == 'borrowed' else settings.TRENDING_RATING_HALF_LIFE_DAYS
+        trends = BookTrend.objects.filter(**{f'{field}__gt': 0})
+        if request.query_params.get('genre'):
+            trends = trends.filter(genre=request.query_params['genre'])
+        # The epoch comes with the scores, rebuild_trends may rescale them at any moment
+        top = list(trends.order_by(f'-{field}').annotate(epoch=BookTrend.epoch_subquery()).values_list('book_id', field, 'epoch')[:limit])
+        books = Book.objects.in_bulk([book_id for book_id, *_ in top])
+        now = timezone.now()
+        for book_id, score, epoch in top:
+            books[book_id].score = score / BookTrend.weight(now, half_life, epoch or BookTrend.TREND_EPOCH)
+        return Response(self.get_serializer([books[book_id] for book_id, *_ in top], many=True).data)
+    
+    @action(detail=True, serializer_class=ScoredBookSerializer)
+    def similar(self, request, pk=None):
+        # The neighbours build_recommendations stored for this book, best first
+        book = self.get_object()
+        books = Book.objects.filter(neighbour_of__book=book).annotate(score=F('neighbour_of__score')).order_by('neighbour_of__rank')
+        return Response(self.get_serializer(books, many=True).data)
     
     
 class TransactionViewset(viewsets.ViewSet):
     permission_classes = [permissions.IsAuthenticated] #So that only authenticated users can carry out transactions
+    throttle_scope = 'transactions'
     
     def create(self, request):
         #The logic that controls book checkout
         book_id = request.data.get('book_id')
-        book = Book.objects.filter(id=book_id, available_copies__gt=0).first()
-        if not book:
-            return Response({'error': "Book is currently unavailable"}, status=status.HTTP_400_BAD_REQUEST) #To make sure only books with available copies can be checked out
-        #Logic to ensure a user is unable to check out a book more than once
-        user_transactions = Transaction.objects.filter(user=request.user, book=book, return_date=None)
-        if user_transactions.exists():
+        try:
+            with transaction.atomic():
+                # A copy set aside for the member's hold is already off the shelf, otherwise one is taken from available_copies
+                claimed = Hold.objects.filter(user=request.user, book_id=book_id, status=Hold.READY).update(status=Hold.FULFILLED)
+                if not claimed:
+                    # Taking a copy is a single conditional UPDATE, so two members can never both get the last copy
+                    taken = Book.objects.filter(id=book_id, available_copies__gt=0).update(available_copies=F('available_copies') - 1)
+                    if not taken:
+                        return Response({'error': "Book is currently unavailable", 'hold': "POST the book_id to library/holds/ to be told when a copy is yours"},
+                                        status=status.HTTP_400_BAD_REQUEST) #To make sure only books with available copies can be checked out
+                    # A member still waiting in the queue who gets a shelved copy, e.g. one staff just added, leaves the queue
+                    Hold.objects.filter(user=request.user, book_id=book_id, status=Hold.WAITING).update(status=Hold.FULFILLED)
+                loan = Transaction.objects.create(user=request.user, book_id=book_id)
+                if not claimed:
+                    book_copies_changed.send(sender=Book, book_ids=[loan.book_id])
+                books_checked_out.send(sender=Book, book_ids=[loan.book_id])
+        except IntegrityError:
+            # The unique_open_loan constraint stops a user from checking out a book more than once, and the copy taken above is rolled back
             return Response({'error': 'You have already borrowed this book'}, status=status.HTTP_400_BAD_REQUEST)
-        transaction = Transaction.objects.create(user=request.user, book=book) #Creating a transaction if user transaction does not exist
-        book.available_copies -= 1 #Reducing the number of available copies if checkout transaction is created successfully
-        book.save()
-        return Response(TransactionSerializer(transaction).data, status=status.HTTP_201_CREATED)
+        return Response(TransactionSerializer(loan).data, status=status.HTTP_201_CREATED)
     
     #The Logic that controls Book Returning
     def return_book(self, request):
         transaction_id = request.data.get('transaction_id')
         # Logic to ensure you can only return a book you borrowed
-        try:
-            transaction = Transaction.objects.get(id=transaction_id, user=request.user)
-        except Transaction.DoesNotExist:
+        loan = Transaction.objects.select_related('book').filter(id=transaction_id, user=request.user).first()
+        if loan is None:
             return Response({"error": "The Checkout transaction does not exist."}, status=status.HTTP_404_NOT_FOUND)
 
         # Logic to ensure a book can only be returned once
-        if transaction.return_date is not None:
+        if loan.return_date is not None:
             return Response({"error": "This transaction has already been settled."}, status=status.HTTP_400_BAD_REQUEST)
 
-        # If everything checks out, successfullly return the book
-        transaction.return_date = datetime.datetime.now()
-        transaction.save()
-        book = transaction.book
-        book.available_copies += 1 # Increase available copies
-        book.save()
+        # If everything checks out, successfullly return the book. Only the request that actually closes the loan gives the copy back
+        return_date = timezone.now()
+        with transaction.atomic():
+            closed = Transaction.objects.filter(id=loan.id, return_date=None).update(return_date=return_date)
+            if not closed:
+                return Response({"error": "This transaction has already been settled."}, status=status.HTTP_400_BAD_REQUEST)
+            release_copies([loan.book_id]) # To the first member waiting for it, or back on the shelf
+        loan.return_date = return_date
+
+        return Response(TransactionSerializer(loan).data, status=status.HTTP_200_OK)
+    
+    # Batch checkout and return, for the front desk and kiosks handling a whole stack of books at once.
+    # Each item gets its own result. Without all_or_nothing the books that can go through do, and the response
+    # is 201 when every item succeeded, 207 when only some did and 400 when none did.
+    batch_attempts = 3 # Retries when another request changes the same books between our read and our write
+    
+    def batch_create(self, request):
+        serializer = BatchCheckoutSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        book_ids = list(dict.fromkeys(serializer.validated_data['book_ids'])) # Drop repeated ids, keep the order
+        for _ in range(self.batch_attempts):
+            try:
+                with transaction.atomic():
+                    return self._batch_checkout(request.user, book_ids, serializer.validated_data['all_or_nothing'])
+            except (BatchConflict, IntegrityError):
+                continue
+        return Response({'error': 'These books are being checked out by someone else right now, please try again.'}, status=status.HTTP_409_CONFLICT)
+    
+    def _batch_checkout(self, user, book_ids, all_or_nothing):
+        # Three reads and writes for the whole batch: the books, the user's open loans of them, then one UPDATE and one INSERT
+        books = Book.objects.select_for_update().only('id', 'title', 'available_copies').in_bulk(book_ids)
+        borrowed = set(Transaction.objects.filter(user=user, book_id__in=book_ids, return_date=None).values_list('book_id', flat=True))
+        held = set(Hold.objects.filter(user=user, book_id__in=book_ids, status=Hold.READY).values_list('book_id', flat=True)) # Copies already set aside for this member
+        errors = {}
+        for book_id in book_ids:
+            if book_id not in books or (books[book_id].available_copies < 1 and book_id not in held):
+                errors[book_id] = "Book is currently unavailable"
+            elif book_id in borrowed:
+                errors[book_id] = 'You have already borrowed this book'
+        eligible = [book_id for book_id in book_ids if book_id not in errors]
+        if all_or_nothing and errors:
+            eligible = []
+        
+        loans = {}
+        if eligible:
+            claimed = [book_id for book_id in eligible if book_id in held]
+            shelved = [book_id for book_id in eligible if book_id not in held]
+            if claimed and Hold.objects.filter(user=user, book_id__in=claimed, status=Hold.READY).update(status=Hold.FULFILLED) != len(claimed):
+                raise BatchConflict() # A hold expired between the read and the update
+            if shelved:
+                taken = Book.objects.filter(id__in=shelved, available_copies__gt=0).update(available_copies=F('available_copies') - 1)
+                if taken != len(shelved):
+                    raise BatchConflict() # A copy went between the read and the update, roll back and look again
+                Hold.objects.filter(user=user, book_id__in=shelved, status=Hold.WAITING).update(status=Hold.FULFILLED)
+                book_copies_changed.send(sender=Book, book_ids=shelved)
+            created = Transaction.objects.bulk_create([Transaction(user=user, book=books[book_id]) for book_id in eligible])
+            loans = {loan.book_id: loan for loan in created}
+            books_checked_out.send(sender=Book, book_ids=eligible)
+        
+        results = []
+        for book_id in book_ids:
+            if book_id in loans:
+                results.append({'book_id': book_id, 'status': 'checked_out', 'transaction': TransactionSerializer(loans[book_id]).data})
+            else:
+                results.append({'book_id': book_id, 'status': 'failed', 'error': errors.get(book_id, 'Not checked out because another book in the batch failed')})
+        return Response({'results': results}, status=batch_status(len(loans), len(book_ids), status.HTTP_201_CREATED))
+    
+    def batch_return(self, request):
+        serializer = BatchReturnSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        transaction_ids = list(dict.fromkeys(serializer.validated_data['transaction_ids']))
+        for _ in range(self.batch_attempts):
+            try:
+                with transaction.atomic():
+                    return self._batch_return(request.user, transaction_ids, serializer.validated_data['all_or_nothing'])
+            except BatchConflict:
+                continue
+        return Response({'error': 'These transactions are being settled by another request right now, please try again.'}, status=status.HTTP_409_CONFLICT)
+    
+    def _batch_return(self, user, transaction_ids, all_or_nothing):
+        loans = Transaction.objects.select_for_update(of=('self',)).select_related('book').filter(user=user).in_bulk(transaction_ids)
+        errors = {}
+        for transaction_id in transaction_ids:
+            if transaction_id not in loans:
+                errors[transaction_id] = "The Checkout transaction does not exist."
+            elif loans[transaction_id].return_date is not None:
+                errors[transaction_id] = "This transaction has already been settled."
+        returnable = [transaction_id for transaction_id in transaction_ids if transaction_id not in errors]
+        if all_or_nothing and errors:
+            returnable = []
+        
+        if returnable:
+            return_date = timezone.now()
+            closed = Transaction.objects.filter(id__in=returnable, return_date=None).update(return_date=return_date)
+            if closed != len(returnable):
+                raise BatchConflict()
+            # unique_open_loan means every open loan here is for a different book, so each one gets exactly one copy back
+            returned_book_ids = [loans[transaction_id].book_id for transaction_id in returnable]
+            release_copies(returned_book_ids)
+            for transaction_id in returnable:
+                loans[transaction_id].return_date = return_date
+        
+        results = []
+        for transaction_id in transaction_ids:
+            if transaction_id in returnable:
+                results.append({'transaction_id': transaction_id, 'status': 'returned', 'transaction': TransactionSerializer(loans[transaction_id]).data})
+            else:
+                results.append({'transaction_id': transaction_id, 'status': 'failed', 'error': errors.get(transaction_id, 'Not returned because another transaction in the batch failed')})
+        return Response({'results': results}, status=batch_status(len(returnable), len(transaction_ids), status.HTTP_200_OK))
+
+
+class BatchConflict(Exception):
+    pass
 
-        return Response(TransactionSerializer(transaction).data, status=status.HTTP_200_OK)
+
+def batch_status(succeeded, total, success_status):
+    if succeeded == total:
+        return success_status
+    if succeeded:
+        return status.HTTP_207_MULTI_STATUS
+    return status.HTTP_400_BAD_REQUEST
     
     
 class NotificationListView(generics.ListAPIView):
     permission_classes = [permissions.IsAuthenticated]
-    serializer_class = NotificationSerializer
+    serializer_class = NotificationFeedSerializer
+    cursor_ordering = '-created_at'
+    
+    broadcast_receipt = None # Set by the async view, which can't look it up from inside feed_for
     
     def get_queryset(self):
-        return Notification.objects.filter(recipient=self.request.user)
+        return Notification.objects.feed_for(self.request.user, receipt=self.broadcast_receipt)
+    
+    def filter_keyset(self, queryset, condition):
+        return Notification.objects.feed_for(self.request.user, condition, receipt=self.broadcast_receipt)
+    
+    def paginate_queryset(self, queryset):
+        page = super().paginate_queryset(queryset)
+        # Move the member's read watermark up to the newest broadcast they are being shown
+        shown = [row['id'] for row in page or [] if row['kind'] == 'broadcast']
+        if shown:
+            BroadcastReceipt.advance(self.request.user, max(shown))
+        return page
     
 class NotificationCreateView(generics.CreateAPIView):
     serializer_class = NotificationSerializer
@@ -95,6 +399,88 @@ class UserProfileView(RetrieveAPIView):
     def get_object(self):
         return self.request.user
     
+class ProfileTransactionListView(SparseFieldsetMixin, generics.ListAPIView):
+    # The member's whole borrowing history, paginated, for when the recent ones on the profile are not enough
+    permission_classes = [permissions.IsAuthenticated]
+    serializer_class = TransactionSerializer
+    cursor_ordering = '-checkout_date'
+    
+    def get_queryset(self):
+        return Transaction.objects.filter(user=self.request.user).select_related('book').order_by('-checkout_date', '-id')
+    
+    
+class HoldListCreateView(SparseFieldsetMixin, generics.ListCreateAPIView):
+    # The member's waiting and ready holds, and joining the queue for a book with no copies left. Instead of
+    # retrying checkout, the member gets a notification when a copy has been set aside for them
+    permission_classes = [permissions.IsAuthenticated]
+    serializer_class = HoldSerializer
+    throttle_scope = 'transactions'
+    
+    def get_queryset(self):
+        return (Hold.objects.filter(user=self.request.user, status__in=Hold.ACTIVE).select_related('book')
+                .annotate(position=Hold.queue_position()).order_by('created_at', 'id'))
+    
+    def create(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        book = serializer.validated_data['book']
+        if Transaction.objects.filter(user=request.user, book=book, return_date=None).exists():
+            return Response({'error': 'You have already borrowed this book'}, status=status.HTTP_400_BAD_REQUEST)
+        if Book.objects.filter(id=book.id, available_copies__gt=0).exists():
+            return Response({'error': 'A copy is available, check it out instead'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            with transaction.atomic():
+                hold = serializer.save(user=request.user)
+                # A copy returned since the check above went back on the shelf, the return didn't know of this hold yet
+                if hand_off_shelved_copy(book.id):
+                    hold.refresh_from_db()
+        except IntegrityError:
+            # The unique_active_hold constraint, one place in the queue per member and book
+            return Response({'error': 'You are already waiting for this book'}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+    
+    
+class HoldCancelView(generics.DestroyAPIView):
+    permission_classes = [permissions.IsAuthenticated]
+    throttle_scope = 'transactions'
+    
+    def get_queryset(self):
+        return Hold.objects.filter(user=self.request.user, status__in=Hold.ACTIVE)
+    
+    def perform_destroy(self, hold):
+        # Holds are kept for the record, cancelling one frees the copy it had set aside
+        with transaction.atomic():
+            if Hold.objects.filter(id=hold.id, status=hold.status).update(status=Hold.CANCELLED) and hold.status == Hold.READY:
+                release_copies([hold.book_id])
+    
+    
+class ProfileRecommendationView(generics.ListAPIView):
+    # Books similar to what the member borrowed last and reviewed well, added up over the similarity index. A fixed
+    # number of seed books with a fixed number of neighbours each, however long the member's history is
+    permission_classes = [permissions.IsAuthenticated]
+    serializer_class = ScoredBookSerializer
+    pagination_class = None
+    seed_books = 20
+    recommendations = 20
+    
+    def get_queryset(self):
+        user = self.request.user
+        seeds = set(Transaction.objects.filter(user=user).order_by('-checkout_date', '-id').values_list('book_id', flat=True)[:self.seed_books])
+        seeds.update(Review.objects.filter(user=user, rating__gte=4).order_by('-created_at').values_list('book_id', flat=True)[:self.seed_books])
+        scores = {}
+        for similar_id, score in BookSimilarity.objects.filter(book_id__in=seeds).values_list('similar_id', 'score'):
+            scores[similar_id] = scores.get(similar_id, 0) + score
+        # Leave out what the member already read, looking only at the candidates rather than the whole history
+        read = set(Transaction.objects.filter(user=user, book_id__in=scores).values_list('book_id', flat=True))
+        read.update(Review.objects.filter(user=user, book_id__in=scores).values_list('book_id', flat=True))
+        ranked = sorted(((score, book_id) for book_id, score in scores.items() if book_id not in read and book_id not in seeds),
+                        key=lambda item: (-item[0], item[1]))[:self.recommendations]
+        books = Book.objects.in_bulk([book_id for _, book_id in ranked])
+        for score, book_id in ranked:
+            books[book_id].score = round(score, 4)
+        return [books[book_id] for _, book_id in ranked]
+    
+    
 class UserRegistrationView(generics.CreateAPIView):
     queryset = CustomUser.objects.all()
     serializer_class = UserRegistrationSerializer
@@ -105,7 +491,7 @@ class UserRegistrationView(generics.CreateAPIView):
         user = serializer.save()  # Save the user
 
         # Logic to generate tokens for the user upon successful registration
-        refresh = RefreshToken.for_user(user)
+        refresh = LibraryRefreshToken.for_user(user)
         access_token = str(refresh.access_token)
         refresh_token = str(refresh)
 
@@ -124,18 +510,25 @@ class UserRegistrationView(generics.CreateAPIView):
         )
         
         
+class TokenObtainView(TokenObtainPairView):
+    throttle_scope = 'token' # Every attempt hashes a password, so logins get their own small bucket
+    
+    
 def homepage(request):
     return render(request, 'home.html')
 
 
 
-class Reviews(viewsets.ModelViewSet):
+class Reviews(ConditionalGetMixin, SparseFieldsetMixin, viewsets.ModelViewSet):
     serializer_class = ReviewSerializer
     permission_classes = [IsAuthorOrReadOnly, permissions.IsAuthenticatedOrReadOnly]
     queryset = Review.objects.all()
     filter_backends = [DjangoFilterBackend, SearchFilter, OrderingFilter]
     filterset_fields = ['book', 'user']
     ordering_fields = ['rating']
+    cursor_ordering = '-created_at'
+    version_collection = 'reviews'
+    version_item = 'review'
     
 
     
@@ -154,7 +547,7 @@ class Reviews(viewsets.ModelViewSet):
         return super().create(request, *args, **kwargs) # Otherwise, create a new one
     
     
-class BookRequestView(generics.ListCreateAPIView):
+class BookRequestView(SparseFieldsetMixin, generics.ListCreateAPIView):
     serializer_class = BookRequestSerializer
     
     def get_queryset(self):
@@ -177,15 +570,235 @@ class GeneralNotificationView(views.APIView):
     def post(self, request):
         serializer = GeneralNotificationSerializer(data=request.data)
         if serializer.is_valid():
-            message = serializer.validated_data['message']
-            recipients = CustomUser.objects.all()
-            notifications = [
-                Notification(recipient=user, message=message) for user in recipients
-            ]
-            Notification.objects.bulk_create(notifications)
+            # Stored once, every member picks it up when they next read their notifications
+            BroadcastNotification.objects.create(message=serializer.validated_data['message'])
             return Response({'detail': 'Notification sent to all users.'}, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
     
-             
\ No newline at end of file
+
+class Echo:
+    # csv.writer wants something to write to, this just hands each line back so it can be streamed
+    def write(self, value):
+        return value
+    
+    
+class ExportView(generics.GenericAPIView):
+    # Staff-only dumps of a whole table as CSV or NDJSON (?export_format=, DRF keeps ?format= for renderers).
+    # Rows are read with .iterator() in chunks and written out as they arrive, so memory stays flat however
+    # big the table is, and related names come from joins in the same query instead of one query per row.
+    permission_classes = [permissions.IsAdminUser]
+    filter_backends = [DjangoFilterBackend]
+    pagination_class = None
+    columns = () # (header, lookup) pairs, lookups can follow foreign keys e.g. ('book_title', 'book__title')
+    export_name = None
+    chunk_size = 2000
+    
+    def get(self, request, *args, **kwargs):
+        export_format = request.query_params.get('export_format', 'csv')
+        if export_format not in ('csv', 'ndjson'):
+            return Response({'error': "export_format must be csv or ndjson"}, status=status.HTTP_400_BAD_REQUEST)
+        queryset = self.filter_queryset(self.get_queryset()).order_by('id')
+        queryset = queryset.using(queryset.db) # Rows are read after the view returns, keep them on the database picked for this request
+        rows = queryset.values_list(*(lookup for _, lookup in self.columns)).iterator(chunk_size=self.chunk_size)
+        headers = [header for header, _ in self.columns]
+        if export_format == 'csv':
+            lines, content_type = self.csv_lines(headers, rows), 'text/csv'
+        else:
+            lines, content_type = self.ndjson_lines(headers, rows), 'application/x-ndjson'
+        response = StreamingHttpResponse(lines, content_type=content_type)
+        response['Content-Disposition'] = f'attachment; filename="{self.export_name}-{timezone.now():%Y%m%d%H%M%S}.{export_format}"'
+        return response
+    
+    def csv_lines(self, headers, rows):
+        writer = csv.writer(Echo())
+        yield writer.writerow(headers)
+        for row in rows:
+            yield writer.writerow(['' if value is None else self.export_value(value) for value in row])
+    
+    def ndjson_lines(self, headers, rows):
+        for row in rows:
+            yield json.dumps(dict(zip(headers, map(self.export_value, row))), cls=DjangoJSONEncoder) + '\n'
+    
+    @staticmethod
+    def export_value(value):
+        # ISO 8601 with the full microseconds in both formats, so exported rows can be matched back exactly
+        return value.isoformat() if hasattr(value, 'isoformat') else value
+    
+    
+class BookExportView(ExportView):
+    queryset = Book.objects.all()
+    filter_backends = [DjangoFilterBackend, BookSearchFilter]
+    filterset_fields = BookViewSet.filterset_fields
+    search_fields = BookViewSet.search_fields
+    export_name = 'books'
+    columns = (
+        ('id', 'id'), ('title', 'title'), ('author', 'author'), ('isbn', 'isbn'), ('genre', 'genre'),
+        ('published_date', 'published_date'), ('available_copies', 'available_copies'),
+        ('rating_sum', 'rating_sum'), ('rating_count', 'rating_count'),
+    )
+    
+    
+class TransactionExportView(ExportView):
+    queryset = Transaction.objects.all()
+    filterset_fields = {'user': ['exact'], 'book': ['exact'], 'return_date': ['isnull']} # ?return_date__isnull=true for open loans
+    export_name = 'transactions'
+    columns = (
+        ('id', 'id'), ('user_id', 'user_id'), ('username', 'user__username'), ('book_id', 'book_id'),
+        ('book_title', 'book__title'), ('book_isbn', 'book__isbn'), ('checkout_date', 'checkout_date'),
+        ('expected_return_date', 'expected_return_date'), ('return_date', 'return_date'),
+    )
+    
+    
+class ReviewExportView(ExportView):
+    queryset = Review.objects.all()
+    filterset_fields = Reviews.filterset_fields
+    export_name = 'reviews'
+    columns = (
+        ('id', 'id'), ('book_id', 'book_id'), ('book_title', 'book__title'), ('user_id', 'user_id'),
+        ('username', 'user__username'), ('rating', 'rating'), ('review_text', 'review_text'),
+        ('created_at', 'created_at'), ('updated_at', 'updated_at'),
+    )
+    
+    
+class MetricsView(views.APIView):
+    # Prometheus scrape target, see library/metrics.py. Staff only, the scraper sends a staff member's token
+    permission_classes = [permissions.IsAdminUser]
+    
+    def get(self, request):
+        return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+    
+    
+class AsyncReadView(View):
+    # GET and HEAD of a DRF view served through Django's async ORM, so under ASGI a request waiting on the database
+    # doesn't hold a worker thread. The DRF view still decides the queryset, filters, serializer, pagination,
+    # permissions and authentication: it is set up here the way DRF would set it up, only the reads are awaited.
+    # Every other method is handed to the DRF view unchanged.
+    view_class = None
+    read_action = 'list' # or 'retrieve'
+    write_actions = {} # The viewset actions for the other methods on the same URL, e.g. {'post': 'create'}
+    basename = None # The router basename of a viewset, for the names it gives itself
+    sync_view = None
+    
+    @classmethod
+    def as_view(cls, **initkwargs):
+        if issubclass(cls.view_class, viewsets.ViewSetMixin):
+            detail = cls.read_action != 'list' # What the router passes, OPTIONS and the browsable API name the view from it
+            sync_view = cls.view_class.as_view({'get': cls.read_action, **cls.write_actions}, basename=cls.basename,
+                                               detail=detail, suffix='Instance' if detail else 'List')
+        else:
+            sync_view = cls.view_class.as_view()
+        view = super().as_view(sync_view=sync_view, **initkwargs)
+        view.csrf_exempt = True # Like every DRF view, token authenticated clients send no CSRF token
+        return view
+    
+    async def get(self, request, *args, **kwargs):
+        # Set up the way the DRF view's own as_view() does, so the Allow header and the browsable API match it
+        view = self.view_class(**self.sync_view.initkwargs)
+        if hasattr(self.sync_view, 'actions'):
+            view.action_map = self.sync_view.actions
+            for method, action in view.action_map.items():
+                setattr(view, method, getattr(view, action))
+        view.setup(request, *args, **kwargs)
+        try:
+            await sync_to_async(self.initial)(view, request, *args, **kwargs)
+            await self.prepare(view)
+            response = await self.read(view, view.request, **kwargs)
+        except Exception as exc:
+            response = view.handle_exception(exc)
+        return view.finalize_response(view.request, response, *args, **kwargs)
+    
+    async def write(self, request, *args, **kwargs):
+        return await sync_to_async(self.sync_view)(request, *args, **kwargs)
+    
+    post = put = patch = delete = options = write
+    
+    @staticmethod
+    def initial(view, request, *args, **kwargs):
+        # What APIView.dispatch does before calling the handler, run in a thread: initial() authenticates and checks
+        # permissions and throttles, which may query the database or read the cache
+        view.request = view.initialize_request(request, *args, **kwargs)
+        view.headers = view.default_response_headers
+        view.initial(view.request, *args, **kwargs)
+    
+    async def prepare(self, view):
+        pass
+    
+    async def read(self, view, request, **kwargs):
+        # The same layers the DRF view puts around list/retrieve: conditional GET, then the catalog cache
+        if not isinstance(view, ConditionalGetMixin):
+            return await self.cached(view, request, **kwargs)
+        key = view.version_key(kwargs)
+        etag, last_modified, not_modified = view.check_validators(request, key, (await ResourceVersion.alookup(key)).get(key))
+        if not_modified is not None:
+            return not_modified
+        return view.add_validators(await self.cached(view, request, **kwargs), etag, last_modified)
+    
+    async def cached(self, view, request, **kwargs):
+        handler = self.list if self.read_action == 'list' else self.retrieve
+        if not isinstance(view, CatalogCacheMixin):
+            return await handler(view, request, **kwargs)
+        key, data = await sync_to_async(view.cache_lookup)(request, view.cache_generation(kwargs)) # File cache reads block
+        if data is not None:
+            return Response(data)
+        with use_primary():
+            response = await handler(view, request, **kwargs)
+        return await sync_to_async(view.cache_store)(key, response)
+    
+    async def filtered_queryset(self, view):
+        # Filter backends only build the query, but validating some filters (e.g. ?book=<id>) reads the database
+        return await sync_to_async(view.filter_queryset)(view.get_queryset())
+    
+    async def list(self, view, request, **kwargs):
+        queryset = await self.filtered_queryset(view)
+        if view.paginator is None:
+            return Response(view.get_serializer([row async for row in queryset], many=True).data)
+        page = await view.paginator.apaginate_queryset(queryset, request, view=view)
+        await self.page_read(view, page)
+        return view.get_paginated_response(view.get_serializer(page, many=True).data)
+    
+    async def page_read(self, view, page):
+        pass
+    
+    async def retrieve(self, view, request, **kwargs):
+        queryset = await self.filtered_queryset(view)
+        lookup_url_kwarg = view.lookup_url_kwarg or view.lookup_field
+        try:
+            obj = await queryset.aget(**{view.lookup_field: kwargs[lookup_url_kwarg]})
+        except (queryset.model.DoesNotExist, TypeError, ValueError, DjangoValidationError):
+            raise Http404(f'No {queryset.model._meta.object_name} matches the given query.')
+        view.check_object_permissions(request, obj)
+        return Response(view.get_serializer(obj).data)
+    
+    
+class AsyncBookListView(AsyncReadView):
+    view_class = BookViewSet
+    basename = 'books'
+    write_actions = {'post': 'create'}
+    
+    
+class AsyncBookDetailView(AsyncReadView):
+    view_class = BookViewSet
+    basename = 'books'
+    read_action = 'retrieve'
+    write_actions = {'put': 'update', 'patch': 'partial_update', 'delete': 'destroy'}
+    
+    
+class AsyncReviewListView(AsyncReadView):
+    view_class = Reviews
+    basename = 'review'
+    write_actions = {'post': 'create'}
+    
+    
+class AsyncNotificationListView(AsyncReadView):
+    view_class = NotificationListView
+    
+    async def prepare(self, view):
+        view.broadcast_receipt = await BroadcastReceipt.last_read_for(view.request.user)
+    
+    async def page_read(self, view, page):
+        # What NotificationListView.paginate_queryset does: the broadcasts on this page now count as read
+        shown = [row['id'] for row in page or [] if row['kind'] == 'broadcast']
+        if shown:
+            await BroadcastReceipt.aadvance(view.request.user, max(shown))
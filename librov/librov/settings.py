@@ -46,9 +46,20 @@ INSTALLED_APPS = [
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'library.authentication.CachedJWTAuthentication', # simplejwt's JWTAuthentication, with the users cached per process
     ),
-    'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination', 'PAGE_SIZE': 10,
+    'DEFAULT_PAGINATION_CLASS': 'library.pagination.LibraryPagination', 'PAGE_SIZE': 10, # Page numbers by default, ?pagination=cursor for keyset pages
+    # Token buckets (library/throttling.py): a client can burst to the number, then gets that many per period
+    'DEFAULT_THROTTLE_CLASSES': (
+        'library.throttling.UserTokenBucketThrottle',
+        'library.throttling.EndpointTokenBucketThrottle',
+    ),
+    'DEFAULT_THROTTLE_RATES': {
+        'user': '600/min',
+        'anon': '120/min',
+        'transactions': '60/min', # Checkouts and returns, per member
+        'token': '10/min', # Logins hash the password, per IP address
+    },
 }
 
 AUTH_USER_MODEL = 'library.Customuser'
@@ -56,14 +67,22 @@ AUTH_USER_MODEL = 'library.Customuser'
 SIMPLE_JWT = {
     'ACCESS_TOKEN_LIFETIME': timedelta(days=365),
     'REFRESH_TOKEN_LIFETIME' : timedelta(days=1000),
-    
+    'TOKEN_OBTAIN_SERIALIZER': 'library.serializers.LibraryTokenObtainPairSerializer',
 }
 
+# Users resolved from tokens are cached in each process. A change made by another worker (deactivating a member,
+# a new password) reaches this one once its entry expires
+AUTH_USER_CACHE_SIZE = 10000
+AUTH_USER_CACHE_SECONDS = 60
+
 AUTHENTICATION_BACKENDS = [
     'django.contrib.auth.backends.ModelBackend',
 ]
 
 MIDDLEWARE = [
+    'library.metrics.MetricsMiddleware', # First, so request latency covers the rest of the stack. Served at /metrics
+    'library.throttling.LoadSheddingMiddleware', # 503 once MAX_CONCURRENT_REQUESTS run and MAX_QUEUED_REQUESTS wait
+    'library.routers.ReplicaRoutingMiddleware', # Safe-method requests read from LIBROV_READ_REPLICAS when there are any
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -75,6 +94,11 @@ MIDDLEWARE = [
 
 ROOT_URLCONF = 'librov.urls'
 
+# Async views for the busiest reads (library/urls.py), opt-in with LIBROV_ASYNC_VIEWS=1 and only worth it under
+# ASGI. Under WSGI every async view would be run through async_to_sync on each request, and benchmark_asgi measured
+# them slower than the sync views under ASGI too, so they stay off by default
+ASYNC_READ_VIEWS = os.environ.get('LIBROV_ASYNC_VIEWS') == '1'
+
 TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
@@ -104,6 +128,85 @@ DATABASES = {
     }
 }
 
+# Production SQLite profile, on unless LIBROV_SQLITE_PROFILE=plain (e.g. to benchmark against the defaults).
+# WAL lets readers carry on while the one writer commits, and synchronous=NORMAL is still crash safe under WAL.
+# Writers queue on busy_timeout instead of failing with "database is locked", and IMMEDIATE transactions take
+# the write lock up front, so an atomic block can't fail halfway when it turns from reading to writing.
+# Connections are kept for CONN_MAX_AGE seconds and checked before reuse, so the pragmas run once per connection.
+if os.environ.get('LIBROV_SQLITE_PROFILE', 'production') == 'production':
+    DATABASES['default'].update({
+        'CONN_MAX_AGE': 600,
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            'transaction_mode': 'IMMEDIATE',
+            'init_command': (
+                'PRAGMA journal_mode=WAL;'
+                'PRAGMA synchronous=NORMAL;'
+                'PRAGMA busy_timeout=5000;'
+                'PRAGMA mmap_size=134217728;' # 128 MB of the file read through memory mapping
+                'PRAGMA cache_size=-20000;' # About 20 MB of page cache per connection
+                'PRAGMA temp_store=MEMORY;'
+            ),
+        },
+    })
+
+# Read replicas. LIBROV_READ_REPLICAS is a comma separated list of SQLite files holding copies of db.sqlite3
+# (sync_replicas refreshes them). Safe-method requests read from them, see library/routers.py. They are
+# mirrors of default in tests, and migrations only ever run on default.
+for number, replica in enumerate(filter(None, os.environ.get('LIBROV_READ_REPLICAS', '').split(',')), start=1):
+    DATABASES[f'replica{number}'] = {
+        **DATABASES['default'],
+        'NAME': replica.strip(),
+        'OPTIONS': {'init_command': DATABASES['default'].get('OPTIONS', {}).get('init_command', '')},
+        'TEST': {'MIRROR': 'default'},
+    }
+
+DATABASE_ROUTERS = ['library.routers.ReadReplicaRouter']
+# After a client writes, its reads skip replicas not synced since, for this long at most. Longer than the
+# sync_replicas interval, so clients always see their own writes. Replicas need a shared cache (LIBROV_CACHE_DIR)
+REPLICA_PIN_SECONDS = int(os.environ.get('LIBROV_REPLICA_PIN_SECONDS', 3600))
+
+
+# Cache
+# https://docs.djangoproject.com/en/5.1/topics/cache/
+# Local memory by default. Set LIBROV_CACHE_DIR to use a file cache, which every worker process shares.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'librov',
+        'OPTIONS': {'MAX_ENTRIES': 5000},
+    }
+}
+
+if os.environ.get('LIBROV_CACHE_DIR'):
+    CACHES['default'] = {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.environ['LIBROV_CACHE_DIR'],
+        'OPTIONS': {'MAX_ENTRIES': 20000},
+    }
+
+CATALOG_CACHE_ALIAS = 'default'
+THROTTLE_DATABASE = os.environ.get('LIBROV_THROTTLE_DB', BASE_DIR / 'throttle.sqlite3') # Token buckets, shared by the workers
+
+TEST_RUNNER = 'library.testing.LibraryTestRunner' # Gives the tests their own THROTTLE_DATABASE
+
+# Trending boards (BookTrend), how long until an event counts half as much
+TRENDING_BORROW_HALF_LIFE_DAYS = 7
+TRENDING_RATING_HALF_LIFE_DAYS = 90
+
+AVAILABILITY_MAX_ITEMS = 200 # Books per books/availability/ request
+AVAILABILITY_MAX_AGE = 30 # Seconds shared caches may keep an availability answer
+
+HOLD_PICKUP_DAYS = 3 # How long a copy set aside for a hold waits before it goes to the next member
+
+# Load shedding, per process
+MAX_CONCURRENT_REQUESTS = int(os.environ.get('LIBROV_MAX_CONCURRENT_REQUESTS', 32)) # 0 turns it off
+MAX_QUEUED_REQUESTS = int(os.environ.get('LIBROV_MAX_QUEUED_REQUESTS', 64))
+QUEUE_TIMEOUT_SECONDS = 2
+LOAD_SHEDDING_EXEMPT_PATHS = ['/metrics'] # Still scraped when the server is overloaded, that's when it matters
+CATALOG_CACHE_TIMEOUT = 300 # Seconds a cached book page lives at most, changes invalidate it before that
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
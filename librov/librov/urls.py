@@ -16,10 +16,11 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import path, include
-from library.views import homepage
+from library.views import homepage, MetricsView
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('library/', include('library.urls')),
+    path('metrics', MetricsView.as_view(), name='metrics'),
     path('', homepage, name='homepage')
 ]